@@ -1,5 +1,9 @@
 from flask import Flask
-from app import config
+from app import config, hepmcio_parallel
+from app.cache import PayloadCache
+from app.prefetch import Prefetcher
+from app.jobs import UploadJobs
+from app.timing import Metrics, SlowRequestProfiler
 from flask_bootstrap import Bootstrap
 from flask_pymongo import PyMongo
 
@@ -8,6 +12,14 @@ app = Flask(__name__)
 app.config.from_object(config.Config)
 bootstrap = Bootstrap(app)
 mongo = PyMongo(app)
+hepmcio_parallel.MAX_PROCESSES = app.config["INGEST_WORKERS"]
+event_cache = PayloadCache(app.config["EVENT_CACHE_MAX_ENTRIES"], app.config["EVENT_CACHE_MAX_BYTES"])
+prefetcher = Prefetcher(event_cache, app.config["PREFETCH_WORKERS"], app.config["PREFETCH_MAX_PENDING"])
+upload_jobs = UploadJobs(event_cache, app.config["UPLOAD_WORKERS"], app.config["INGEST_BATCH_SIZE"],
+                         app.config["INGEST_WORKERS"])
+metrics = Metrics()
+profiler = SlowRequestProfiler(app.config["PROFILE_DIR"], app.config["PROFILE_MIN_SECONDS"]) \
+    if app.config["PROFILE_DIR"] else None
 
 from app import routes
 
@@ -0,0 +1,97 @@
+"""In-process cache for finished Visualiser payloads. Uploads to a collection are write-once, so a payload
+   for a given file, event and set of view parameters never changes until the file is uploaded again.
+
+   Classes:
+   PayloadCache -- thread-safe LRU cache of encoded payloads bounded by entry count and total size.
+   """
+
+import threading
+from collections import OrderedDict
+
+
+class PayloadCache(object):
+    """Thread-safe LRU cache of encoded payloads. Keys are tuples whose first element is the filename, so all
+       entries for a file can be dropped at once. Values are bytes, and their lengths count towards the
+       memory cap.
+
+       Methods:
+       get -- returns a cached payload, or None on a miss.
+       contains -- checks for a payload without touching the counters or the LRU order.
+       put -- stores a payload, evicting least recently used entries to stay within the limits.
+       invalidate -- drops all entries for a file.
+       clear -- drops all entries.
+       stats -- returns the hit/miss counters and current size.
+    """
+    def __init__(self, max_entries=512, max_bytes=64*1024*1024):
+        """Constructor.
+
+           Arguments:
+           max_entries -- maximum number of payloads held.
+           max_bytes -- maximum total size of the payloads held.
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the payload stored under key and marks it as most recently used, or None on a miss.
+        """
+        with self._lock:
+            payload = self._entries.get(key)
+            if payload is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return payload
+
+    def contains(self, key):
+        """Returns whether a payload is stored under key, without counting a hit or miss or changing the LRU order.
+        """
+        with self._lock:
+            return key in self._entries
+
+    def put(self, key, payload):
+        """Stores a payload under key. Payloads larger than the memory cap are not stored.
+
+           Arguments:
+           key -- a tuple starting with the filename.
+           payload -- the encoded payload, as bytes.
+        """
+        if len(payload) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._nbytes -= len(self._entries.pop(key))
+            self._entries[key] = payload
+            self._nbytes += len(payload)
+            while len(self._entries) > self.max_entries or self._nbytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._nbytes -= len(evicted)
+                self.evictions += 1
+
+    def invalidate(self, filename):
+        """Drops all entries for a file, e.g. when it is uploaded again or deleted.
+        """
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == filename]:
+                self._nbytes -= len(self._entries.pop(key))
+
+    def clear(self):
+        """Drops all entries.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
+
+    def stats(self):
+        """Returns a dict with the hit, miss and eviction counters, the number of entries and their total size.
+        """
+        with self._lock:
+            return {"hits":self.hits, "misses":self.misses, "evictions":self.evictions,
+                    "entries":len(self._entries), "bytes":self._nbytes}
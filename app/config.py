@@ -1,5 +1,34 @@
 import os
 
+basedir = os.path.abspath(os.path.dirname(__file__))
+
 class Config(object):
     SECRET_KEY = os.environ.get("SECRET_KEY") or "glasgowPPE2019"
-    MONGO_URI = "mongodb://localhost:27017/ppeDatabase"
\ No newline at end of file
+    MONGO_URI = "mongodb://localhost:27017/ppeDatabase"
+    #Directory of HepMC files the Visualiser can read straight from disk when they are not in the database.
+    EVENT_FILES_DIR = os.environ.get("EVENT_FILES_DIR") or os.path.join(basedir, os.pardir, "event_files")
+    #Number of documents buffered before each database insert while ingesting an upload.
+    INGEST_BATCH_SIZE = 10000
+    #Worker processes used to parse uploads, shared by all the uploads running at the same time.
+    INGEST_WORKERS = int(os.environ.get("INGEST_WORKERS") or os.cpu_count() or 1)
+    #Storage layout of uploads unless the upload form asks for another: "documents" for one document per event,
+    #particle and vertex, or "packed" for one document per event with packed binary columns.
+    STORAGE_LAYOUT = os.environ.get("STORAGE_LAYOUT") or "documents"
+    #Uploads ingested in the background at the same time.
+    UPLOAD_WORKERS = 2
+    #Limits of the in-process cache of rendered event payloads.
+    EVENT_CACHE_MAX_ENTRIES = 512
+    EVENT_CACHE_MAX_BYTES = 64*1024*1024
+    #Worker threads and queue bound for prefetching the events either side of the one being viewed.
+    PREFETCH_WORKERS = 2
+    PREFETCH_MAX_PENDING = 8
+    #Solenoid field in tesla along the beam axis, segments per track and track length in mm used to propagate
+    #tracks for the spacetime view, and the most segments a client may ask for.
+    TRAJECTORY_FIELD = 4.0
+    TRAJECTORY_STEPS = 32
+    TRAJECTORY_LENGTH = 1000.0
+    TRAJECTORY_MAX_STEPS = 256
+    #Directory to write cProfile dumps of slow requests to, for profiling a running server; requests are only
+    #profiled when it is set. Requests taking at least PROFILE_MIN_SECONDS are dumped.
+    PROFILE_DIR = os.environ.get("PROFILE_DIR")
+    PROFILE_MIN_SECONDS = float(os.environ.get("PROFILE_MIN_SECONDS") or 1.0)
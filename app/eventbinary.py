@@ -0,0 +1,162 @@
+"""Compact binary encoding of the Visualiser's event payloads. Instead of a JSON list of particle and vertex
+   documents, an event is sent as a small header followed by packed little-endian columns, which the browser
+   wraps in Float32Array/Int32Array views without parsing anything. The columns are built with NumPy straight
+   from the event, without going through per-particle documents.
+
+   Layout, every field 4 bytes wide so that each column starts on a 4-byte boundary:
+   header -- the magic bytes "HEPB", the format version (uint32), then the event number, the number of
+   particles n, the number of vertices m and the number of bundles b (int32).
+   particle columns -- momentum (float32, n x 4: px py pz E), pid (int32), charge (float32), barcode (int32),
+   status (int32), start_vertex and end_vertex (int32 indices into the vertex columns, -1 if none).
+   vertex columns -- position (float32, m x 4: x y z t), barcode (int32).
+   bundle columns -- type (int32 index into selection.TRACK_TYPES), count (int32), momentum (float32, b x 4),
+   summarising soft particles left out of the particle columns (see selection.Budget).
+
+   Trajectories computed by the trajectory module are sent the same way: the magic bytes "HEPT", the format
+   version (uint32), the event number, the number of tracks n and the number of points per track k (int32),
+   then the points (float32, n x k x 3: x y z), one track after another.
+
+   Functions:
+   encode_event -- packs an event's selected particles and all its vertices.
+   decode_event -- unpacks an encoded event into NumPy arrays.
+   encode_trajectories -- packs the polylines of an event's tracks.
+   decode_trajectories -- unpacks encoded trajectories into a NumPy array.
+   """
+
+import numpy as np
+from app import hepmcio, selection
+
+#Media type of encoded events, for content negotiation.
+MIMETYPE = "application/vnd.hepmc-event"
+
+MAGIC = b"HEPB"
+VERSION = 2
+
+HEADER_DTYPE = np.dtype([("magic", "S4"), ("version", "<u4"), ("no", "<i4"), ("nparticles", "<i4"),
+                         ("nvertices", "<i4"), ("nbundles", "<i4")])
+
+#Media type, magic bytes and header of encoded trajectories.
+TRAJECTORY_MIMETYPE = "application/vnd.hepmc-trajectories"
+TRAJECTORY_MAGIC = b"HEPT"
+TRAJECTORY_VERSION = 1
+TRAJECTORY_HEADER_DTYPE = np.dtype([("magic", "S4"), ("version", "<u4"), ("no", "<i4"), ("ntracks", "<i4"),
+                                    ("npoints", "<i4")])
+
+#Name, type and width of each column, in the order they are written.
+PARTICLE_COLUMNS = (("momentum", "<f4", 4), ("pid", "<i4", 1), ("charge", "<f4", 1), ("barcode", "<i4", 1),
+                    ("status", "<i4", 1), ("start_vertex", "<i4", 1), ("end_vertex", "<i4", 1))
+VERTEX_COLUMNS = (("position", "<f4", 4), ("barcode", "<i4", 1))
+BUNDLE_COLUMNS = (("type", "<i4", 1), ("count", "<i4", 1), ("momentum", "<f4", 4))
+
+
+def _vertex_indices(barcodes, order, vertex_barcodes):
+    "Map vertex barcodes to indices into the vertex columns, -1 for barcodes that are not among them"
+    if not len(vertex_barcodes):
+        return np.full(len(barcodes), -1, dtype="<i4")
+    sorted_barcodes = vertex_barcodes[order]
+    pos = np.clip(np.searchsorted(sorted_barcodes, barcodes), 0, len(order) - 1)
+    return np.where(sorted_barcodes[pos] == barcodes, order[pos], -1).astype("<i4")
+
+
+def encode_event(no, evt, particles, bundles=(), vertices=None):
+    """Packs an event into the binary payload format.
+
+       Arguments:
+       no -- the number of the event in the file.
+       evt -- the hepmcio event.
+       particles -- the particles to include, in order, e.g. as chosen by eventview.select_particles.
+       bundles -- bundles of soft particles as built by selection.bundles.
+       vertices -- the vertices to include, by default all the event's vertices.
+
+       Returns:
+       The encoded event as bytes.
+    """
+    arrays = selection.EventArrays(evt, particles)
+    n = len(arrays.particles)
+    vertices = list(evt.vertices.values() if vertices is None else vertices)
+    vertex_barcodes = np.fromiter((v.barcode for v in vertices), np.int64, len(vertices))
+    order = np.argsort(vertex_barcodes, kind="stable")
+    #Missing vertex barcodes are stored as 0, which is never a vertex barcode.
+    start = np.fromiter((p.nvtx_start or 0 for p in arrays.particles), np.int64, n)
+    end = np.fromiter((p.nvtx_end or 0 for p in arrays.particles), np.int64, n)
+    particle_columns = {
+        "momentum": np.stack([arrays.px, arrays.py, arrays.pz, arrays.E], axis=1) if n else np.empty((0, 4)),
+        "pid": arrays.pid,
+        "charge": hepmcio.particle_table().charges(arrays.pid),
+        "barcode": arrays.barcode,
+        "status": arrays.status,
+        "start_vertex": _vertex_indices(start, order, vertex_barcodes),
+        "end_vertex": _vertex_indices(end, order, vertex_barcodes),
+    }
+    vertex_columns = {
+        "position": np.array([v.pos for v in vertices], dtype=np.float64).reshape(len(vertices), 4),
+        "barcode": vertex_barcodes,
+    }
+    bundle_columns = {
+        "type": [selection.TRACK_TYPES.index(b["type"]) for b in bundles],
+        "count": [b["count"] for b in bundles],
+        "momentum": np.array([b["momentum"] for b in bundles], dtype=np.float64).reshape(len(bundles), 4),
+    }
+    header = np.array([(MAGIC, VERSION, no, n, len(vertices), len(bundles))], dtype=HEADER_DTYPE)
+    parts = [header.tobytes()]
+    for values, columns in ((particle_columns, PARTICLE_COLUMNS), (vertex_columns, VERTEX_COLUMNS),
+                            (bundle_columns, BUNDLE_COLUMNS)):
+        parts.extend(np.ascontiguousarray(values[name], dtype=dtype).tobytes() for name, dtype, _ in columns)
+    return b"".join(parts)
+
+
+def decode_event(data):
+    """Unpacks an event encoded by encode_event. The arrays are read-only views over data.
+
+       Arguments:
+       data -- the encoded event.
+
+       Returns:
+       A dict holding the event number "no" and dicts of particle columns "particles", vertex columns
+       "vertices" and bundle columns "bundles", each column a NumPy array with one row per entry.
+    """
+    header = np.frombuffer(data, HEADER_DTYPE, 1)[0]
+    if header["magic"] != MAGIC or header["version"] != VERSION:
+        raise ValueError("Not a version %d encoded event." % VERSION)
+    offset = HEADER_DTYPE.itemsize
+    event = {"no":int(header["no"]), "particles":{}, "vertices":{}, "bundles":{}}
+    for table, count, columns in (("particles", header["nparticles"], PARTICLE_COLUMNS),
+                                  ("vertices", header["nvertices"], VERTEX_COLUMNS),
+                                  ("bundles", header["nbundles"], BUNDLE_COLUMNS)):
+        for name, dtype, width in columns:
+            column = np.frombuffer(data, dtype, count*width, offset)
+            event[table][name] = column.reshape(count, width) if width > 1 else column
+            offset += column.nbytes
+    return event
+
+
+def encode_trajectories(no, points):
+    """Packs the polylines of an event's tracks into the binary payload format.
+
+       Arguments:
+       no -- the number of the event in the file.
+       points -- an (n, k, 3) array of k points along each of n tracks, as returned by trajectory.propagate.
+
+       Returns:
+       The encoded trajectories as bytes.
+    """
+    ntracks, npoints = points.shape[:2]
+    header = np.array([(TRAJECTORY_MAGIC, TRAJECTORY_VERSION, no, ntracks, npoints)], dtype=TRAJECTORY_HEADER_DTYPE)
+    return header.tobytes() + np.ascontiguousarray(points, dtype="<f4").tobytes()
+
+
+def decode_trajectories(data):
+    """Unpacks trajectories encoded by encode_trajectories.
+
+       Arguments:
+       data -- the encoded trajectories.
+
+       Returns:
+       A tuple of the event number and a read-only (n, k, 3) float32 array of the points along each track.
+    """
+    header = np.frombuffer(data, TRAJECTORY_HEADER_DTYPE, 1)[0]
+    if header["magic"] != TRAJECTORY_MAGIC or header["version"] != TRAJECTORY_VERSION:
+        raise ValueError("Not version %d encoded trajectories." % TRAJECTORY_VERSION)
+    ntracks, npoints = int(header["ntracks"]), int(header["npoints"])
+    points = np.frombuffer(data, "<f4", ntracks*npoints*3, TRAJECTORY_HEADER_DTYPE.itemsize)
+    return int(header["no"]), points.reshape(ntracks, npoints, 3)
@@ -0,0 +1,133 @@
+"""Access to the per-file MongoDB collections holding uploaded events. In the default layout each collection
+   holds one event document per event, one document per particle and per vertex, and a single manifest
+   document describing the file, so event navigation can be served from indexed lookups. In the packed layout
+   (see packedstore) each event is instead a single document holding its particles and vertices as packed
+   binary columns. The manifest records which layout a file was stored in and how many events it holds. Each
+   event document carries the event's particle and vertex counts, so the manifest stays small however many
+   events a file holds.
+
+   Classes:
+   ManifestBuilder -- counts the events of a file for its manifest while it is ingested.
+
+   Functions:
+   ensure_indexes -- creates the compound indexes used for event lookups.
+   is_uploaded -- returns whether a file's collection holds any events, without creating it.
+   get_manifest -- returns a file's manifest, building it for collections uploaded without one.
+   find_event -- returns the event document with a given number.
+   find_particles -- returns the particle documents of an event.
+   find_vertices -- returns the vertex documents of an event.
+   """
+
+import pymongo
+
+#Projection used for all reads, as the Mongo object IDs are not needed by the app.
+NO_ID = {"_id": False}
+
+#Storage layouts of a file: one document per event, particle and vertex, or one packed document per event.
+DOCUMENTS = "documents"
+PACKED = "packed"
+LAYOUTS = (DOCUMENTS, PACKED)
+
+#Projection of manifest reads, leaving out the per-event arrays that manifests of older uploads held.
+MANIFEST_FIELDS = {"_id":False, "barcodes":False, "particles":False, "vertices":False}
+
+
+def ensure_indexes(collection):
+    """Creates the compound indexes on (type, no) and (type, event) used to look up events and their
+       particles/vertices. Safe to call on a collection that already has them.
+
+       Arguments:
+       collection -- the MongoDB collection for a file.
+    """
+    collection.create_index([("type", pymongo.ASCENDING), ("no", pymongo.ASCENDING)])
+    collection.create_index([("type", pymongo.ASCENDING), ("event", pymongo.ASCENDING)])
+
+
+class ManifestBuilder(object):
+    """Counts the events of a file for its manifest, recording each event's particle and vertex counts on its
+       event document as "nparticles" and "nvertices".
+
+       Methods:
+       add_documents -- records an event from its documents.
+       document -- returns the manifest document.
+    """
+    def __init__(self, layout=DOCUMENTS):
+        """Constructor.
+
+           Arguments:
+           layout -- the storage layout of the file, DOCUMENTS or PACKED.
+        """
+        self.layout = layout
+        self.events = 0
+
+    def add_documents(self, documents):
+        """Records an event from its documents, as built by hepmcio_json.event_documents, adding its particle
+           and vertex counts to its event document. Must be called before the documents are inserted.
+
+           Arguments:
+           documents -- the event document followed by the event's particle and vertex documents, or the
+           single document of an event in the packed layout, which already holds its counts.
+        """
+        event = documents[0]
+        self.events += 1
+        if event.get("layout") == PACKED:
+            return
+        nvertices = sum(1 for d in documents if d["type"] == "vertex")
+        event["nparticles"] = len(documents) - 1 - nvertices
+        event["nvertices"] = nvertices
+
+    def document(self):
+        """Returns the manifest document.
+        """
+        return {"type":"manifest", "layout":self.layout, "events":self.events}
+
+
+def is_uploaded(collection):
+    """Returns whether a file's collection holds any events. Only reads, so looking up a file that was never
+       uploaded does not create its collection, which would then block its upload.
+    """
+    return collection.find_one({"type":"event"}, {"_id":True}) is not None
+
+
+def get_manifest(collection):
+    """Returns the manifest document of a file. For collections uploaded before manifests were written, the
+       manifest and indexes are built from the stored documents and saved on first access. Manifests without
+       a layout are of files in the DOCUMENTS layout. The per-event arrays held by the manifests of older
+       uploads are left out.
+
+       Arguments:
+       collection -- the MongoDB collection for a file.
+
+       Returns:
+       The manifest document, or None if the collection holds no events.
+    """
+    manifest = collection.find_one({"type":"manifest"}, MANIFEST_FIELDS)
+    if manifest is not None:
+        return manifest
+    #Nothing is written unless the file was really uploaded.
+    if not is_uploaded(collection):
+        return None
+    ensure_indexes(collection)
+    manifest = {"layout":DOCUMENTS, "events":collection.count_documents({"type":"event"})}
+    #Concurrent first reads may both build the manifest, but only the first one is stored.
+    collection.update_one({"type":"manifest"}, {"$setOnInsert":manifest}, upsert=True)
+    return collection.find_one({"type":"manifest"}, MANIFEST_FIELDS)
+
+
+def find_event(collection, no):
+    """Returns the event document with the given number in the file, or None if there is none. In the packed
+       layout this is the whole event, see packedstore.
+    """
+    return collection.find_one({"type":"event", "no":no}, NO_ID)
+
+
+def find_particles(collection, barcode):
+    """Returns a cursor over the particle documents of the event with the given barcode.
+    """
+    return collection.find({"type":"particle", "event":barcode}, NO_ID)
+
+
+def find_vertices(collection, barcode):
+    """Returns a cursor over the vertex documents of the event with the given barcode.
+    """
+    return collection.find({"type":"vertex", "event":barcode}, NO_ID)
@@ -0,0 +1,384 @@
+"""Builds the Visualiser's view of an event straight from the stored documents. The event graph is rebuilt
+   once from the Mongo documents, the interesting particles are selected on it, and the payload is made of
+   the original documents of the chosen particles, so nothing is serialized until the response itself.
+   Events stored in the packed layout are read in one document and used as columnar views (see packedstore).
+   Files that were never uploaded can also be viewed straight from disk, using their byte-offset event index
+   to read only the requested event.
+
+   Functions:
+   load_event -- fetches an event's documents and rebuilds its graph.
+   select_particles -- selects the interesting particles of an event and their ancestors.
+   soft_bundles -- summarises the soft particles left out by a track budget.
+   view_vertices -- returns the vertices sent along with the chosen particles of an event.
+   event_view -- builds the payload sent to the Visualiser for an event.
+   event_file_path -- returns the path of a HepMC file on disk that can be viewed without uploading it.
+   file_event_count -- returns the number of events in a HepMC file on disk.
+   file_event_view -- builds the payload for an event read straight from a HepMC file on disk.
+   encode_view -- encodes a payload as compact UTF-8 JSON.
+   encoded_event_view -- returns the payload for an event, encoded as JSON or in the binary format.
+   encoded_file_event_view -- as encoded_event_view, for an event read from a HepMC file on disk.
+   view_key -- returns the cache key for an event's payload.
+   cached_event_view -- returns the encoded payload for an event, from a PayloadCache when possible.
+   cached_file_event_view -- as cached_event_view, for an event read from a HepMC file on disk.
+   encoded_trajectories -- returns the tracks of an event's interesting particles in the binary format.
+   encoded_file_trajectories -- as encoded_trajectories, for an event read from a HepMC file on disk.
+   trajectory_key -- returns the cache key for an event's trajectories.
+   cached_trajectories -- returns the encoded trajectories for an event, from a PayloadCache when possible.
+   cached_file_trajectories -- as cached_trajectories, for an event read from a HepMC file on disk.
+   """
+
+import gzip
+import json
+import os
+from app import eventstore, eventbinary, hepmcio, hepmcio_json, packedstore, selection, timing, trajectory
+
+
+def load_event(collection, no):
+    """Fetches an event's documents and rebuilds its graph from them.
+
+       Arguments:
+       collection -- the MongoDB collection for a file.
+       no -- the number of the event in the file.
+
+       Returns:
+       A tuple of the hepmcio Event, a dict of particle documents by barcode and a list of vertex documents,
+       or None if there is no such event. Events in the packed layout have no particle or vertex documents,
+       so come back as a read-only ColumnarEvent with None in their place.
+    """
+    with timing.stage("mongo") as stage:
+        event = eventstore.find_event(collection, no)
+        if event is None:
+            return None
+        if packedstore.is_packed(event):
+            particles = vertices = None
+            stage.count(documents=1)
+        else:
+            particles = {p["barcode"]:p for p in eventstore.find_particles(collection, event["barcode"])}
+            vertices = list(eventstore.find_vertices(collection, event["barcode"]))
+            stage.count(documents=1 + len(particles) + len(vertices))
+    if particles is None:
+        return packedstore.event_from_document(collection, event), None, None
+    evt = hepmcio_json.event_from_documents(event, particles.values(), vertices)
+    return evt, particles, vertices
+
+
+def select_particles(evt, cut=selection.DEFAULT_CUT, arrays=None):
+    """Selects the interesting particles of an event and their ancestors. The cut is evaluated on the whole
+       event at once, then the ancestors of the passing particles are found in a single walk of the event graph.
+       With a selection.Budget the ancestors of the kept particles are always included, on top of the budget.
+
+       Arguments:
+       evt -- the hepmcio event.
+       cut -- the selection.Cut picking interesting particles; by default non-final-state particles above
+       selection.PT_CUTOFF.
+       arrays -- the event's selection.EventArrays, if already built.
+
+       Returns:
+       A list of particles, each appearing once.
+    """
+    with timing.stage("select") as stage:
+        passing = selection.select(evt, cut, arrays)
+        stage.count(particles=len(passing))
+    return evt.ancestors(passing, inclusive=True)
+
+
+def soft_bundles(evt, cut=selection.DEFAULT_CUT, arrays=None):
+    """Summarises the soft particles of an event, those passing a selection.Budget's base cut but left out by
+       the budget, in one bundle per track type (see selection.bundles). Only a Budget asking for bundles has
+       any.
+
+       Arguments:
+       evt -- the hepmcio event.
+       cut -- the selection.Cut picking interesting particles.
+       arrays -- the event's selection.EventArrays, if already built.
+
+       Returns:
+       A list of bundles, empty unless the cut asks for them.
+    """
+    if not getattr(cut, "bundle", False):
+        return []
+    arrays = arrays if arrays is not None else selection.EventArrays(evt)
+    return selection.bundles(arrays, cut.soft(arrays))
+
+
+def view_vertices(evt, particles, cut=selection.DEFAULT_CUT):
+    """Returns the vertices sent along with the chosen particles of an event: all the event's vertices or,
+       under a selection.Budget, only the production and decay vertices of the chosen particles, so that the
+       payload stays bounded however large the event.
+
+       Arguments:
+       evt -- the hepmcio event.
+       particles -- the chosen particles, as returned by select_particles.
+       cut -- the selection.Cut they were chosen by.
+
+       Returns:
+       A list of vertices, in the order of evt.vertices.
+    """
+    if not isinstance(cut, selection.Budget):
+        return list(evt.vertices.values())
+    barcodes = {p.nvtx_start for p in particles} | {p.nvtx_end for p in particles}
+    return [v for bc, v in evt.vertices.items() if bc in barcodes]
+
+
+def event_view(collection, no, cut=selection.DEFAULT_CUT):
+    """Builds the payload sent to the Visualiser for an event.
+
+       Arguments:
+       collection -- the MongoDB collection for a file.
+       no -- the number of the event in the file.
+       cut -- the selection.Cut picking interesting particles.
+
+       Returns:
+       A dict with the event number, the documents of the interesting particles, the documents of the event's
+       vertices (see view_vertices) and the bundles of soft particles (see soft_bundles), or None if there is no
+       such event.
+    """
+    loaded = load_event(collection, no)
+    if loaded is None:
+        return None
+    evt, particles, vertices = loaded
+    if particles is None:
+        return _document_view(no, evt, cut)
+    arrays = selection.EventArrays(evt)
+    chosen = select_particles(evt, cut, arrays)
+    if isinstance(cut, selection.Budget):
+        barcodes = {v.barcode for v in view_vertices(evt, chosen, cut)}
+        vertices = [v for v in vertices if v["barcode"] in barcodes]
+    return {"no":no, "particles":[particles[p.barcode] for p in chosen], "vertices":vertices,
+            "bundles":soft_bundles(evt, cut, arrays)}
+
+
+def event_file_path(directory, filename):
+    """Returns the path of the HepMC file for filename in directory, or None if there is no such file.
+
+       Arguments:
+       directory -- the directory holding HepMC files.
+       filename -- the name of the file without its .hepmc extension, already sanitised.
+    """
+    path = os.path.join(directory, filename + ".hepmc")
+    return path if os.path.isfile(path) else None
+
+
+def file_event_count(path):
+    """Returns the number of events in a HepMC file on disk, from its event index.
+    """
+    return len(hepmcio.load_event_index(path))
+
+
+def file_event_view(path, no, cut=selection.DEFAULT_CUT):
+    """Builds the payload for an event read straight from a HepMC file on disk. Only the requested event is
+       parsed, using the file's event index.
+
+       Arguments:
+       path -- path of the HepMC file.
+       no -- the number of the event in the file.
+       cut -- the selection.Cut picking interesting particles.
+
+       Returns:
+       A dict in the same form as event_view returns, or None if there is no such event.
+    """
+    evt = _read_file_event(path, no)
+    return _document_view(no, evt, cut) if evt is not None else None
+
+
+def _document_view(no, evt, cut):
+    "Build the payload for an event without stored documents, making documents for the chosen particles only"
+    arrays = selection.EventArrays(evt)
+    chosen = select_particles(evt, cut, arrays)
+    return {"no":no, "particles":[hepmcio_json.particle_document(p) for p in chosen],
+            "vertices":[hepmcio_json.vertex_document(v) for v in view_vertices(evt, chosen, cut)],
+            "bundles":soft_bundles(evt, cut, arrays)}
+
+
+def _read_file_event(path, no):
+    "Read one event from a HepMC file on disk through its event index, or None if there is no such event"
+    with open(path) as f:
+        return hepmcio.HepMCReader(f, index=hepmcio.load_event_index(path)).read_event(no)
+
+
+def encode_view(view):
+    """Encodes a payload built by event_view as compact UTF-8 JSON.
+    """
+    with timing.stage("encode") as stage:
+        body = json.dumps(view, separators=(",", ":")).encode("utf-8")
+        stage.count(bytes=len(body))
+    return body
+
+
+def _encode_binary(no, evt, cut):
+    "Encode an event's interesting particles, its vertices and any bundles in the gzip-compressed binary format"
+    arrays = selection.EventArrays(evt)
+    chosen = select_particles(evt, cut, arrays)
+    bundles = soft_bundles(evt, cut, arrays)
+    with timing.stage("encode") as stage:
+        data = eventbinary.encode_event(no, evt, chosen, bundles, view_vertices(evt, chosen, cut))
+        body = gzip.compress(data, compresslevel=6, mtime=0)
+        stage.count(bytes=len(body))
+    return body
+
+
+def encoded_event_view(collection, no, cut=selection.DEFAULT_CUT, binary=False):
+    """Returns the payload for an event, encoded as JSON by encode_view or, if binary is set, in the
+       eventbinary format compressed with gzip, ready to be sent with a gzip content encoding.
+
+       Arguments:
+       collection -- the MongoDB collection for a file.
+       no -- the number of the event in the file.
+       cut -- the selection.Cut picking interesting particles.
+       binary -- whether to use the binary format.
+
+       Returns:
+       The encoded payload, or None if there is no such event.
+    """
+    if not binary:
+        view = event_view(collection, no, cut)
+        return encode_view(view) if view is not None else None
+    loaded = load_event(collection, no)
+    return _encode_binary(no, loaded[0], cut) if loaded is not None else None
+
+
+def encoded_file_event_view(path, no, cut=selection.DEFAULT_CUT, binary=False):
+    """As encoded_event_view, for an event read straight from a HepMC file on disk.
+    """
+    if not binary:
+        view = file_event_view(path, no, cut)
+        return encode_view(view) if view is not None else None
+    evt = _read_file_event(path, no)
+    return _encode_binary(no, evt, cut) if evt is not None else None
+
+
+def view_key(collection, no, cut=selection.DEFAULT_CUT, binary=False):
+    """Returns the cache key for the payload of an event: the filename, the event number and the view parameters.
+    """
+    return _view_key(collection.name, no, cut, binary)
+
+
+def _view_key(filename, no, cut, binary):
+    return (filename, no, cut.key, "binary") if binary else (filename, no, cut.key)
+
+
+def cached_event_view(collection, no, cache, cut=selection.DEFAULT_CUT, binary=False):
+    """Returns the encoded payload for an event. Payloads are cached by filename, event number and view
+       parameters, which is safe as uploaded files are never modified in place.
+
+       Arguments:
+       collection -- the MongoDB collection for a file.
+       no -- the number of the event in the file.
+       cache -- the PayloadCache to use.
+       cut -- the selection.Cut picking interesting particles.
+       binary -- whether to use the gzip-compressed binary format rather than JSON.
+
+       Returns:
+       The payload as encoded by encoded_event_view, or None if there is no such event.
+    """
+    key = view_key(collection, no, cut, binary)
+    body = cache.get(key)
+    if body is None:
+        body = encoded_event_view(collection, no, cut, binary)
+        if body is None:
+            return None
+        cache.put(key, body)
+    return body
+
+
+def cached_file_event_view(path, no, cache, cut=selection.DEFAULT_CUT, binary=False):
+    """Returns the encoded payload for an event read straight from a HepMC file on disk, cached under the
+       same key as the file's database collection would be.
+
+       Arguments:
+       path -- path of the HepMC file.
+       no -- the number of the event in the file.
+       cache -- the PayloadCache to use.
+       cut -- the selection.Cut picking interesting particles.
+       binary -- whether to use the gzip-compressed binary format rather than JSON.
+
+       Returns:
+       The payload as encoded by encoded_event_view, or None if there is no such event.
+    """
+    key = _view_key(os.path.splitext(os.path.basename(path))[0], no, cut, binary)
+    body = cache.get(key)
+    if body is None:
+        body = encoded_file_event_view(path, no, cut, binary)
+        if body is None:
+            return None
+        cache.put(key, body)
+    return body
+
+
+def _encode_trajectories(no, evt, cut, field, steps, length):
+    "Propagate an event's interesting particles and encode their tracks, compressed with gzip"
+    particles = select_particles(evt, cut)
+    with timing.stage("propagate", tracks=len(particles)):
+        points = trajectory.event_trajectories(evt, particles, field, steps, length)
+    with timing.stage("encode") as stage:
+        body = gzip.compress(eventbinary.encode_trajectories(no, points), compresslevel=6, mtime=0)
+        stage.count(bytes=len(body))
+    return body
+
+
+def encoded_trajectories(collection, no, cut=selection.DEFAULT_CUT, field=4.0, steps=32, length=1000.0):
+    """Returns the tracks of an event's interesting particles, propagated by trajectory.event_trajectories and
+       encoded by eventbinary.encode_trajectories, compressed with gzip. The tracks are in the same order as
+       the particles of the event's payload.
+
+       Arguments:
+       collection -- the MongoDB collection for a file.
+       no -- the number of the event in the file.
+       cut -- the selection.Cut picking interesting particles.
+       field, steps, length -- the field in tesla, the number of segments per track and the path length of
+       each track in mm.
+
+       Returns:
+       The encoded trajectories, or None if there is no such event.
+    """
+    loaded = load_event(collection, no)
+    return _encode_trajectories(no, loaded[0], cut, field, steps, length) if loaded is not None else None
+
+
+def encoded_file_trajectories(path, no, cut=selection.DEFAULT_CUT, field=4.0, steps=32, length=1000.0):
+    """As encoded_trajectories, for an event read straight from a HepMC file on disk.
+    """
+    evt = _read_file_event(path, no)
+    return _encode_trajectories(no, evt, cut, field, steps, length) if evt is not None else None
+
+
+def trajectory_key(filename, no, cut=selection.DEFAULT_CUT, field=4.0, steps=32, length=1000.0):
+    """Returns the cache key for the trajectories of an event: the filename, the event number, the cut and
+       the propagation parameters.
+    """
+    return (filename, no, cut.key, "trajectories", field, steps, length)
+
+
+def cached_trajectories(collection, no, cache, cut=selection.DEFAULT_CUT, field=4.0, steps=32, length=1000.0):
+    """Returns the encoded trajectories for an event, cached like cached_event_view.
+
+       Arguments:
+       collection -- the MongoDB collection for a file.
+       no -- the number of the event in the file.
+       cache -- the PayloadCache to use.
+       cut, field, steps, length -- as for encoded_trajectories.
+
+       Returns:
+       The trajectories as encoded by encoded_trajectories, or None if there is no such event.
+    """
+    key = trajectory_key(collection.name, no, cut, field, steps, length)
+    body = cache.get(key)
+    if body is None:
+        body = encoded_trajectories(collection, no, cut, field, steps, length)
+        if body is None:
+            return None
+        cache.put(key, body)
+    return body
+
+
+def cached_file_trajectories(path, no, cache, cut=selection.DEFAULT_CUT, field=4.0, steps=32, length=1000.0):
+    """As cached_trajectories, for an event read straight from a HepMC file on disk.
+    """
+    key = trajectory_key(os.path.splitext(os.path.basename(path))[0], no, cut, field, steps, length)
+    body = cache.get(key)
+    if body is None:
+        body = encoded_file_trajectories(path, no, cut, field, steps, length)
+        if body is None:
+            return None
+        cache.put(key, body)
+    return body
@@ -1,4 +1,14 @@
+import os
+import io
+import gc
+import gzip
+import bz2
+import lzma
+import tempfile
 import pypdt
+import numpy as np
+from collections import deque
+from app import timing
 
 """\
 A simple pure-Python parser for HepMC IO_GenEvent ASCII event files, which may
@@ -12,11 +22,18 @@ Vertex -- vertex in an event file; represents a vertex in the event graph.
 Event -- event in an event file; represents an event graph. Contains hashmaps of all particles and vertices associated
 with the graph.
 HepMCReader -- the reader class for parsing HepMC files. Can read files using either filename or a file object.
-HepMCWriter -- the writer class for creating HepMC files. Currently unfinished.
+HepMCWriter -- the writer class for creating HepMC files, optionally gzip-compressed.
+ParticleTable -- compact PID lookup of charge, mass and name built once from the PyPDT particle data table.
 
 Functions:
+particle_table -- returns the shared ParticleTable, loading it on first use.
+index_events -- records the byte offset and length of every event in a file in one pass.
+load_event_index -- returns the event index of a file, from its sidecar file when it is up to date.
+compression -- returns the compression format of a file, detected from its leading bytes.
+open_binary -- opens a HepMC file for reading as bytes, decompressing it on the fly if needed.
+open_text -- opens a HepMC file for reading as text, decompressing it on the fly if needed.
 
-get_ancestors -- gets all the ancestors of a particle above some energy threshold.
+get_ancestors -- gets all the ancestors of a particle with displaced production vertices.
 mk_nx_graph -- creates a NetworkX graph from event data.
 """
 
@@ -24,26 +41,127 @@ __version__ = "1.1.1"
 __author__ = "Andy Buckley, Darius Darulis"
 __email__ = "andy@insectnation.org, darius.dragas@gmail.com"
 
+class ParticleTable(object):
+    """
+    A compact lookup of particle charge, mass and name keyed by PDG ID, built once from the PyPDT particle
+    data table. PIDs with |pid| below DENSE_MAX are held in dense NumPy arrays indexed by pid + DENSE_MAX
+    so whole arrays of PIDs can be looked up at once; larger PIDs (SUSY, excited states etc.) fall back to a
+    dict. Antiparticles missing from the table take the negated charge of their particle.
+
+    Methods:
+    charge -- returns the charge for a PID, 0.0 if unknown.
+    mass -- returns the mass for a PID, None if unknown.
+    name -- returns the name for a PID, None if unknown.
+    charges -- returns the charges for an array of PIDs.
+    masses -- returns the masses for an array of PIDs, NaN where unknown.
+    """
+    DENSE_MAX = 10000
+
+    def __init__(self, pdt=None):
+        """
+        Constructor.
+
+        Arguments:
+        pdt -- a pypdt.PDT instance to build the table from. Loads the default PyPDT table if not given.
+        """
+        if pdt is None:
+            pdt = pypdt.PDT()
+        size = 2*self.DENSE_MAX + 1
+        self._charges = np.zeros(size)
+        self._masses = np.full(size, np.nan)
+        self._names = {}
+        #PID -> (charge, mass) for PIDs outside the dense range.
+        self._sparse = {}
+        entries = {pd.id: pd for pd in pdt}
+        for pid, pd in list(entries.items()):
+            entries.setdefault(-pid, None)
+        for pid, pd in entries.items():
+            if pd is not None:
+                charge, mass, name = pd.charge, pd.mass, pd.name
+            else:
+                anti = entries[-pid]
+                charge, mass, name = -anti.charge, anti.mass, anti.name
+            self._names[pid] = name
+            if abs(pid) < self.DENSE_MAX:
+                self._charges[pid + self.DENSE_MAX] = charge
+                self._masses[pid + self.DENSE_MAX] = mass if mass is not None else np.nan
+            else:
+                self._sparse[pid] = (charge, mass)
+
+    def charge(self, pid):
+        """
+        Returns the charge of the particle with the given PID, or 0.0 if it is not in the table.
+        """
+        if abs(pid) < self.DENSE_MAX:
+            return float(self._charges[pid + self.DENSE_MAX])
+        return float(self._sparse.get(pid, (0.0, None))[0])
+
+    def mass(self, pid):
+        """
+        Returns the mass of the particle with the given PID, or None if it is not in the table.
+        """
+        if abs(pid) < self.DENSE_MAX:
+            mass = self._masses[pid + self.DENSE_MAX]
+            return None if np.isnan(mass) else float(mass)
+        return self._sparse.get(pid, (0.0, None))[1]
+
+    def name(self, pid):
+        """
+        Returns the name of the particle with the given PID, or None if it is not in the table.
+        """
+        return self._names.get(pid)
+
+    def charges(self, pids):
+        """
+        Returns the charges of an array of PIDs as a float array, 0.0 where unknown.
+        """
+        return self._lookup(pids, self._charges, 0)
+
+    def masses(self, pids):
+        """
+        Returns the masses of an array of PIDs as a float array, NaN where unknown.
+        """
+        return self._lookup(pids, self._masses, 1)
+
+    def _lookup(self, pids, dense, col):
+        "Vectorized lookup in a dense column with a per-element fallback for large PIDs"
+        pids = np.asarray(pids, dtype=np.int64)
+        inrange = np.abs(pids) < self.DENSE_MAX
+        rtn = np.take(dense, np.where(inrange, pids + self.DENSE_MAX, self.DENSE_MAX))
+        if not inrange.all():
+            default = 0.0 if col == 0 else np.nan
+            for i in np.flatnonzero(~inrange):
+                value = self._sparse.get(int(pids.flat[i]), (0.0, None))[col]
+                rtn.flat[i] = default if value is None else value
+        return rtn
+
+
+_particle_table = None
+
+def particle_table():
+    """
+    Returns the ParticleTable shared by the reader, the JSON encoders and the routes, building it from the
+    PyPDT data the first time it is needed.
+    """
+    global _particle_table
+    if _particle_table is None:
+        _particle_table = ParticleTable()
+    return _particle_table
+
+
 def get_ancestors(p, dmin=1e-5):
     """
-    Gets all ancestors of a particle above some energy threshold by traversing vertices.
+    Gets all ancestors of a particle whose production vertices are displaced from the origin by more than
+    some distance.
 
     Arguments:
     p -- particle whose ancestors to get.
-    dmin -- energy cut-off for being considered "interesting".
+    dmin -- displacement cut-off for being considered "interesting".
 
     Returns:
-    rtn -- a list of lists containing interesting ancestor particles.
+    rtn -- a list of the interesting ancestor particles, each appearing once, followed by p itself.
     """
-    rtn = []
-    v = p.vtx_start()
-    if v:
-        d2 = v.pos[0]**2 + v.pos[1]**2 + v.pos[2]**2
-        if d2 > dmin**2:
-            for pp in p.parents():
-                # if pp.status != 2:
-                #     continue
-                rtn += get_ancestors(pp)
+    rtn = p.evt.ancestors([p], dmin) if p.evt else []
     rtn.append(p)
     return rtn
 
@@ -95,13 +213,15 @@ class Particle(object):
         """
         Returns parent particles of the particle.
         """
-        return self.vtx_start().parents() if self.vtx_start() else None
+        v = self.vtx_start()
+        return v.parents() if v else None
 
     def children(self):
         """
         Returns the children particles for the particle.
         """
-        return self.vtx_end().children() if self.vtx_end() else None
+        v = self.vtx_end()
+        return v.children() if v else None
 
     
     
@@ -138,15 +258,15 @@ class Vertex(object):
 
     def parents(self):
         """
-        Returns particles coming into the vertex by comparing barcodes.
+        Returns particles coming into the vertex, looked up in the event's adjacency index.
         """
-        return [p for p in self.evt.particles.values() if p.nvtx_end == self.barcode]
+        return self.evt.particles_in(self.barcode)
 
     def children(self):
         """
-        Returns particles coming out of the vertex by comparing barcodes.
+        Returns particles coming out of the vertex, looked up in the event's adjacency index.
         """
-        return [p for p in self.evt.particles.values() if p.nvtx_start == self.barcode]
+        return self.evt.particles_out(self.barcode)
 
     def __eq__(self, other):
         if isinstance(other, self.__class__):
@@ -161,6 +281,26 @@ class Vertex(object):
 class Event(object):
     """
     An event represnting a HepMC graph.
+
+    Besides the particle and vertex hashmaps, the event keeps an adjacency index mapping each vertex
+    barcode to its incoming and outgoing particles, so graph navigation costs O(degree) rather than a
+    scan over every particle. Particles should be added with add_particle to keep the index current;
+    assigning a whole new particles hashmap rebuilds it.
+
+    Events read by a lazy HepMCReader hold only their header and the raw text of their particle and vertex
+    lines; the lines are parsed the first time the particles or vertices are used, and unload releases them
+    again.
+
+    Methods:
+    load -- parses the particles and vertices of a lazily read event.
+    unload -- releases the parsed particles and vertices of a lazily read event.
+    add_particle -- adds a particle to the event and indexes it by its vertices.
+    add_particles -- adds a sequence of particles to the event.
+    add_vertex -- adds a vertex to the event.
+    particles_in -- returns the particles coming into a vertex.
+    particles_out -- returns the particles coming out of a vertex.
+    ancestors -- returns the ancestors of a set of particles, each once.
+    descendants -- returns the descendants of a set of particles, each once.
     """
     def __init__(self):
         """
@@ -177,8 +317,230 @@ class Event(object):
         self.weights = None
         self.units = [None, None]
         self.xsec = [None, None]
-        self.particles = {}
-        self.vertices = {}
+        self._particles = {}
+        #Vertex barcode -> particles ending/starting at that vertex.
+        self._particles_in = {}
+        self._particles_out = {}
+        #Cache of ancestor/descendant walks, cleared whenever the graph changes.
+        self._traversals = {}
+        self._vertices = {}
+
+    #Particle and vertex lines of a lazily read event, the vertex barcode in force before them, and whether
+    #they have been parsed. Set by HepMCReader in lazy mode; other events are always loaded.
+    _body = None
+    _body_vtx = None
+    _loaded = True
+    #Whether the body is being parsed, so that the graph methods used while adding its objects do not parse it again.
+    _loading = False
+
+    def load(self):
+        """
+        Parses the particles and vertices of a lazily read event, unless they are already parsed. They are also
+        parsed on first use, so calling this is only needed to control when the work is done. If the body cannot
+        be parsed, the error is raised and the event is left unloaded, with no particles or vertices.
+        """
+        if self._loaded or self._loading:
+            return
+        self._loading = True
+        try:
+            _parse_body(self, self._body, self._body_vtx, particle_table())
+        except Exception:
+            self._clear()
+            raise
+        finally:
+            self._loading = False
+        self._loaded = True
+
+    def _clear(self):
+        "Drop the particles and vertices of the event"
+        self._particles = {}
+        self._particles_in = {}
+        self._particles_out = {}
+        self._traversals = {}
+        self._vertices = {}
+
+    def unload(self):
+        """
+        Releases the particles and vertices of a lazily read event, which are parsed again from the event's
+        text if they are used later. Particles and vertices still referenced elsewhere are detached from the
+        event's graph. Raises ValueError for events that were not read lazily, as they could not be restored.
+        """
+        if self._body is None:
+            raise ValueError("Only lazily read events can be unloaded.")
+        self._loaded = False
+        self._clear()
+
+    @property
+    def particles(self):
+        if not self._loaded:
+            self.load()
+        return self._particles
+
+    @particles.setter
+    def particles(self, particles):
+        self.load()
+        self._particles = {}
+        self._particles_in = {}
+        self._particles_out = {}
+        self._traversals = {}
+        for p in particles.values():
+            self.add_particle(p)
+
+    @property
+    def vertices(self):
+        if not self._loaded:
+            self.load()
+        return self._vertices
+
+    @vertices.setter
+    def vertices(self, vertices):
+        self.load()
+        self._vertices = vertices
+
+    def add_particle(self, p):
+        """
+        Adds a particle to the event and records it in the adjacency index. The particle's vertex
+        barcodes must be set before it is added.
+
+        Arguments:
+        p -- the particle to be added.
+        """
+        self.load()
+        old = self._particles.get(p.barcode)
+        if old is not None:
+            self._unindex(old)
+        p.evt = self
+        self._traversals = {}
+        self._particles[p.barcode] = p
+        if p.nvtx_end is not None:
+            self._particles_in.setdefault(p.nvtx_end, []).append(p)
+        if p.nvtx_start is not None:
+            self._particles_out.setdefault(p.nvtx_start, []).append(p)
+
+    def add_particles(self, particles):
+        """
+        Adds a sequence of particles to the event, as add_particle does for each in turn.
+
+        Arguments:
+        particles -- the particles to be added.
+        """
+        self.load()
+        if self._particles:
+            for p in particles:
+                self.add_particle(p)
+            return
+        self._traversals = {}
+        for p in particles:
+            p.evt = self
+        self._particles = dict((p.barcode, p) for p in particles)
+        if len(self._particles) < len(particles):
+            #Repeated barcodes: index one at a time so that later particles replace earlier ones.
+            self._particles = {}
+            for p in particles:
+                self.add_particle(p)
+            return
+        for p in particles:
+            if p.nvtx_end is not None:
+                self._particles_in.setdefault(p.nvtx_end, []).append(p)
+            if p.nvtx_start is not None:
+                self._particles_out.setdefault(p.nvtx_start, []).append(p)
+
+    def _unindex(self, p):
+        "Remove a particle from the adjacency index"
+        for index, bc in ((self._particles_in, p.nvtx_end), (self._particles_out, p.nvtx_start)):
+            if bc in index:
+                index[bc] = [q for q in index[bc] if q is not p]
+
+    def add_vertex(self, v):
+        """
+        Adds a vertex to the event.
+
+        Arguments:
+        v -- the vertex to be added.
+        """
+        self.load()
+        v.evt = self
+        self._traversals = {}
+        self._vertices[v.barcode] = v
+
+    def particles_in(self, barcode):
+        """
+        Returns the particles coming into the vertex with the given barcode.
+        """
+        self.load()
+        return list(self._particles_in.get(barcode, ()))
+
+    def particles_out(self, barcode):
+        """
+        Returns the particles coming out of the vertex with the given barcode.
+        """
+        self.load()
+        return list(self._particles_out.get(barcode, ()))
+
+    @timing.timed("ancestors")
+    def ancestors(self, particles, dmin=1e-5, inclusive=False):
+        """
+        Gets the ancestors of a set of particles in a single iterative walk up the event graph. A particle's
+        parents are only followed if its production vertex is displaced from the origin by more than dmin.
+        Results are cached on the event until the graph is modified.
+
+        Arguments:
+        particles -- the particles whose ancestors to get.
+        dmin -- displacement cut-off for following a particle's parents.
+        inclusive -- whether to include the given particles at the front of the result. Otherwise the given
+        particles are left out entirely, even if one is an ancestor of another.
+
+        Returns:
+        rtn -- a list of particles, each appearing once, in breadth-first order.
+        """
+        return self._traverse(particles, dmin, inclusive, "nvtx_start", self._particles_in)
+
+    def descendants(self, particles, dmin=1e-5, inclusive=False):
+        """
+        Gets the descendants of a set of particles in a single iterative walk down the event graph. A particle's
+        children are only followed if its decay vertex is displaced from the origin by more than dmin.
+        Results are cached on the event until the graph is modified.
+
+        Arguments:
+        particles -- the particles whose descendants to get.
+        dmin -- displacement cut-off for following a particle's children.
+        inclusive -- whether to include the given particles at the front of the result.
+
+        Returns:
+        rtn -- a list of particles, each appearing once, in breadth-first order.
+        """
+        return self._traverse(particles, dmin, inclusive, "nvtx_end", self._particles_out)
+
+    def _traverse(self, particles, dmin, inclusive, vtx_attr, index):
+        "Breadth-first walk across vertices, sharing one visited set between all the starting particles"
+        self.load()
+        seeds = list(dict.fromkeys(p.barcode for p in particles))
+        missing = [bc for bc in seeds if bc not in self._particles]
+        if missing:
+            raise ValueError("particles %s are not in this event" % missing)
+        key = (vtx_attr, tuple(seeds), dmin, inclusive)
+        if key in self._traversals:
+            ## Reinsert so that the dict's order runs from least to most recently used
+            rtn = self._traversals[key] = self._traversals.pop(key)
+            return list(rtn)
+        visited = set(seeds)
+        rtn = [self._particles[bc] for bc in seeds] if inclusive else []
+        queue = deque(self._particles[bc] for bc in seeds)
+        dmin2 = dmin**2
+        while queue:
+            p = queue.popleft()
+            v = self.vertices.get(getattr(p, vtx_attr))
+            if v is None or v.pos[0]**2 + v.pos[1]**2 + v.pos[2]**2 <= dmin2:
+                continue
+            for q in index.get(v.barcode, ()):
+                if q.barcode not in visited:
+                    visited.add(q.barcode)
+                    rtn.append(q)
+                    queue.append(q)
+        self._traversals[key] = rtn
+        if len(self._traversals) > TRAVERSAL_CACHE_SIZE:
+            del self._traversals[next(iter(self._traversals))]
+        return list(rtn)
     
     def __eq__(self, other):
         if isinstance(other, self.__class__):
@@ -191,30 +553,265 @@ class Event(object):
                 self.xsec[0], self.xsec[1], self.no)
 
 
+def index_events(file):
+    """
+    Records where each event starts and how long it is, in one pass over a file opened in binary mode, or over
+    an in-memory text stream.
+
+    Arguments:
+    file -- a binary file object, or an io.StringIO, positioned at the start of a HepMC file.
+
+    Returns:
+    index -- an (N, 2) int64 array holding the offset and length of each event's lines, in file order. Offsets
+    are in bytes, or in characters for an io.StringIO, which seeks by character.
+    """
+    if isinstance(file, io.TextIOBase):
+        eventMarker, endMarker = "E ", "HepMC::IO_GenEvent-END_EVENT_LISTING"
+    else:
+        eventMarker, endMarker = b"E ", b"HepMC::IO_GenEvent-END_EVENT_LISTING"
+    offsets = []
+    pos = 0
+    end = None
+    for line in file:
+        if line.startswith(eventMarker):
+            offsets.append(pos)
+        elif line.startswith(endMarker):
+            end = pos
+            break
+        pos += len(line)
+    if end is None:
+        end = pos
+    index = np.empty((len(offsets), 2), dtype=np.int64)
+    index[:, 0] = offsets
+    index[:, 1] = np.diff(offsets + [end])
+    return index
+
+
+def load_event_index(filename):
+    """
+    Returns the event index of a file. The index is kept in a sidecar file next to it (filename + ".idx.npy"),
+    which is rebuilt whenever it is older than the file or cannot be read. The sidecar is written to a temporary
+    file and renamed into place, so concurrent readers never see it half written. If it cannot be written the
+    index is only returned. The offsets of a compressed file are into its uncompressed contents.
+
+    Arguments:
+    filename -- path of the HepMC file.
+
+    Returns:
+    index -- the array returned by index_events.
+    """
+    sidecar = filename + ".idx.npy"
+    if os.path.exists(sidecar) and os.path.getmtime(sidecar) >= os.path.getmtime(filename):
+        try:
+            index = np.load(sidecar)
+            if index.ndim == 2 and index.shape[1] == 2:
+                return index
+        except (OSError, ValueError, EOFError):
+            pass
+    with open_binary(filename) as f:
+        index = index_events(f)
+    try:
+        fd, path = tempfile.mkstemp(suffix=".npy", dir=os.path.dirname(os.path.abspath(sidecar)))
+    except OSError:
+        return index
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.save(f, index)
+        os.replace(path, sidecar)
+    except OSError:
+        os.remove(path)
+    return index
+
+
+#Format version written in the header of HepMC files by HepMCWriter.
+HEPMC_VERSION = "2.06.09"
+
+#Number of ancestor and descendant walks each event keeps, dropping the least recently used beyond it.
+TRAVERSAL_CACHE_SIZE = 64
+
+#Leading bytes of the supported compression formats.
+COMPRESSION_MAGIC = ((b"\x1f\x8b", "gzip"), (b"BZh", "bz2"), (b"\xfd7zXZ\x00", "xz"), (b"\x28\xb5\x2f\xfd", "zstd"))
+
+#File name suffixes of compressed HepMC files.
+COMPRESSION_SUFFIXES = (".gz", ".bz2", ".xz", ".zst")
+
+
+def compression(filename):
+    """
+    Returns the compression format of a file, detected from its leading bytes rather than its name.
+
+    Arguments:
+    filename -- path of the file.
+
+    Returns:
+    "gzip", "bz2", "xz" or "zstd", or None for an uncompressed file.
+    """
+    with open(filename, "rb") as f:
+        return _compression(f.read(6))
+
+
+def _compression(magic):
+    for prefix, name in COMPRESSION_MAGIC:
+        if magic.startswith(prefix):
+            return name
+    return None
+
+
+def open_binary(filename):
+    """
+    Opens a HepMC file for reading in binary mode. Compressed files are decompressed as they are read, so
+    they are never inflated in memory as a whole. Decompressed zstd streams can only be read forwards, and
+    need the optional zstandard package.
+
+    Arguments:
+    filename -- path of the file, compressed or not.
+
+    Returns:
+    A binary file object over the uncompressed contents.
+    """
+    f = open(filename, "rb")
+    fmt = _compression(f.peek(6)[:6])
+    if fmt == "gzip":
+        return gzip.GzipFile(fileobj=f, mode="rb")
+    if fmt == "bz2":
+        return bz2.BZ2File(f)
+    if fmt == "xz":
+        return lzma.LZMAFile(f)
+    if fmt == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            f.close()
+            raise ValueError("Reading zstd compressed files requires the zstandard package.")
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(f, closefd=True))
+    return f
+
+
+def open_text(filename):
+    """
+    Opens a HepMC file for reading as UTF-8 text, decompressing it on the fly if needed (see open_binary).
+
+    Arguments:
+    filename -- path of the file, compressed or not.
+
+    Returns:
+    A text file object over the uncompressed contents.
+    """
+    return io.TextIOWrapper(open_binary(filename), encoding="utf-8")
+
+
+def _new(cls, attributes):
+    "Create an instance of cls with the given attribute dictionary, bypassing its constructor"
+    obj = cls.__new__(cls)
+    obj.__dict__ = attributes
+    return obj
+
+
 class HepMCReader(object):
+    """
+    Reader for HepMC IO_GenEvent files. Iterating over the reader yields events one at a time, so a file can
+    be streamed without holding more than the current event in memory. Given an event index (see index_events),
+    the reader can also jump straight to any event in a seekable file.
 
-    def __init__(self, file):
+    Methods:
+    fromfilename -- opens a reader on a file path.
+    next -- returns the next event in the file.
+    all_events -- returns a list of all remaining events in the file.
+    seek_event -- moves the reader to the start of an event.
+    read_event -- reads the event with a given number.
+    """
+
+    #Size of the blocks read from the file in fast mode.
+    BLOCK_SIZE = 1 << 20
+
+    def __init__(self, file, index=None, fast=False, lazy=False):
+        """
+        Constructor.
+
+        Arguments:
+        file -- a text file object positioned at the start of a HepMC file.
+        index -- the file's event index, needed by seek_event/read_event. Built on first use if not given.
+        fast -- use the fast parse mode, which reads the file in large blocks and converts the numeric columns
+        of each event in bulk with NumPy. Produces the same events as the default mode, but raises ValueError
+        on malformed particle or vertex lines instead of skipping them.
+        lazy -- read only the header lines of each event (E, U and C), keeping the rest of its text to be parsed
+        as in fast mode when its particles or vertices are first used (see Event.load). Passes that only need
+        event numbers, barcodes, weights, units or cross-sections then cost little more than reading the file.
+        """
         self._file = file
         self._currentline = None
         self._currentvtx = None
+        #Number of events read so far, used to number events in file order.
+        self._nevents = 0
+        self.index = index
+        self.fast = fast
+        self.lazy = lazy
+        #Text read ahead of the current line in fast mode.
+        self._buffer = ""
         self.version = None
         ## First non-empty line should be the version info
         while True:
-            self._read_next_line()
+            if not self._read_next_line():
+                raise ValueError("Not a HepMC file: no HepMC::Version line found.")
             if self._currentline.startswith("HepMC::Version"):
                 self.version = self._currentline.split()[1]
                 break
         ## Read on until we see the START_EVENT_LISTING marker
         while True:
-            self._read_next_line()
+            if not self._read_next_line():
+                raise ValueError("Not a HepMC IO_GenEvent file: no START_EVENT_LISTING line found.")
             if self._currentline == "HepMC::IO_GenEvent-START_EVENT_LISTING":
                 break
         ## Read one more line to make the first E line current
         self._read_next_line()
 
     @classmethod
-    def fromfilename(cls, filename):
-        return cls(open(filename))
+    def fromfilename(cls, filename, **kwargs):
+        return cls(open_text(filename), **kwargs)
+
+    def seek_event(self, n):
+        """
+        Moves the reader to the start of the n-th event in the file (counting from 1), so the next call to next()
+        returns it. Costs one seek rather than parsing all the events before it. Raises IndexError if there is
+        no such event, and ValueError if the file can only be read in order: seeking needs a text file over a
+        binary one, or an io.StringIO.
+
+        Arguments:
+        n -- the number of the event in the file.
+        """
+        if self.index is None:
+            if isinstance(self._file, io.StringIO):
+                source = self._file
+            elif hasattr(self._file, "buffer"):
+                ## Index the underlying byte stream; the seek below resynchronises the text layer
+                source = self._file.buffer
+            else:
+                raise ValueError("seek_event needs a binary-backed file or an io.StringIO")
+            self._file.seek(0)
+            self.index = index_events(source)
+        if not 1 <= n <= len(self.index):
+            raise IndexError("event %d out of range, file has %d events" % (n, len(self.index)))
+        self._file.seek(int(self.index[n - 1, 0]))
+        self._buffer = ""
+        self._read_next_line()
+        self._nevents = n - 1
+
+    @timing.timed("parse")
+    def read_event(self, n):
+        """
+        Reads the n-th event in the file (counting from 1) without parsing the events before it.
+
+        Arguments:
+        n -- the number of the event in the file.
+
+        Returns:
+        evt -- the event, or None if there is no such event.
+        """
+        try:
+            self.seek_event(n)
+        except IndexError:
+            return None
+        return self.next()
 
     def _read_next_line(self):
         "Return the next line, stripped of the trailing newline"
@@ -230,17 +827,21 @@ class HepMCReader(object):
         Gets next event in file. Returns none if no events are left.
 
         Returns:
-        evt -- next event in file.
+        evt -- next event in file, with evt.no set to its position in the file.
         """
         "Return a new event graph"
-        PDT = pypdt.PDT()
         evt = Event()
         if not self._currentline or self._currentline == "HepMC::IO_GenEvent-END_EVENT_LISTING":
             return None
         assert self._currentline.startswith("E ")
-        vals = self._currentline.split()
-        evt.num = int(vals[1])
-        evt.weights = [float(vals[-1])] # TODO: do this right, and handle weight maps
+        self._nevents += 1
+        evt.no = self._nevents
+        if self.lazy:
+            return self._next_lazy(evt)
+        table = particle_table()
+        if self.fast:
+            return self._next_fast(evt, table)
+        _parse_event_line(evt, self._currentline)
         ## Read the other event header lines until a Vertex line is encountered
         while not self._currentline.startswith("V "):
             self._read_next_line()
@@ -263,8 +864,8 @@ class HepMCReader(object):
                     p.status = int(vals[8])
                     p.nvtx_start = self._currentvtx
                     p.nvtx_end = int(vals[11])
-                    p.charge = PDT[p.barcode].charge if PDT[p.barcode] else 0.0
-                    evt.particles[bc] = p
+                    p.charge = table.charge(p.pid)
+                    evt.add_particle(p)
                 except:
                     print (vals)
             elif vals[0] == "V":
@@ -272,12 +873,74 @@ class HepMCReader(object):
                 #print("V", bc)
                 self._currentvtx = bc # current vtx barcode for following Particles
                 v = Vertex(barcode=bc, pos=[float(x) for x in vals[3:7]], event=evt)
-                evt.vertices[bc] = v
+                evt.add_vertex(v)
             elif not self._currentline or self._currentline == "HepMC::IO_GenEvent-END_EVENT_LISTING":
                 break
             self._read_next_line()
         return evt
     
+    def _read_event_text(self):
+        "Return the body lines of the current event as one string, and the line that follows them"
+        buf = self._buffer
+        start = 0
+        while True:
+            if buf.startswith(("E ", "HepMC::IO_GenEvent-END_EVENT_LISTING")):
+                end = 0
+            else:
+                found = [i + 1 for i in (buf.find("\nE ", start), buf.find("\nHepMC::IO_GenEvent-END", start)) if i >= 0]
+                end = min(found) if found else -1
+            chunk = None
+            if end < 0 or buf.find("\n", end) < 0:
+                chunk = self._file.read(self.BLOCK_SIZE)
+            if chunk:
+                #Resume the search where it left off, allowing for a marker split across blocks.
+                start = max(len(buf) - len("\nHepMC::IO_GenEvent-END"), 0) if end < 0 else end - 1
+                buf += chunk
+                continue
+            if end < 0:
+                self._buffer = ""
+                return buf, ""
+            eol = buf.find("\n", end)
+            self._buffer = buf[eol + 1:] if eol >= 0 else ""
+            return buf[:end], buf[end:eol] if eol >= 0 else buf[end:]
+
+    def _next_fast(self, evt, table):
+        "Parse the current event from one block of text, converting its numeric columns in bulk"
+        _parse_event_line(evt, self._currentline)
+        text, self._currentline = self._read_event_text()
+        self._currentvtx = _parse_body(evt, text, self._currentvtx, table)
+        return evt
+
+    def _next_lazy(self, evt):
+        "Read the current event's header lines, keeping the text of its particle and vertex lines to parse later"
+        _parse_event_line(evt, self._currentline)
+        text, self._currentline = self._read_event_text()
+        #Header lines come before the first vertex or particle line.
+        found = [i for i in (text.find("\nV "), text.find("\nP ")) if i >= 0]
+        header = "" if text.startswith(("V ", "P ")) else text[:min(found)] if found else text
+        for line in header.split("\n"):
+            if line.startswith("U "):
+                evt.units = line.split()[1:3]
+            elif line.startswith("C "):
+                evt.xsec = [float(x) for x in line.split()[1:3]]
+        evt._body = text
+        evt._body_vtx = self._currentvtx
+        evt._loaded = False
+        #Particles of the next event are attached to the last vertex of this one until it has its own.
+        last = text.rfind("\nV ") + 1
+        if last or text.startswith("V "):
+            self._currentvtx = int(text[last:].split(None, 2)[1])
+        return evt
+
+    def __iter__(self):
+        """
+        Generator over the remaining events in the file, reading each event only when it is requested.
+        """
+        evt = self.next()
+        while evt is not None:
+            yield evt
+            evt = self.next()
+
     def all_events(self):
         """
         Utility function to get all events in the file. Returns empty list if no events in file.
@@ -285,41 +948,183 @@ class HepMCReader(object):
         Returns:
         events -- a list of events in the file.
         """
-        #Counter for the number of objects in file.
-        no = 1
-        events = []
-        evt = self.next()
-        while evt is not None:
-            evt.no = no
-            no += 1
-            events.append(evt)
-            evt = self.next()
-        return events
+        return list(self)
+
+
+def _parse_event_line(evt, line):
+    """
+    Sets the event number and weights of an event from its E line, which every reading mode parses the same way.
+
+    Arguments:
+    evt -- the event.
+    line -- the event's E line.
+    """
+    vals = line.split()
+    evt.num = int(vals[1])
+    evt.weights = [float(vals[-1])] # TODO: do this right, and handle weight maps
+
+
+def _parse_body(evt, text, currentvtx, table):
+    """
+    Parses the particle and vertex lines of an event from one block of text, converting their numeric columns
+    in bulk, and adds the resulting objects to the event.
+
+    Arguments:
+    evt -- the event.
+    text -- the event's lines after its E line.
+    currentvtx -- barcode of the vertex particles are attached to before the event's first vertex line.
+    table -- the ParticleTable used to look up charges.
+
+    Returns:
+    The barcode of the event's last vertex, or currentvtx if it has none.
+    """
+    plines, vlines, owners = [], [], []
+    for line in text.split("\n"):
+        if line.startswith("P "):
+            plines.append(line)
+            #Index of the vertex line this particle follows, -1 if none yet in this event.
+            owners.append(len(vlines) - 1)
+        elif line.startswith("V "):
+            vlines.append(line)
+        elif not vlines and line.startswith("U "):
+            evt.units = line.split()[1:3]
+        elif not vlines and line.startswith("C "):
+            evt.xsec = [float(x) for x in line.split()[1:3]]
+    #The objects built below are acyclic apart from their event reference, so pause the cyclic garbage
+    #collector while creating them rather than letting it rescan every earlier event on each pass.
+    gcEnabled = gc.isenabled()
+    gc.disable()
+    try:
+        return _build_body(evt, table, plines, vlines, owners, currentvtx)
+    finally:
+        if gcEnabled:
+            gc.enable()
+
+
+def _build_body(evt, table, plines, vlines, owners, currentvtx):
+    "Convert the particle and vertex lines of an event in bulk and add the resulting objects to it"
+    vbarcodes = []
+    if vlines:
+        vcols = np.loadtxt(vlines, usecols=range(1, 7), ndmin=2)
+        vbarcodes = vcols[:, 0].astype(np.int64).tolist()
+        vertices = [_new(Vertex, {"evt": evt, "pos": pos, "barcode": bc})
+                    for bc, pos in zip(vbarcodes, vcols[:, 2:6].tolist())]
+        evt._vertices.update(zip(vbarcodes, vertices))
+    if plines:
+        pcols = np.loadtxt(plines, usecols=range(1, 12), ndmin=2)
+        ints = pcols[:, [0, 1, 7, 10]].astype(np.int64)
+        starts = [vbarcodes[o] if o >= 0 else currentvtx for o in owners]
+        charges = table.charges(ints[:, 1]).tolist()
+        particles = [_new(Particle, {"evt": evt, "barcode": bc, "pid": pid, "status": status, "mom": mom,
+                                     "charge": charge, "nvtx_start": nvtx_start, "nvtx_end": nvtx_end,
+                                     "mass": mass})
+                     for (bc, pid, status, nvtx_end), mom, mass, nvtx_start, charge in
+                     zip(ints.tolist(), pcols[:, 2:6].tolist(), pcols[:, 6].tolist(), starts, charges)]
+        evt.add_particles(particles)
+    return vbarcodes[-1] if vbarcodes else currentvtx
 
 
 class HepMCWriter(object):
+    """
+    Writer for HepMC IO_GenEvent files, the format HepMCReader reads. Each event is formatted as a whole and
+    handed to a buffered file in a single write, gzip-compressed when the filename ends in .gz. Floats are
+    written with 17 significant digits, so they read back exactly.
+
+    Only what the event model holds is written. Event scale, couplings, signal process, beam particles, PDF
+    information, vertex IDs, polarizations and colour flow are written as zeros, weight names and heavy ion
+    lines are left out, and particles with neither a production nor an end vertex cannot be written at all.
+
+    Methods:
+    write_next -- writes an event.
+    write_events -- writes a sequence of events.
+    finalize -- writes the end marker and closes the file.
+    """
 
-    def __init__(self, filename):
-        self._file = open(filename)
-        self._file.write("HepMC::Version 2.6.X")
+    #Size of the write buffer of uncompressed files.
+    BUFFER_SIZE = 1 << 20
+
+    def __init__(self, filename, compress=None, compresslevel=6):
+        """
+        Constructor. Writes the file header. The writer can be used as a context manager, finalizing the file
+        on exit.
+
+        Arguments:
+        filename -- path of the file to create, replacing any existing file.
+        compress -- whether to gzip the output. By default, files whose name ends in .gz are compressed.
+        compresslevel -- the gzip compression level, from 1 (fastest) to 9 (smallest).
+        """
+        if compress is None:
+            compress = filename.endswith(".gz")
+        if compress:
+            self._file = gzip.open(filename, "wt", compresslevel=compresslevel, encoding="utf-8")
+        else:
+            self._file = open(filename, "w", buffering=self.BUFFER_SIZE, encoding="utf-8")
+        self._file.write("HepMC::Version %s\n" % HEPMC_VERSION)
         self._file.write("HepMC::IO_GenEvent-START_EVENT_LISTING\n")
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.finalize()
+
     def finalize(self):
         "Close the HepMC event file"
+        if self._file is None:
+            return
         self._file.write("HepMC::IO_GenEvent-END_EVENT_LISTING\n")
         self._file.close()
         self._file = None
 
-    # TODO: FINISH!
     def write_next(self, evt):
-        "Write the next event"
-        self._file.write("E\n")
-        self._file.write("U\n") # evt.units
-        self._file.write("U\n") # evt.xsec
-        for v in evt.vertices:
-            self._file.write("V\n")
-            for p in v.particles_in + v.particles_out:
-                self._file.write("P\n")
+        """
+        Writes the next event. Each vertex is followed by its orphan incoming particles, those with no
+        production vertex of their own, then by its outgoing particles, as HepMCReader expects.
+
+        Arguments:
+        evt -- the event to write.
+        """
+        self._file.write(_format_event(evt))
+
+    def write_events(self, events):
+        """
+        Writes a sequence of events, e.g. a HepMCReader, one at a time.
+
+        Arguments:
+        events -- an iterable of events.
+
+        Returns:
+        The number of events written.
+        """
+        n = 0
+        for evt in events:
+            self.write_next(evt)
+            n += 1
+        return n
+
+
+def _format_event(evt):
+    "Format an event's lines in IO_GenEvent format as a single string"
+    weights = evt.weights or []
+    vertices = evt.vertices
+    lines = ["E %d -1 0 0 0 0 0 %d 0 0 0 %d%s" % (evt.num or 0, len(vertices), len(weights),
+                                                "".join(" %.16e" % w for w in weights))]
+    if evt.units[0] is not None:
+        lines.append("U %s %s" % tuple(evt.units))
+    if evt.xsec[0] is not None:
+        lines.append("C %.16e %.16e" % tuple(evt.xsec))
+    for bc, v in vertices.items():
+        #The reader attaches orphans to the vertex they follow, so they may come back with it as their start.
+        orphans = [p for p in evt.particles_in(bc) if p.nvtx_start == bc or p.nvtx_start not in vertices]
+        outgoing = [p for p in evt.particles_out(bc) if p.nvtx_end != bc]
+        lines.append("V %d 0 %.16e %.16e %.16e %.16e %d %d 0" % (bc, v.pos[0], v.pos[1], v.pos[2], v.pos[3],
+                                                                len(orphans), len(outgoing)))
+        lines.extend("P %d %d %.16e %.16e %.16e %.16e %.16e %d 0 0 %d 0" %
+                     (p.barcode, p.pid, p.mom[0], p.mom[1], p.mom[2], p.mom[3], p.mass or 0.0, p.status or 0,
+                      p.nvtx_end or 0) for p in orphans + outgoing)
+    lines.append("")
+    #Exact zeros are written as 0, as HepMC itself does.
+    return "\n".join(lines).replace(" 0.0000000000000000e+00", " 0")
 
 
 def mk_nx_graph(evt):
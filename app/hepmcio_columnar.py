@@ -0,0 +1,335 @@
+"""Columnar NumPy representation of hepmcio events. A whole file, or any sequence of events, is held as a
+   few structured arrays (one row per event, particle and vertex) plus CSR-style adjacency arrays, instead of
+   one Python object per particle and vertex. The arrays can be saved as a directory of .npy files, which can
+   be opened memory-mapped, or as a single .npz archive.
+
+   Particles, vertices and events can still be used through the usual hepmcio interface: ColumnarEvent,
+   ColumnarParticle and ColumnarVertex are thin read-only views over the arrays that subclass the hepmcio
+   classes, so graph navigation, ancestor walks and the JSON encoders work on them unchanged.
+
+   Classes:
+   ColumnarEvents -- the arrays for a sequence of events.
+   ColumnarEvent -- a hepmcio Event view over one event in a ColumnarEvents.
+   ColumnarParticle -- a hepmcio Particle view over one particle row.
+   ColumnarVertex -- a hepmcio Vertex view over one vertex row.
+
+   Functions:
+   event_row -- returns the EVENT_DTYPE row for an event's header.
+   """
+
+import os
+from collections.abc import Mapping
+import numpy as np
+from app import hepmcio
+
+EVENT_DTYPE = np.dtype([("no", np.int64), ("num", np.int64), ("weight", np.float64), ("xsec", np.float64),
+                        ("xsec_err", np.float64), ("momentum_unit", "U8"), ("length_unit", "U8")])
+
+PARTICLE_DTYPE = np.dtype([("barcode", np.int64), ("pid", np.int64), ("status", np.int32),
+                           ("px", np.float64), ("py", np.float64), ("pz", np.float64), ("E", np.float64),
+                           ("mass", np.float64), ("charge", np.float64),
+                           ("start_vertex", np.int64), ("end_vertex", np.int64)])
+
+VERTEX_DTYPE = np.dtype([("barcode", np.int64), ("x", np.float64), ("y", np.float64), ("z", np.float64),
+                         ("t", np.float64)])
+
+#Names of the arrays making up a ColumnarEvents, as saved to disk.
+ARRAYS = ("events", "particles", "vertices", "particle_offsets", "vertex_offsets",
+          "start_row", "end_row", "in_ptr", "in_idx", "out_ptr", "out_idx")
+
+
+class ColumnarEvents(object):
+    """The columnar arrays for a sequence of events.
+
+       Attributes:
+       events -- EVENT_DTYPE array, one row per event.
+       particles -- PARTICLE_DTYPE array of the particles of all events, event by event.
+       vertices -- VERTEX_DTYPE array of the vertices of all events, event by event.
+       particle_offsets, vertex_offsets -- event i owns particle rows particle_offsets[i]:particle_offsets[i+1],
+       and likewise for vertices.
+       start_row, end_row -- row of each particle's start/end vertex in vertices, or -1 if it has none.
+       in_ptr, in_idx -- CSR adjacency: the particles coming into vertex row v are in_idx[in_ptr[v]:in_ptr[v+1]].
+       out_ptr, out_idx -- likewise for the particles coming out of each vertex.
+
+       Methods:
+       from_events -- builds the arrays from hepmcio events.
+       from_arrays -- builds the vertex rows and adjacency arrays around existing event, particle and vertex arrays.
+       from_file -- builds the arrays from a HepMC file.
+       load -- opens arrays saved with save, optionally memory-mapped.
+       save -- saves the arrays to a directory of .npy files or a .npz archive.
+       event -- returns a ColumnarEvent view of an event.
+    """
+    def __init__(self, **arrays):
+        for name in ARRAYS:
+            setattr(self, name, arrays[name])
+
+    def __len__(self):
+        return len(self.events)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.event(i)
+
+    @classmethod
+    def from_events(cls, events):
+        """Builds the arrays from an iterable of hepmcio events, e.g. a HepMCReader.
+        """
+        event_rows, particle_blocks, vertex_blocks = [], [], []
+        particle_offsets, vertex_offsets = [0], [0]
+        for evt in events:
+            event_rows.append(event_row(evt))
+            particles = np.array([(p.barcode, p.pid, p.status if p.status is not None else 0,
+                                   p.mom[0], p.mom[1], p.mom[2], p.mom[3], _float(p.mass), _float(p.charge),
+                                   _int(p.nvtx_start), _int(p.nvtx_end)) for p in evt.particles.values()],
+                                 dtype=PARTICLE_DTYPE)
+            vertices = np.array([(v.barcode,) + tuple(v.pos[:4]) for v in evt.vertices.values()], dtype=VERTEX_DTYPE)
+            particle_blocks.append(particles)
+            vertex_blocks.append(vertices)
+            particle_offsets.append(particle_offsets[-1] + len(particles))
+            vertex_offsets.append(vertex_offsets[-1] + len(vertices))
+        particles = np.concatenate(particle_blocks) if particle_blocks else np.empty(0, PARTICLE_DTYPE)
+        vertices = np.concatenate(vertex_blocks) if vertex_blocks else np.empty(0, VERTEX_DTYPE)
+        return cls.from_arrays(np.array(event_rows, dtype=EVENT_DTYPE), particles, vertices,
+                               np.array(particle_offsets, dtype=np.int64), np.array(vertex_offsets, dtype=np.int64))
+
+    @classmethod
+    def from_arrays(cls, events, particles, vertices, particle_offsets, vertex_offsets):
+        """Builds the vertex rows and adjacency arrays around existing arrays, e.g. ones read back from storage.
+           The given arrays are used as they are, without copying, so read-only arrays stay read-only.
+
+           Arguments:
+           events, particles, vertices -- arrays of EVENT_DTYPE, PARTICLE_DTYPE and VERTEX_DTYPE rows, or of
+           the same fields in another byte order.
+           particle_offsets, vertex_offsets -- the offsets of each event's rows, as for the attributes.
+        """
+        start_rows, end_rows = [], []
+        for i in range(len(events)):
+            p0, p1 = particle_offsets[i], particle_offsets[i + 1]
+            v0, v1 = vertex_offsets[i], vertex_offsets[i + 1]
+            vertex_barcodes = vertices["barcode"][v0:v1]
+            start_rows.append(_vertex_rows(vertex_barcodes, particles["start_vertex"][p0:p1], v0))
+            end_rows.append(_vertex_rows(vertex_barcodes, particles["end_vertex"][p0:p1], v0))
+        start_row = np.concatenate(start_rows) if start_rows else np.empty(0, np.int64)
+        end_row = np.concatenate(end_rows) if end_rows else np.empty(0, np.int64)
+        in_ptr, in_idx = _csr(end_row, len(vertices))
+        out_ptr, out_idx = _csr(start_row, len(vertices))
+        return cls(events=events, particles=particles, vertices=vertices, particle_offsets=particle_offsets,
+                   vertex_offsets=vertex_offsets, start_row=start_row, end_row=end_row, in_ptr=in_ptr,
+                   in_idx=in_idx, out_ptr=out_ptr, out_idx=out_idx)
+
+    @classmethod
+    def from_file(cls, filename):
+        """Builds the arrays from all events in a HepMC file, compressed or not, reading one event at a time.
+        """
+        with hepmcio.open_text(filename) as f:
+            return cls.from_events(hepmcio.HepMCReader(f, fast=True))
+
+    @classmethod
+    def load(cls, path, mmap_mode=None):
+        """Opens arrays saved with save.
+
+           Arguments:
+           path -- a directory of .npy files or a .npz archive.
+           mmap_mode -- passed to numpy.load for .npy directories, e.g. "r" to memory-map the arrays read-only.
+           Archives are always read into memory.
+        """
+        if os.path.isdir(path):
+            return cls(**{name:np.load(os.path.join(path, name + ".npy"), mmap_mode=mmap_mode) for name in ARRAYS})
+        with np.load(path) as archive:
+            return cls(**{name:archive[name] for name in ARRAYS})
+
+    def save(self, path):
+        """Saves the arrays. Paths ending in .npz are written as a single archive, anything else as a directory
+           of .npy files that can be memory-mapped by load.
+        """
+        arrays = {name:getattr(self, name) for name in ARRAYS}
+        if path.endswith(".npz"):
+            np.savez(path, **arrays)
+            return
+        os.makedirs(path, exist_ok=True)
+        for name, array in arrays.items():
+            np.save(os.path.join(path, name + ".npy"), array)
+
+    def event(self, i):
+        """Returns a ColumnarEvent view of the i-th event (counting from 0).
+        """
+        return ColumnarEvent(self, i)
+
+
+class _RowMapping(Mapping):
+    "Read-only barcode -> view mapping over a block of rows, creating each view on first access"
+    def __init__(self, barcodes, first_row, make_view):
+        self._rows = {int(bc):first_row + i for i, bc in enumerate(barcodes)}
+        self._make_view = make_view
+        self._views = {}
+
+    def __getitem__(self, barcode):
+        view = self._views.get(barcode)
+        if view is None:
+            view = self._views[barcode] = self._make_view(self._rows[barcode])
+        return view
+
+    def __iter__(self):
+        return iter(self._rows)
+
+    def __len__(self):
+        return len(self._rows)
+
+
+class _AdjacencyMapping(Mapping):
+    "Read-only vertex barcode -> particle views mapping over CSR adjacency arrays"
+    def __init__(self, evt, ptr, idx):
+        self._evt = evt
+        self._ptr = ptr
+        self._idx = idx
+
+    def __getitem__(self, barcode):
+        row = self._evt.vertices._rows[barcode]
+        return [self._evt._particle_at(int(r)) for r in self._idx[self._ptr[row]:self._ptr[row + 1]]]
+
+    def __iter__(self):
+        return iter(self._evt.vertices)
+
+    def __len__(self):
+        return len(self._evt.vertices)
+
+
+class ColumnarEvent(hepmcio.Event):
+    """A read-only hepmcio Event view over one event of a ColumnarEvents. Its particles and vertices are
+       created lazily as ColumnarParticle/ColumnarVertex views, and incoming/outgoing particles come from the
+       CSR adjacency arrays, so the Event navigation methods work unchanged.
+
+       Methods:
+       to_event -- materializes an independent, mutable hepmcio Event.
+    """
+    def __init__(self, store, i):
+        """Constructor.
+
+           Arguments:
+           store -- the ColumnarEvents holding the event.
+           i -- the index of the event in store (counting from 0).
+        """
+        self.store = store
+        row = store.events[i]
+        self.no = int(row["no"])
+        self.num = int(row["num"])
+        self.weights = [float(row["weight"])]
+        self.units = [str(row["momentum_unit"]) or None, str(row["length_unit"]) or None]
+        self.xsec = [_none(row["xsec"]), _none(row["xsec_err"])]
+        p0, p1 = store.particle_offsets[i], store.particle_offsets[i + 1]
+        v0, v1 = store.vertex_offsets[i], store.vertex_offsets[i + 1]
+        self._particles = _RowMapping(store.particles["barcode"][p0:p1], p0, lambda r: ColumnarParticle(self, r))
+        self.vertices = _RowMapping(store.vertices["barcode"][v0:v1], v0, lambda r: ColumnarVertex(self, r))
+        self._particles_in = _AdjacencyMapping(self, store.in_ptr, store.in_idx)
+        self._particles_out = _AdjacencyMapping(self, store.out_ptr, store.out_idx)
+        self._traversals = {}
+
+    def __eq__(self, other):
+        "Compare equal to plain hepmcio events with the same header, whichever side of == they are on"
+        return isinstance(other, hepmcio.Event) and hepmcio.Event.__eq__(other, self)
+
+    def _particle_at(self, row):
+        return self._particles[int(self.store.particles["barcode"][row])]
+
+    def to_event(self):
+        """Materializes an independent hepmcio Event with plain Particle and Vertex objects.
+        """
+        evt = hepmcio.Event()
+        evt.no, evt.num, evt.weights = self.no, self.num, list(self.weights)
+        evt.units, evt.xsec = list(self.units), list(self.xsec)
+        for p in self.particles.values():
+            q = hepmcio.Particle(p.pid, p.mom, p.barcode)
+            q.status, q.mass, q.charge, q.nvtx_start, q.nvtx_end = p.status, p.mass, p.charge, p.nvtx_start, p.nvtx_end
+            evt.add_particle(q)
+        for v in self.vertices.values():
+            evt.add_vertex(hepmcio.Vertex(v.pos, v.barcode))
+        return evt
+
+
+class ColumnarParticle(hepmcio.Particle):
+    """A read-only hepmcio Particle view over one row of a ColumnarEvents particle array.
+    """
+    def __init__(self, evt, row):
+        self.evt = evt
+        self._row = row
+
+    def __eq__(self, other):
+        return isinstance(other, hepmcio.Particle) and hepmcio.Particle.__eq__(other, self)
+
+    def _get(self, field):
+        return self.evt.store.particles[field][self._row]
+
+    barcode = property(lambda self: int(self._get("barcode")))
+    pid = property(lambda self: int(self._get("pid")))
+    status = property(lambda self: int(self._get("status")))
+    mass = property(lambda self: _none(self._get("mass")))
+    charge = property(lambda self: _none(self._get("charge")))
+    nvtx_start = property(lambda self: _none_int(self._get("start_vertex")))
+    nvtx_end = property(lambda self: _none_int(self._get("end_vertex")))
+
+    @property
+    def mom(self):
+        row = self.evt.store.particles[self._row]
+        return [float(row["px"]), float(row["py"]), float(row["pz"]), float(row["E"])]
+
+
+class ColumnarVertex(hepmcio.Vertex):
+    """A read-only hepmcio Vertex view over one row of a ColumnarEvents vertex array.
+    """
+    def __init__(self, evt, row):
+        self.evt = evt
+        self._row = row
+
+    def __eq__(self, other):
+        return isinstance(other, hepmcio.Vertex) and hepmcio.Vertex.__eq__(other, self)
+
+    barcode = property(lambda self: int(self.evt.store.vertices["barcode"][self._row]))
+
+    @property
+    def pos(self):
+        row = self.evt.store.vertices[self._row]
+        return [float(row["x"]), float(row["y"]), float(row["z"]), float(row["t"])]
+
+
+def event_row(evt):
+    """Returns the EVENT_DTYPE row for a hepmcio event's header, as a tuple.
+    """
+    units = evt.units if evt.units else [None, None]
+    xsec = evt.xsec if evt.xsec else [None, None]
+    return (evt.no or 0, evt.num, (evt.weights or [np.nan])[0], _float(xsec[0]), _float(xsec[1]),
+            units[0] or "", units[1] or "")
+
+
+#Missing integer fields (e.g. a particle without a start vertex) are stored as this sentinel.
+NO_VALUE = np.iinfo(np.int64).min
+
+def _int(value):
+    return NO_VALUE if value is None else value
+
+def _float(value):
+    return np.nan if value is None else value
+
+def _none(value):
+    return None if np.isnan(value) else float(value)
+
+def _none_int(value):
+    return None if value == NO_VALUE else int(value)
+
+
+def _vertex_rows(vertex_barcodes, barcodes, offset):
+    "Map vertex barcodes to global vertex rows, -1 where there is no such vertex in the event"
+    if len(vertex_barcodes) == 0:
+        return np.full(len(barcodes), -1, dtype=np.int64)
+    sorter = np.argsort(vertex_barcodes, kind="stable")
+    pos = np.searchsorted(vertex_barcodes, barcodes, sorter=sorter)
+    pos = np.minimum(pos, len(vertex_barcodes) - 1)
+    found = vertex_barcodes[sorter[pos]] == barcodes
+    return np.where(found, sorter[pos] + offset, -1).astype(np.int64)
+
+
+def _csr(rows, nrows):
+    "Build CSR (ptr, idx) arrays listing, for each of nrows targets, the indices i with rows[i] equal to it"
+    valid = np.flatnonzero(rows >= 0)
+    idx = valid[np.argsort(rows[valid], kind="stable")]
+    ptr = np.searchsorted(rows[idx], np.arange(nrows + 1))
+    return ptr.astype(np.int64), idx.astype(np.int64)
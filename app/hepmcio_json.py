@@ -9,6 +9,11 @@
    EventEncoder -- JSON encoder implementation for event objects
    
    Functions:
+   particle_document -- builds the plain dict document for a particle
+   vertex_document -- builds the plain dict document for a vertex
+   event_document -- builds the plain dict document for an event, without its particles and vertices
+   event_documents -- builds the documents for an event followed by its particles and vertices
+   event_from_documents -- rebuilds an event graph directly from its stored documents
    as_event -- object hook for JSONified events, for use with standard JSON decoder
    as_particle -- object hook for JSONified particles, for use with standard JSON decoder
    as_vertex -- object hook for JSONified vertices, for use with standard JSON decoder
@@ -19,7 +24,7 @@ __version__ = "1.0"
 
 
 import json
-from app import hepmcio
+from app import hepmcio, timing
 
 class EventJSONObject(object):
     """An object wrapper for JSONified events. Contains event, associated particles and vertices
@@ -101,14 +106,10 @@ class HepMCJSONDecoder(object):
         """
         if isinstance(obj, EventJSONObject):
             evt = self.EventDecoder.decode(obj.evt)
-            particles = [self.ParticleDecoder.decode(p) for p in obj.particles]
-            for p in particles:
-                p.evt = evt
-            vertices = [self.VertexDecoder.decode(v) for v in obj.vertices]
-            for v in vertices:
-                v.evt = evt
-            evt.particles = {p.barcode:p for p in particles}
-            evt.vertices = {v.barcode:v for v in vertices}
+            for p in obj.particles:
+                evt.add_particle(self.ParticleDecoder.decode(p))
+            for v in obj.vertices:
+                evt.add_vertex(self.VertexDecoder.decode(v))
             return evt
         
         objType = json.JSONDecoder().decode(obj).get("type", None)
@@ -120,13 +121,68 @@ class HepMCJSONDecoder(object):
             raise ValueError
         
 
+def particle_document(obj):
+    """Builds the plain dict document for a hepmcio Particle, as stored in the database and produced by
+       ParticleEncoder. Missing charges are filled in from the shared hepmcio particle table.
+    """
+    charge = obj.charge if obj.charge is not None else hepmcio.particle_table().charge(obj.pid)
+    return {"type":"particle", "event":obj.evt.num, "barcode":obj.barcode, "pid":obj.pid,"charge":charge, "mass":obj.mass, "momentum":obj.mom, "start_vertex":obj.nvtx_start, "end_vertex":obj.nvtx_end, "status":obj.status}
+
+def vertex_document(obj):
+    """Builds the plain dict document for a hepmcio Vertex, as stored in the database and produced by
+       VertexEncoder.
+    """
+    return {"type":"vertex", "event":obj.evt.num, "barcode":obj.barcode, "position":obj.pos}
+
+def event_document(obj):
+    """Builds the plain dict document for a hepmcio Event, as stored in the database and produced by
+       EventEncoder. References to associated particles/vertices are left out to maintain a semi-normal form.
+    """
+    return {"type":"event", "no":obj.no, "barcode":obj.num,  "weight":obj.weights, "units":obj.units, "xsec":obj.xsec}
+
+def event_documents(evt):
+    """Builds the documents for an event directly from the hepmcio objects, without going through JSON strings.
+
+       Arguments:
+       evt -- the hepmcio event.
+
+       Returns:
+       A list holding the event document followed by one document per particle and per vertex.
+    """
+    documents = [event_document(evt)]
+    documents.extend(particle_document(p) for p in evt.particles.values())
+    documents.extend(vertex_document(v) for v in evt.vertices.values())
+    return documents
+
+def event_from_documents(event, particles, vertices):
+    """Rebuilds a hepmcio event graph directly from its documents, as produced by event_documents or read from
+       the database, without going through JSON strings.
+
+       Arguments:
+       event -- the event document.
+       particles -- an iterable of particle documents.
+       vertices -- an iterable of vertex documents.
+
+       Returns:
+       The hepmcio Event, with its adjacency index built.
+    """
+    with timing.stage("decode") as stage:
+        evt = as_event(event)
+        for p in particles:
+            evt.add_particle(as_particle(p))
+        for v in vertices:
+            evt.add_vertex(as_vertex(v))
+        stage.count(particles=len(evt.particles), vertices=len(evt.vertices))
+    return evt
+
 class ParticleEncoder(json.JSONEncoder):
     """JSON encoder for hepmcio Particle objects. Overrides standard JSONEncoder and its default method. 
-        The returned JSON string contains all the attributes of the object plus type info.
+        The returned JSON string contains all the attributes of the object plus type info. Missing charges
+        are filled in from the shared hepmcio particle table.
     """
     def default(self,obj):
         if isinstance(obj, hepmcio.Particle):
-            return {"type":"particle", "event":obj.evt.num, "barcode":obj.barcode, "pid":obj.pid,"charge":obj.charge, "mass":obj.mass, "momentum":obj.mom, "start_vertex":obj.nvtx_start, "end_vertex":obj.nvtx_end, "status":obj.status}
+            return particle_document(obj)
         return json.JSONEncoder.default(self,obj)
 
 class VertexEncoder(json.JSONEncoder):
@@ -135,7 +191,7 @@ class VertexEncoder(json.JSONEncoder):
     """
     def default(self,obj):
         if isinstance(obj, hepmcio.Vertex):
-            return {"type":"vertex", "event":obj.evt.num, "barcode":obj.barcode, "position":obj.pos}
+            return vertex_document(obj)
         return json.JSONEncoder.default(self,obj)
 
 class EventEncoder(json.JSONEncoder):
@@ -145,7 +201,7 @@ class EventEncoder(json.JSONEncoder):
     """
     def default(self,obj):
         if isinstance(obj, hepmcio.Event):
-            return {"type":"event", "no":obj.no, "barcode":obj.num,  "weight":obj.weights, "units":obj.units, "xsec":obj.xsec}
+            return event_document(obj)
         return json.JSONEncoder.default(self,obj)
 
 def as_event(dct):
@@ -178,7 +234,9 @@ def as_particle(dct):
         particle.nvtx_start = dct["start_vertex"]
         particle.nvtx_end = dct["end_vertex"]
         particle.mass = dct["mass"]
-        particle.charge = dct["charge"]
+        particle.charge = dct.get("charge")
+        if particle.charge is None:
+            particle.charge = hepmcio.particle_table().charge(particle.pid)
         return particle
     return dct
 
@@ -0,0 +1,229 @@
+"""Parallel parsing of large HepMC files. The file is split into byte ranges aligned on event boundaries,
+   each range is parsed by the usual HepMCReader in a separate process, and the results are handed back in
+   file order with the events numbered as a single reader would number them.
+
+   Events come back as hepmcio objects or, for ingestion, as their ready-to-insert documents. Documents are
+   much cheaper to send between processes than the event graphs, so the parent process stays out of the way
+   and throughput grows with the number of workers.
+
+   Compressed files cannot be split by byte offset, so they are first decompressed to a temporary file, which
+   is cheap next to parsing, or streamed through a single reader when only one worker is used. Files too small
+   to be worth handing to other processes are parsed in the calling process.
+
+   The worker processes are shared: every read submits its ranges to one pool of at most MAX_PROCESSES
+   processes, so concurrent uploads share the CPUs instead of each starting a process per CPU. The pool is
+   started from a fork server (or by spawning, where there is none) rather than by forking the app, whose
+   other threads could be holding locks that the forked children would then wait on forever.
+
+   Functions:
+   event_ranges -- splits a file into byte ranges that start on event boundaries.
+   read_events -- parses a file in worker processes, yielding events or documents in file order.
+   """
+
+import io
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from app import hepmcio, hepmcio_json
+
+#Largest byte range handed to a worker in one go. Files are split into at least one range per worker.
+CHUNK_BYTES = 16*1024*1024
+
+#Files smaller than this are parsed in the calling process, as starting and feeding worker processes would
+#take longer than parsing them.
+MIN_PARALLEL_BYTES = 4*1024*1024
+
+#Number of processes in the pool shared by all reads.
+MAX_PROCESSES = os.cpu_count() or 1
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _event_start(f, pos):
+    "Return the offset of the first event or end-marker line at or after pos in a binary file"
+    if pos > 0:
+        #Skip the rest of the line pos falls in, unless pos is itself at a line start.
+        f.seek(pos - 1)
+        pos += len(f.readline()) - 1
+    else:
+        f.seek(0)
+    for line in f:
+        if line.startswith((b"E ", b"HepMC::IO_GenEvent-END_EVENT_LISTING")):
+            return pos
+        pos += len(line)
+    return pos
+
+
+def event_ranges(filename, nranges):
+    """Splits a HepMC file into byte ranges of roughly equal size, each starting on an event line so that it
+       holds whole events only. The first range also holds the file header and the last the end marker.
+
+       Arguments:
+       filename -- path of the HepMC file.
+       nranges -- the number of ranges wanted. Fewer are returned if the file has fewer events.
+
+       Returns:
+       A list of (start, end) byte offsets in file order.
+    """
+    size = os.path.getsize(filename)
+    with open(filename, "rb") as f:
+        bounds = [0]
+        for i in range(1, nranges):
+            start = _event_start(f, max(size*i//nranges, bounds[-1]))
+            if start > bounds[-1] and start < size:
+                bounds.append(start)
+        bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def _parse_range(filename, start, end, build):
+    "Parse the events in one byte range of a file, returning the events, or their document lists if build is given"
+    with open(filename, "rb") as f:
+        #The reader expects the file header before the first event, so ranges after the first reuse it.
+        header = b""
+        if start > 0:
+            size = _event_start(f, 0)
+            f.seek(0)
+            header = f.read(size)
+        f.seek(start)
+        text = (header + f.read(end - start)).decode("utf-8")
+    events = hepmcio.HepMCReader(io.StringIO(text), fast=True)
+    if build is not None:
+        return [build(evt) for evt in events]
+    return list(events)
+
+
+def read_events(filename, workers=None, documents=False, chunk_bytes=CHUNK_BYTES, progress=None,
+                min_bytes=MIN_PARALLEL_BYTES, build=None):
+    """Parses a HepMC file in the shared pool of worker processes. Ranges are submitted a few at a time per
+       worker, so only a bounded part of the file is held in memory however large it is. A file smaller than
+       min_bytes is parsed in the calling process.
+
+       Arguments:
+       filename -- path of the HepMC file.
+       workers -- number of ranges parsed at the same time, by at most MAX_PROCESSES processes shared with any
+       other reads. Defaults to the number of CPUs.
+       documents -- yield each event's documents, as built by build, instead of the event itself.
+       chunk_bytes -- largest byte range parsed by a worker at a time.
+       progress -- called with the numbers of events and of uncompressed bytes read so far, once the events of
+       each range have been consumed (after every event when streaming a compressed file).
+       min_bytes -- files smaller than this, uncompressed, are parsed in the calling process.
+       build -- the module-level function building an event's documents in the worker processes, such as
+       packedstore.event_documents. Defaults to hepmcio_json.event_documents.
+
+       Returns:
+       A generator over the events, or over their document lists, in file order. Events are numbered from 1
+       as HepMCReader numbers them.
+    """
+    workers = workers or os.cpu_count() or 1
+    build = (build or hepmcio_json.event_documents) if documents else None
+    if hepmcio.compression(filename) is not None:
+        if workers == 1:
+            return _numbered(_read_stream(filename, build), build, progress)
+        return _read_decompressed(filename, workers, build, chunk_bytes, progress, min_bytes)
+    size = os.path.getsize(filename)
+    serial = workers == 1 or size < min_bytes
+    ranges = event_ranges(filename, max(1 if serial else workers, -(-size//chunk_bytes)))
+    if serial or len(ranges) == 1:
+        chunks = ((end, _parse_range(filename, start, end, build)) for start, end in ranges)
+    else:
+        chunks = _parse_ranges(filename, ranges, workers, build)
+    return _numbered(chunks, build, progress)
+
+
+def _read_stream(filename, build):
+    "Parse a file with a single reader as it is decompressed, yielding one event or document list at a time"
+    with hepmcio.open_text(filename) as f:
+        for evt in hepmcio.HepMCReader(f, fast=True):
+            #The position is that of the decompressed data, read ahead of the parser by up to a block.
+            yield f.buffer.tell(), [build(evt) if build is not None else evt]
+
+
+def _read_decompressed(filename, workers, build, chunk_bytes, progress, min_bytes):
+    "Decompress a file to a temporary file and read that in parallel, removing it once the events are read"
+    fd, path = tempfile.mkstemp(suffix=".hepmc")
+    try:
+        with os.fdopen(fd, "wb") as f, hepmcio.open_binary(filename) as source:
+            shutil.copyfileobj(source, f, 1024*1024)
+        for item in read_events(path, workers, build is not None, chunk_bytes, progress, min_bytes, build):
+            yield item
+    finally:
+        os.remove(path)
+
+
+def _numbered(chunks, build, progress):
+    "Yield the events or document lists of each (end offset, items) chunk in turn, numbering them from 1"
+    no = 0
+    for end, chunk in chunks:
+        for item in chunk:
+            no += 1
+            _number(item, no, build is not None)
+            yield item
+        if progress is not None:
+            progress(no, end)
+
+
+def _start_context():
+    "Return the multiprocessing context the pool's processes are started with, a fork server where available"
+    if "forkserver" not in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("spawn")
+    context = multiprocessing.get_context("forkserver")
+    #The server imports the parser once, and each worker forked from it starts with it loaded.
+    context.set_forkserver_preload([__name__])
+    return context
+
+
+def _shared_pool():
+    "Return the process pool shared by all reads, starting it on first use"
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(MAX_PROCESSES, mp_context=_start_context())
+        return _pool
+
+
+def _discard_pool(pool):
+    "Forget a pool broken by a worker process dying, so that the next read starts a new one"
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False)
+
+
+def _parse_ranges(filename, ranges, workers, build):
+    "Parse byte ranges in the shared pool, yielding each range's end and results in order, 2 per worker pending"
+    pool = _shared_pool()
+    pending = deque()
+    ranges = iter(ranges)
+    try:
+        while True:
+            for start, end in ranges:
+                pending.append((end, pool.submit(_parse_range, filename, start, end, build)))
+                if len(pending) >= 2*workers:
+                    break
+            if not pending:
+                return
+            end, future = pending.popleft()
+            yield end, future.result()
+    except BrokenProcessPool:
+        _discard_pool(pool)
+        raise
+    finally:
+        #Ranges of a read that is abandoned or fails are not parsed for nothing.
+        for end, future in pending:
+            future.cancel()
+
+
+def _number(item, no, documents):
+    "Set the file order number of an event, or of the event document heading its documents"
+    if documents:
+        item[0]["no"] = no
+    else:
+        item.no = no
@@ -0,0 +1,139 @@
+"""Streaming ingestion of HepMC files into MongoDB. Events are parsed one at a time and their documents are
+   gathered across events into large unordered batches, so memory use does not grow with the size of the
+   file and each batch costs a single round trip. Files are stored either one document per event, particle
+   and vertex, or one packed document per event (see eventstore and packedstore).
+
+   Classes:
+   BulkWriter -- buffers documents and writes them to a collection in unordered batches.
+
+   Functions:
+   ingest_stream -- parses a HepMC text stream and inserts its documents and manifest into a collection.
+   ingest_file -- as ingest_stream, for a file on disk parsed in parallel worker processes.
+   """
+
+from app import hepmcio, hepmcio_json, hepmcio_parallel, eventstore, packedstore
+
+
+class BulkWriter(object):
+    """Buffers documents, possibly from many events, and writes them to a collection with unordered
+       insert_many calls of a configurable size. Unordered batches let the server apply the writes in
+       parallel instead of stopping at each one. Can be used as a context manager, which flushes on exit.
+
+       Methods:
+       add -- adds documents to the buffer, flushing whenever a full batch is pending.
+       flush -- writes out all pending documents.
+    """
+    def __init__(self, collection, batch_size=10000):
+        """Constructor.
+
+           Arguments:
+           collection -- the MongoDB collection to write to.
+           batch_size -- number of documents sent in each insert_many call.
+        """
+        self.collection = collection
+        self.batch_size = batch_size
+        self.ndocuments = 0
+        self.nbatches = 0
+        self._pending = []
+
+    def add(self, documents):
+        """Adds documents to the buffer, writing out full batches as they fill up.
+
+           Arguments:
+           documents -- an iterable of dicts to be inserted.
+        """
+        self._pending.extend(documents)
+        while len(self._pending) >= self.batch_size:
+            self._write(self._pending[:self.batch_size])
+            del self._pending[:self.batch_size]
+
+    def flush(self):
+        """Writes out all pending documents.
+        """
+        if self._pending:
+            self._write(self._pending)
+            self._pending = []
+
+    def _write(self, documents):
+        self.collection.insert_many(documents, ordered=False)
+        self.ndocuments += len(documents)
+        self.nbatches += 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+        return False
+
+
+def _batch_size(batch_size, layout):
+    "Packed events are one document each, of up to packedstore.MAX_COLUMN_BYTES, so are sent in smaller batches"
+    return min(batch_size, packedstore.BATCH_EVENTS) if layout == eventstore.PACKED else batch_size
+
+
+def ingest_stream(stream, collection, batch_size=10000, layout=eventstore.DOCUMENTS):
+    """Parses a HepMC text stream event by event and inserts the resulting documents into a collection.
+       Documents are built directly from the hepmcio objects and written in unordered batches of batch_size,
+       so at most one batch plus one event is held in memory at any time. The lookup indexes are created
+       first and the file's manifest is written once all events are in.
+
+       Arguments:
+       stream -- a text file object positioned at the start of a HepMC file.
+       collection -- the MongoDB collection to insert into.
+       batch_size -- number of documents sent in each insert, at most packedstore.BATCH_EVENTS in the packed
+       layout.
+       layout -- the storage layout, eventstore.DOCUMENTS or eventstore.PACKED.
+
+       Returns:
+       The manifest document for the file.
+    """
+    eventstore.ensure_indexes(collection)
+    manifest = eventstore.ManifestBuilder(layout)
+    with BulkWriter(collection, _batch_size(batch_size, layout)) as writer:
+        for evt in hepmcio.HepMCReader(stream, fast=True):
+            if layout == eventstore.PACKED:
+                documents = [packedstore.event_document(evt)]
+                packedstore.spill(collection, documents[0])
+            else:
+                documents = hepmcio_json.event_documents(evt)
+            manifest.add_documents(documents)
+            writer.add(documents)
+    document = manifest.document()
+    collection.insert_one(dict(document))
+    return document
+
+
+def ingest_file(filename, collection, batch_size=10000, workers=None, progress=None, layout=eventstore.DOCUMENTS):
+    """Parses a HepMC file in worker processes and inserts the resulting documents into a collection, as
+       ingest_stream does for a stream. The workers build the documents, so the calling process only numbers
+       them and writes them out.
+
+       Arguments:
+       filename -- path of the HepMC file.
+       collection -- the MongoDB collection to insert into.
+       batch_size -- number of documents sent in each insert, at most packedstore.BATCH_EVENTS in the packed
+       layout.
+       workers -- number of worker processes. Defaults to the number of CPUs.
+       progress -- called with the numbers of events and bytes processed so far, as for
+       hepmcio_parallel.read_events.
+       layout -- the storage layout, eventstore.DOCUMENTS or eventstore.PACKED. Packed documents are built by
+       the workers, and only spilled to GridFS by the calling process.
+
+       Returns:
+       The manifest document for the file.
+    """
+    eventstore.ensure_indexes(collection)
+    manifest = eventstore.ManifestBuilder(layout)
+    build = packedstore.event_documents if layout == eventstore.PACKED else None
+    with BulkWriter(collection, _batch_size(batch_size, layout)) as writer:
+        for documents in hepmcio_parallel.read_events(filename, workers, documents=True, progress=progress,
+                                                      build=build):
+            if layout == eventstore.PACKED:
+                packedstore.spill(collection, documents[0])
+            manifest.add_documents(documents)
+            writer.add(documents)
+    document = manifest.document()
+    collection.insert_one(dict(document))
+    return document
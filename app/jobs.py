@@ -0,0 +1,205 @@
+"""Background upload jobs. An upload is spooled to disk and handed to a small thread pool, and the request
+   returns a job ID straight away instead of holding a Flask worker while the file is parsed and inserted.
+   The status of each job, with its progress and any error, can then be polled.
+
+   Classes:
+   UploadJob -- the state and progress of one upload.
+   UploadJobs -- runs upload jobs in a thread pool and keeps track of them by ID.
+   """
+
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from app import eventstore, ingest, packedstore
+
+logger = logging.getLogger(__name__)
+
+#Job states, in the order a job goes through them.
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class UploadJob(object):
+    """The state and progress of one upload. Progress is updated by the worker thread and read by status
+       requests; each update replaces single attributes, so no lock is needed to read a consistent enough view.
+
+       Methods:
+       update -- records the numbers of events and bytes processed so far.
+       status -- returns the job's state and progress as a dict.
+    """
+    def __init__(self, filename, path=None):
+        """Constructor.
+
+           Arguments:
+           filename -- the name the file is stored under, without its extension.
+           path -- path of the spooled upload, removed once the job finishes. None for a job reserved before
+           its upload is spooled, see UploadJobs.reserve.
+        """
+        self.id = uuid.uuid4().hex
+        self.filename = filename
+        self.path = path
+        self.upload_bytes = os.path.getsize(path) if path is not None else 0
+        self.state = QUEUED
+        self.events = 0
+        self.bytes_read = 0
+        self.error = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+
+    def update(self, events, bytes_read):
+        """Records the numbers of events and (uncompressed) bytes processed so far.
+        """
+        self.events = events
+        self.bytes_read = bytes_read
+
+    def status(self):
+        """Returns the job's state and progress, with its throughput since it started, as a JSON-ready dict.
+        """
+        elapsed = 0.0
+        if self.started is not None:
+            elapsed = (self.finished or time.time()) - self.started
+        return {"id":self.id, "filename":self.filename, "state":self.state, "events":self.events,
+                "bytes_read":self.bytes_read, "upload_bytes":self.upload_bytes, "elapsed":elapsed,
+                "events_per_second":self.events/elapsed if elapsed else 0.0,
+                "mb_per_second":self.bytes_read/elapsed/1e6 if elapsed else 0.0, "error":self.error}
+
+
+class UploadJobs(object):
+    """Runs upload jobs in a thread pool. Each job ingests its spooled file into the file's collection, using
+       worker processes for the parsing, and removes the spooled file when it is done. A job that fails drops
+       the partly written collection, and any events it spilled to GridFS, so the file can be uploaded again. Finished jobs are kept for polling
+       until more than max_finished have accumulated, oldest first.
+
+       Methods:
+       submit -- queues an upload and returns its job.
+       reserve -- registers a job for a file before its upload is spooled.
+       start -- starts a job registered by reserve.
+       cancel -- forgets a job registered by reserve.
+       get -- returns a job by ID.
+       active -- returns whether a file has an upload queued or running.
+       shutdown -- stops the worker threads once queued jobs are done.
+    """
+    def __init__(self, cache, max_workers=2, batch_size=10000, ingest_workers=None, max_finished=100):
+        """Constructor.
+
+           Arguments:
+           cache -- the PayloadCache whose payloads for a file are dropped once it is uploaded.
+           max_workers -- number of uploads processed at the same time.
+           batch_size -- number of documents sent in each insert.
+           ingest_workers -- number of parser processes per upload. Defaults to the number of CPUs.
+           max_finished -- number of finished jobs kept for status requests.
+        """
+        self.cache = cache
+        self.batch_size = batch_size
+        self.ingest_workers = ingest_workers
+        self.max_finished = max_finished
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="upload")
+        #Job ID -> job, oldest first.
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def submit(self, filename, path, collection, layout=eventstore.DOCUMENTS):
+        """Queues an upload, unless the file already has one queued or running.
+
+           Arguments:
+           filename -- the name the file is stored under, without its extension.
+           path -- path of the spooled upload. The job takes ownership of it and removes it when done.
+           collection -- the MongoDB collection to ingest the file into.
+           layout -- the storage layout, eventstore.DOCUMENTS or eventstore.PACKED.
+
+           Returns:
+           The UploadJob, or None if the file is already being uploaded, in which case path is left alone.
+        """
+        job = self.reserve(filename)
+        if job is not None:
+            self.start(job, path, collection, layout)
+        return job
+
+    def reserve(self, filename):
+        """Registers a queued job for a file, unless it already has one queued or running. The check and the
+           registration are made under one lock, so of two concurrent uploads of a file only one gets a job,
+           and the file can then be spooled before the job is started or cancelled.
+
+           Arguments:
+           filename -- the name the file is stored under, without its extension.
+
+           Returns:
+           The UploadJob, or None if the file is already being uploaded.
+        """
+        with self._lock:
+            if self._active(filename):
+                return None
+            job = UploadJob(filename)
+            self._jobs[job.id] = job
+            finished = [j for j in self._jobs.values() if j.state in (DONE, FAILED)]
+            for old in finished[:max(0, len(finished) - self.max_finished)]:
+                del self._jobs[old.id]
+        return job
+
+    def start(self, job, path, collection, layout=eventstore.DOCUMENTS):
+        """Starts a job registered by reserve.
+
+           Arguments:
+           job -- the UploadJob.
+           path -- path of the spooled upload. The job takes ownership of it and removes it when done.
+           collection -- the MongoDB collection to ingest the file into.
+           layout -- the storage layout, eventstore.DOCUMENTS or eventstore.PACKED.
+        """
+        job.path = path
+        job.upload_bytes = os.path.getsize(path)
+        self._executor.submit(self._run, job, collection, layout)
+
+    def cancel(self, job):
+        """Forgets a job registered by reserve that will not be started, freeing its file for another upload.
+        """
+        with self._lock:
+            self._jobs.pop(job.id, None)
+
+    def get(self, job_id):
+        """Returns the job with the given ID, or None if there is no such job.
+        """
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def active(self, filename):
+        """Returns whether an upload of the given file is queued or running.
+        """
+        with self._lock:
+            return self._active(filename)
+
+    def _active(self, filename):
+        return any(j.filename == filename and j.state in (QUEUED, RUNNING) for j in self._jobs.values())
+
+    def shutdown(self):
+        """Stops the worker threads once the queued jobs are done.
+        """
+        self._executor.shutdown(wait=True)
+
+    def _run(self, job, collection, layout):
+        job.state = RUNNING
+        job.started = time.time()
+        state = FAILED
+        try:
+            ingest.ingest_file(job.path, collection, self.batch_size, self.ingest_workers, progress=job.update,
+                               layout=layout)
+            state = DONE
+        except Exception as e:
+            logger.exception("Upload of %s failed", job.filename)
+            if layout == eventstore.PACKED:
+                packedstore.drop(collection)
+            else:
+                collection.drop()
+            job.error = str(e) or type(e).__name__
+        finally:
+            os.remove(job.path)
+            #Drop any payloads cached for an earlier upload under the same name.
+            self.cache.invalidate(job.filename)
+            job.finished = time.time()
+            job.state = state
@@ -0,0 +1,215 @@
+"""Packed storage layout of uploaded events. Each event is stored as a single document holding its header
+   fields and its particles and vertices as packed little-endian binary columns, the fields of the
+   hepmcio_columnar PARTICLE_DTYPE and VERTEX_DTYPE rows: barcodes, PDG IDs, statuses, momenta, masses,
+   charges, production/decay vertex links and vertex positions. Loading an event is then a single indexed read
+   of one document instead of two cursors over thousands of small ones, and the columns are wrapped in NumPy
+   arrays without copying or parsing anything. The event is served as a hepmcio_columnar.ColumnarEvent, so
+   the selection, ancestor walks and encoders work on it unchanged.
+
+   Events whose columns would not fit in a MongoDB document are spilled to GridFS, the event document then
+   holding only the header and the ID of the GridFS file. Collections stored one document per particle and
+   vertex can be converted in place with migrate, or from the command line:
+
+   Usage: python -m app.packedstore [--uri URI] filename [filename ...]
+
+   Functions:
+   is_packed -- returns whether an event document is in the packed layout.
+   event_document -- builds the packed document for an event.
+   event_documents -- as event_document, as a list in the form of hepmcio_json.event_documents.
+   spill -- moves the columns of an oversized event document to GridFS.
+   event_from_document -- rebuilds an event from its packed document.
+   drop -- drops a file's collection along with any events it spilled to GridFS.
+   migrate -- converts a file's collection from the per-particle layout to the packed layout.
+   main -- command line entry point.
+   """
+
+import argparse
+import gridfs
+import numpy as np
+import pymongo
+from app import config, eventstore, hepmcio, hepmcio_columnar, hepmcio_json, timing
+
+#Stored column types, fixed to little-endian so that stored events read back the same on any machine.
+PARTICLE_DTYPE = hepmcio_columnar.PARTICLE_DTYPE.newbyteorder("<")
+VERTEX_DTYPE = hepmcio_columnar.VERTEX_DTYPE.newbyteorder("<")
+
+#Events whose columns take more bytes than this are spilled to GridFS, leaving room under MongoDB's 16 MB
+#document limit for the header fields.
+MAX_COLUMN_BYTES = 15*1024*1024
+
+#GridFS bucket shared by all files' spilled events; each GridFS file is named after the collection it belongs to.
+GRIDFS_BUCKET = "packed_events"
+
+#Events per insert when migrating. Each event is one document of up to MAX_COLUMN_BYTES, so batches stay small.
+BATCH_EVENTS = 64
+
+#Suffix of the collection a file is packed into while it is migrated, before it replaces the original.
+MIGRATION_SUFFIX = ".packing"
+
+
+def is_packed(document):
+    """Returns whether an event document is in the packed layout.
+    """
+    return document.get("layout") == eventstore.PACKED
+
+
+def event_document(evt):
+    """Builds the packed document for an event. Missing charges are filled in from the shared hepmcio particle
+       table, as hepmcio_json.particle_document does.
+
+       Arguments:
+       evt -- the hepmcio event.
+
+       Returns:
+       The event document of hepmcio_json.event_document with the "layout", the particle and vertex counts
+       "nparticles" and "nvertices", and the columns as bytes in "particles" and "vertices".
+    """
+    store = hepmcio_columnar.ColumnarEvents.from_events([evt])
+    particles = store.particles.astype(PARTICLE_DTYPE)
+    missing = np.isnan(particles["charge"])
+    particles["charge"][missing] = hepmcio.particle_table().charges(particles["pid"][missing])
+    document = hepmcio_json.event_document(evt)
+    document.update({"layout":eventstore.PACKED, "nparticles":len(particles), "nvertices":len(store.vertices),
+                     "particles":particles.tobytes(), "vertices":store.vertices.astype(VERTEX_DTYPE).tobytes()})
+    return document
+
+
+def event_documents(evt):
+    """Builds the packed document for an event, in a list like hepmcio_json.event_documents returns, so that it
+       can be used wherever per-particle documents are, e.g. as the build function of hepmcio_parallel.read_events.
+    """
+    return [event_document(evt)]
+
+
+def _bucket(database):
+    return gridfs.GridFS(database, GRIDFS_BUCKET)
+
+
+def _delete_spilled(database, name):
+    "Delete the events of a file spilled to GridFS"
+    bucket = _bucket(database)
+    for spilled in bucket.find({"filename":name}):
+        bucket.delete(spilled._id)
+
+
+def spill(collection, document, max_bytes=MAX_COLUMN_BYTES):
+    """Moves the columns of a packed event document to GridFS if they take more than max_bytes, replacing them
+       in the document with the ID of the GridFS file under "gridfs". Smaller documents are left alone.
+
+       Arguments:
+       collection -- the MongoDB collection the document is stored in.
+       document -- the packed event document, modified in place.
+       max_bytes -- the largest size of the columns kept in the document.
+
+       Returns:
+       Whether the document was spilled.
+    """
+    if len(document["particles"]) + len(document["vertices"]) <= max_bytes:
+        return False
+    data = document.pop("particles") + document.pop("vertices")
+    document["gridfs"] = _bucket(collection.database).put(data, filename=collection.name)
+    return True
+
+
+def event_from_document(collection, document):
+    """Rebuilds an event from its packed document. The particle and vertex arrays are read-only views over the
+       stored bytes, read from GridFS first if the event was spilled.
+
+       Arguments:
+       collection -- the MongoDB collection the document is stored in.
+       document -- the packed event document.
+
+       Returns:
+       A read-only hepmcio_columnar.ColumnarEvent.
+    """
+    nparticles, nvertices = document["nparticles"], document["nvertices"]
+    if "gridfs" in document:
+        with timing.stage("gridfs") as stage:
+            data = _bucket(collection.database).get(document["gridfs"]).read()
+            stage.count(bytes=len(data))
+        particles = np.frombuffer(data, PARTICLE_DTYPE, nparticles)
+        vertices = np.frombuffer(data, VERTEX_DTYPE, nvertices, particles.nbytes)
+    else:
+        particles = np.frombuffer(document["particles"], PARTICLE_DTYPE, nparticles)
+        vertices = np.frombuffer(document["vertices"], VERTEX_DTYPE, nvertices)
+    with timing.stage("decode", particles=nparticles, vertices=nvertices):
+        events = np.array([hepmcio_columnar.event_row(hepmcio_json.as_event(document))],
+                          dtype=hepmcio_columnar.EVENT_DTYPE)
+        store = hepmcio_columnar.ColumnarEvents.from_arrays(events, particles, vertices,
+                                                            np.array([0, nparticles]), np.array([0, nvertices]))
+        return store.event(0)
+
+
+def drop(collection):
+    """Drops a file's collection along with any of its events spilled to GridFS.
+    """
+    _delete_spilled(collection.database, collection.name)
+    collection.drop()
+
+
+def migrate(collection, max_bytes=MAX_COLUMN_BYTES, batch_events=BATCH_EVENTS):
+    """Converts a file's collection from one document per particle and vertex to the packed layout. The events
+       are packed one at a time into a new collection, which then replaces the original in a single rename, so
+       the file stays readable throughout and is left as it was if the migration fails. Collections already in
+       the packed layout are left alone. Raises ValueError, before writing anything, if any of the events the
+       manifest counts are missing.
+
+       Arguments:
+       collection -- the MongoDB collection for a file.
+       max_bytes -- events whose columns are larger than this are spilled to GridFS.
+       batch_events -- number of events sent in each insert.
+
+       Returns:
+       The file's new manifest, or None if the collection holds no events.
+    """
+    manifest = eventstore.get_manifest(collection)
+    if manifest is None or manifest.get("layout") == eventstore.PACKED:
+        return manifest
+    missing = set(range(1, manifest["events"] + 1)) - set(collection.distinct("no", {"type":"event"}))
+    if missing:
+        raise ValueError("%s is missing events %s" % (collection.name, sorted(missing)))
+    target = collection.database[collection.name + MIGRATION_SUFFIX]
+    #Clear out anything left by an earlier migration that failed part way.
+    target.drop()
+    _delete_spilled(collection.database, collection.name)
+    eventstore.ensure_indexes(target)
+    builder = eventstore.ManifestBuilder(eventstore.PACKED)
+    batch = []
+    for no in range(1, manifest["events"] + 1):
+        event = eventstore.find_event(collection, no)
+        evt = hepmcio_json.event_from_documents(event, eventstore.find_particles(collection, event["barcode"]),
+                                                eventstore.find_vertices(collection, event["barcode"]))
+        document = event_document(evt)
+        #Spilled events are named after the original collection, which the migrated one is renamed to.
+        spill(collection, document, max_bytes)
+        batch.append(document)
+        builder.add_documents([document])
+        if len(batch) >= batch_events:
+            target.insert_many(batch, ordered=False)
+            batch = []
+    if batch:
+        target.insert_many(batch, ordered=False)
+    document = builder.document()
+    target.insert_one(dict(document))
+    target.rename(collection.name, dropTarget=True)
+    return document
+
+
+def main(argv=None):
+    """Command line entry point, see the module usage.
+    """
+    parser = argparse.ArgumentParser(description="Convert uploaded files to the packed storage layout.")
+    parser.add_argument("filenames", nargs="+", help="names of the files to convert, as uploaded")
+    parser.add_argument("--uri", default=config.Config.MONGO_URI, help="MongoDB URI of the app's database")
+    args = parser.parse_args(argv)
+    database = pymongo.MongoClient(args.uri).get_default_database()
+    for filename in args.filenames:
+        manifest = migrate(database[filename])
+        if manifest is None:
+            print("%s: no events, skipped." % filename)
+        else:
+            print("%s: %d events packed." % (filename, manifest["events"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""Background prefetching of Visualiser payloads. Users almost always step from event N to N+1 or N-1, so
+   once event N is served its neighbours are computed in a thread pool and left in the payload cache for
+   the next request.
+
+   Classes:
+   Prefetcher -- schedules payload computations for neighbouring events in a bounded thread pool.
+   """
+
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from app import eventview, selection
+
+logger = logging.getLogger(__name__)
+
+
+class Prefetcher(object):
+    """Computes payloads for neighbouring events in a thread pool and stores them in a PayloadCache. At most
+       max_pending prefetches are queued or running at a time; when a new event is requested, queued prefetches
+       for other events of the same file are stale and are cancelled, so fast scrolling does not pile up work.
+
+       Methods:
+       prefetch -- schedules payloads for the given events of a file.
+       prefetch_neighbours -- schedules payloads for the events either side of an event.
+       wait -- waits for an in-flight prefetch of a payload to finish.
+       shutdown -- stops the worker threads.
+    """
+    def __init__(self, cache, max_workers=2, max_pending=8):
+        """Constructor.
+
+           Arguments:
+           cache -- the PayloadCache prefetched payloads are stored in.
+           max_workers -- number of worker threads.
+           max_pending -- maximum number of prefetches queued or running at a time.
+        """
+        self.cache = cache
+        self.max_pending = max_pending
+        self.submitted = 0
+        self.cancelled = 0
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="prefetch")
+        #Cache key -> future, oldest first.
+        self._pending = OrderedDict()
+        self._lock = threading.Lock()
+
+    def prefetch(self, collection, nos, cut=selection.DEFAULT_CUT, binary=False):
+        """Schedules the payloads for the given events of a file, unless they are already cached or in flight.
+           Queued prefetches for any other events of the file are cancelled.
+
+           Arguments:
+           collection -- the MongoDB collection for the file.
+           nos -- the numbers of the events to prefetch. Numbers below 1 are ignored.
+           cut -- the selection.Cut picking interesting particles.
+           binary -- whether to prefetch the binary payloads rather than the JSON ones.
+        """
+        wanted = OrderedDict((eventview.view_key(collection, no, cut, binary), no) for no in nos if no >= 1)
+        with self._lock:
+            for key, future in list(self._pending.items()):
+                if future.done():
+                    del self._pending[key]
+                elif key[0] == collection.name and key not in wanted and future.cancel():
+                    del self._pending[key]
+                    self.cancelled += 1
+            for key, no in wanted.items():
+                if key in self._pending or self.cache.contains(key):
+                    continue
+                while len(self._pending) >= self.max_pending:
+                    _, oldest = self._pending.popitem(last=False)
+                    if oldest.cancel():
+                        self.cancelled += 1
+                self._pending[key] = self._executor.submit(self._compute, collection, no, cut, binary)
+                self.submitted += 1
+
+    def prefetch_neighbours(self, collection, no, maxno, cut=selection.DEFAULT_CUT, binary=False):
+        """Schedules the payloads for events no+1 and no-1 of a file, those of them numbered 1 to maxno.
+
+           Arguments:
+           collection -- the MongoDB collection for the file.
+           no -- the number of the event being viewed.
+           maxno -- the number of events in the file.
+           cut, binary -- as for prefetch.
+        """
+        self.prefetch(collection, [n for n in (no + 1, no - 1) if 1 <= n <= maxno], cut, binary)
+
+    def wait(self, key, timeout=None):
+        """Waits for an in-flight prefetch of the payload with the given cache key, so a request does not compute
+           the same payload a second time. Returns immediately if there is none.
+        """
+        with self._lock:
+            future = self._pending.get(key)
+        if future is not None and not future.cancelled():
+            try:
+                future.result(timeout)
+            except Exception:
+                pass
+
+    def shutdown(self):
+        """Cancels queued prefetches and stops the worker threads.
+        """
+        with self._lock:
+            for future in self._pending.values():
+                future.cancel()
+            self._pending.clear()
+        self._executor.shutdown(wait=True)
+
+    def _compute(self, collection, no, cut, binary):
+        "Compute a payload straight into the cache, leaving the cache's hit/miss counters to real requests"
+        key = eventview.view_key(collection, no, cut, binary)
+        if self.cache.contains(key):
+            return
+        try:
+            body = eventview.encoded_event_view(collection, no, cut, binary)
+            if body is not None:
+                self.cache.put(key, body)
+        except Exception:
+            logger.exception("Prefetch of event %d in %s failed", no, collection.name)
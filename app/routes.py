@@ -1,13 +1,55 @@
-from app import app, mongo
-from flask import render_template, request, jsonify
-import operator
+from app import app, mongo, event_cache, prefetcher, upload_jobs, metrics, profiler
+from flask import render_template, request, jsonify, abort, g
 from werkzeug import secure_filename
-from app import hepmcio_json
 from app import hepmcio
+from app import ingest
+from app import eventstore
+from app import eventview
+from app import selection
+from app import eventbinary
+from app import timing
+import gzip
 import os
-import json
-import io
-from functools import reduce
+import tempfile
+import time
+
+@app.before_request
+def start_timing():
+	"""
+	Starts timing the stages of a request (see timing.stage), and profiling it if PROFILE_DIR is set.
+	"""
+	g.request_start = time.perf_counter()
+	timing.start()
+	if profiler is not None:
+		g.profile = profiler.start()
+
+@app.after_request
+def finish_timing(response):
+	"""
+	Sends the stage timings of a request back in a Server-Timing header, which browsers show in their developer
+	tools, and adds them to the metrics. Slow requests are dumped by the profiler when profiling is on.
+	"""
+	timings = timing.stop()
+	if "request_start" not in g:
+		return response
+	seconds = time.perf_counter() - g.request_start
+	if timings is not None:
+		response.headers["Server-Timing"] = timings.server_timing(seconds)
+	if request.endpoint is not None:
+		metrics.observe(request.endpoint, seconds, timings, response.status_code)
+	profile = g.pop("profile", None)
+	if profile is not None:
+		profiler.finish(profile, request.endpoint or "unmatched", seconds)
+	return response
+
+@app.teardown_request
+def stop_profile(exc):
+	"""
+	Stops the profile of a request that ended without a response.
+	"""
+	profile = g.pop("profile", None)
+	if profile is not None:
+		profile.disable()
 
 @app.route('/')
 @app.route('/index')
@@ -27,55 +69,86 @@ def upload():
 @app.route('/uploader', methods=['GET', 'POST'])
 def uploader():
 	"""
-	A view for the file upload action. Retrieves file from a form, parses it using HepMCIO and uploads
-	the parsed data to the database.
+	A view for the file upload action. Retrieves file from a form and queues it to be parsed using HepMCIO
+	and uploaded to the database in the background.
 
 	Multiple checks are performed to see whether the file upload is well-formed.
 
+	HTTP request:
+	file -- the HepMC file, optionally compressed.
+	layout -- the storage layout, "documents" or "packed" (see eventstore), STORAGE_LAYOUT by default.
+
 	Returns:
-	response string -- a string indicating the outcome of the upload.
+	The upload job's status as JSON (see upload_status), with status 202, or a string indicating why the upload
+	was refused.
 	"""
 	if request.method == 'POST':
 		
 		if "file" not in request.files:
-			return "No data in file."
+			return "No data in file.", 400
 
 		File = request.files['file']
+		layout = request.form.get("layout") or app.config["STORAGE_LAYOUT"]
+		if layout not in eventstore.LAYOUTS:
+			return "Unknown storage layout.", 400
 		
 		if File.filename == "":
-			return "No file selected."
+			return "No file selected.", 400
 		
-		filename, ext = secure_filename(File.filename).split('.')
+		#Compressed files keep their .hepmc extension before the compression suffix, e.g. run.hepmc.gz. The
+		#compression itself is detected from the file contents when it is read.
+		name = secure_filename(File.filename)
+		for suffix in hepmcio.COMPRESSION_SUFFIXES:
+			if name.endswith(suffix):
+				name = name[:-len(suffix)]
+				break
+		filename, ext = os.path.splitext(name)
 		#Check if file stream exists and file tpye correct.
-		if File and ext == "hepmc":
-			#The file is a byte stream by default which is not compatible with the current version of hepmcio.
-			string_stream = io.StringIO(File.read().decode('utf-8'))
+		if File and filename and ext == ".hepmc":
+			#Registering the job first means that of two concurrent uploads of a file only one goes ahead.
+			job = upload_jobs.reserve(filename)
+			if job is None:
+				return "File is already being uploaded.", 409
+			#Each collection contains all the data in a file.
+			if filename in mongo.db.collection_names():
+				upload_jobs.cancel(job)
+				return "File already in database.", 409
+			#Spool the upload to disk so that it can be split between parser processes, and leave the
+			#parsing and insertion to a background job so the request returns straight away.
+			fd, path = tempfile.mkstemp(suffix=".hepmc")
+			try:
+				with os.fdopen(fd, "wb") as f:
+					File.save(f)
+			except Exception:
+				os.remove(path)
+				upload_jobs.cancel(job)
+				raise
+			upload_jobs.start(job, path, mongo.db[filename], layout)
+			return jsonify(job.status()), 202
 
-			#Get all events from file and jsonify them.
-			events = hepmcio.HepMCReader(string_stream).all_events()
-			hepMCEncoder = hepmcio_json.HepMCJSONEncoder()
-			jsonified = [hepMCEncoder.encode(event) for event in events]
+		return "Incorrect file type.", 400
 
-			#Each collection contains all the data in a file.
-			if filename not in mongo.db.collection_names():
-				collection = mongo.db[filename]
-				jsonDecoder = json.JSONDecoder()
-
-				#MongoDB takes in Python objects and not JSON strings, so have to decode before adding documents.
-				for jsonObject in jsonified:
-					jsonEvent = jsonDecoder.decode(jsonObject.evt)
-					jsonParticles = [jsonDecoder.decode(p) for p in jsonObject.particles]
-					jsonVertices = [jsonDecoder.decode(v) for v in jsonObject.vertices]
-
-					collection.insert_one(jsonEvent)
-					collection.insert_many(jsonParticles)
-					collection.insert_many(jsonVertices)
-		
-				return "Succesfully uploaded file."
-			
-			return "File already in database."
+@app.route('/uploader/<string:job_id>')
+def upload_status(job_id):
+	"""
+	A view for polling the progress of an upload job.
 
-		return "Incorrect file type."
+	Arguments:
+	job_id -- the ID returned by the uploader.
+
+	Returns:
+	A JSON object containing:
+	id, filename -- the job ID and the name the file is stored under.
+	state -- one of "queued", "running", "done" or "failed".
+	events, bytes_read -- the numbers of events and uncompressed bytes processed so far.
+	upload_bytes -- the size of the uploaded file.
+	elapsed, events_per_second, mb_per_second -- the job's running time in seconds and its throughput.
+	error -- the reason the job failed, or null.
+	"""
+	job = upload_jobs.get(job_id)
+	if job is None:
+		abort(404)
+	return jsonify(job.status())
 
 
 @app.route("/visualiser/<string:filename>/")
@@ -87,49 +160,44 @@ def visualiser(filename):
 	Arguments:
 	filename -- the name of the required file provided in the URL.
 
+	HTTP request:
+	Optional selection cuts, see selection.from_args.
+
 	Returns:
 	file - filename provided in the URL.
 	particles - an array of interesting particles from the first event in the file.
 	vertices - an array of vertices from the first event in the file.
+	bundles - bundles of the soft particles dropped by a max_tracks budget, see selection.from_args.
+	maxno - the number of events in the file, from the file's manifest or event index.
+	cuts - the selection cuts from the URL, passed on to later get_event calls.
 	
 	Returned to the render_template call.
 	"""
+	try:
+		cut = selection.from_args(request.args)
+	except ValueError:
+		abort(400)
+	#A file still being uploaded has an incomplete collection.
+	if upload_jobs.active(filename):
+		abort(409)
 	collection = mongo.db[filename]
-	jsonEncoder = hepmcio_json.HepMCJSONEncoder()
-	hepMCDecoder = hepmcio_json.HepMCJSONDecoder()
-	jsonDecoder = json.JSONDecoder()
-	#Get first event data in file and decode to HepMCIO objects.
-	event = collection.find_one({"type":"event", "no":1}, {"_id":False})
-	particleJson = collection.find({"type":"particle", "event":event["barcode"]}, {"_id":False})
-	particles = []
-	for particle in particleJson:
-		particles.append(jsonEncoder.encode(particle))
-	
-	vertices = []
-	vertexJson = collection.find({"type":"vertex", "event":event["barcode"]}, {"_id":False})
-	for vertex in vertexJson:
-		vertices.append(jsonEncoder.encode(vertex))
-	event = jsonEncoder.encode(event)
+	#Only reads the collection, so viewing a file on disk leaves its name free for an upload.
+	manifest = eventstore.get_manifest(collection)
+	if manifest is not None:
+		#Get the interesting particles of the first event, i.e. particles passing the cuts and their ancestors.
+		view = eventview.event_view(collection, 1, cut)
+		maxno = manifest["events"]
+		prefetcher.prefetch_neighbours(collection, 1, maxno, cut)
+	else:
+		#Files that were never uploaded can still be read straight from the event files directory.
+		path = eventview.event_file_path(app.config["EVENT_FILES_DIR"], secure_filename(filename))
+		if path is None:
+			abort(404)
+		view = eventview.file_event_view(path, 1, cut)
+		maxno = eventview.file_event_count(path)
 	
-	
-	#Decode event to find interesting particles, i.e. particles above PT_CUTOFF and their ancestors..
-	eventObject = hepmcio_json.EventJSONObject(event, particles, vertices)
-	decodedEvent = hepMCDecoder.decode(eventObject)
-
-	PT_CUTOFF = 0.0
-	intParticles = [particle for particle in decodedEvent.particles.values() if particle.status!=1 and \
-		particle.mom[0]**2 + particle.mom[1]**2 > PT_CUTOFF**2]
-	#Build a single list from the individual particle ancestor lists.
-	intParticleAncestors = reduce(operator.concat, [hepmcio.get_ancestors(particle)[:-1] for particle in intParticles])
-
-	particles = []
-	for particle in (intParticles + intParticleAncestors):
-		#Encode particle to JSON, decode to Python dicts.
-		particles.append(jsonDecoder.decode(jsonEncoder.encode(particle)))
-	#Decode to Python dicts.
-	vertices = list(map(jsonDecoder.decode, vertices))
-	
-	return render_template("visualiser.html", title="Visualiser", file=filename, particles=particles, vertices=vertices)
+	return render_template("visualiser.html", title="Visualiser", file=filename, particles=view["particles"],
+		vertices=view["vertices"], bundles=view["bundles"], maxno=maxno, cuts=request.args.to_dict())
 	
 @app.route('/visualiser/get_event', methods=['GET'])
 def get_event():
@@ -139,46 +207,122 @@ def get_event():
 	HTTP request:
 	no -- number of the event to be retrieved.
 	filename - filename for the file.
+	Optional selection cuts such as pt_min, abs_eta_max, status or pid, see selection.from_args. For very large
+	events, max_tracks keeps only that many of the selected particles ranked by pt or energy (rank), plus their
+	ancestors, and bundle=1 summarises the rest in one bundle per particle type.
+	format -- "binary" for the packed binary format of eventbinary, which is also chosen when the Accept
+	header prefers eventbinary.MIMETYPE to JSON.
 
 	Returns:
-	A dict containing:
+	A JSON object containing:
+	no -- the number of the event.
 	particles -- an array of interesting particles from the event.
-	vertices -- an array of interesting vertices from the event.
+	vertices -- an array of vertices from the event.
+	bundles -- an array of bundles of soft particles, each with its type, count and summed momentum.
+	Or, in the binary format, the same event as packed columns, gzip content encoded where the client allows.
 	"""
 	#Get HTTP query args.
-	no = request.args.get('no')
+	no = request.args.get('no', type=int)
 	filename = request.args.get('filename')
+	if no is None or not filename:
+		abort(404)
+	try:
+		cut = selection.from_args(request.args)
+	except ValueError:
+		abort(400)
+	if upload_jobs.active(filename):
+		abort(409)
+	accept = request.accept_mimetypes
+	binary = request.args.get("format") == "binary" or accept[eventbinary.MIMETYPE] > accept["application/json"]
 	collection = mongo.db[filename]
+	#Served from the payload cache when possible; otherwise the event is looked up through the (type, no) index.
+	#If the event is already being prefetched, wait for that rather than computing it twice.
+	with timing.stage("prefetch_wait"):
+		prefetcher.wait(eventview.view_key(collection, no, cut, binary))
+	body = eventview.cached_event_view(collection, no, event_cache, cut, binary)
+	#Only reads the collection, so viewing a file on disk leaves its name free for an upload.
+	manifest = eventstore.get_manifest(collection)
+	if body is None and manifest is None:
+		#Not uploaded, so read the event straight from disk using the file's byte-offset index.
+		path = eventview.event_file_path(app.config["EVENT_FILES_DIR"], secure_filename(filename))
+		if path is not None:
+			body = eventview.cached_file_event_view(path, no, event_cache, cut, binary)
+	if body is None:
+		abort(404)
+	if manifest is not None:
+		#Warm up the neighbouring events, which the user is most likely to step to next. Files on disk are not
+		#prefetched, as the prefetcher reads from the database.
+		prefetcher.prefetch_neighbours(collection, no, manifest["events"], cut, binary)
+	if not binary:
+		return app.response_class(body, mimetype="application/json")
+	return binary_response(body, eventbinary.MIMETYPE)
 
-	jsonEncoder = hepmcio_json.HepMCJSONEncoder()
-	hepMCDecoder = hepmcio_json.HepMCJSONDecoder()
-	jsonDecoder = json.JSONDecoder()
-	#Everything below same as in the Visualiser view.
-	event = collection.find_one({"type":"event", "no":int(no)}, {"_id":False})
-	particleJson = collection.find({"type":"particle", "event":event["barcode"]}, {"_id":False})
-	particles = []
-	for particle in particleJson:
-		particles.append(jsonEncoder.encode(particle))
-	vertices = []
-	vertexJson = collection.find({"type":"vertex", "event":event["barcode"]}, {"_id":False})
-	for vertex in vertexJson:
-		vertices.append(jsonEncoder.encode(vertex))
-	event = jsonEncoder.encode(event)
-
-	eventObject = hepmcio_json.EventJSONObject(event, particles, vertices)
-	
-	decodedEvent = hepMCDecoder.decode(eventObject)
+@app.route('/visualiser/get_trajectories', methods=['GET'])
+def get_trajectories():
+	"""
+	A view for the Visualiser's spacetime view. Propagates the interesting particles of an event through a
+	solenoid field on the server, so that the browser only has to draw the tracks.
 
-	PT_CUTOFF = 0.0
-	intParticles = [particle for particle in decodedEvent.particles.values() if particle.status!=1 and \
-		particle.mom[0]**2 + particle.mom[1]**2 > PT_CUTOFF**2]
-	
-	intParticleAncestors = reduce(operator.concat, [hepmcio.get_ancestors(particle)[:-1] for particle in intParticles])
+	HTTP request:
+	no -- number of the event.
+	filename - filename for the file.
+	Optional selection cuts, as for get_event.
+	field -- the field along the beam axis in tesla, TRAJECTORY_FIELD by default.
+	steps -- the number of segments per track, TRAJECTORY_STEPS by default, at most TRAJECTORY_MAX_STEPS.
 
-	particles = []
-	for particle in (intParticles + intParticleAncestors):
-		particles.append(jsonDecoder.decode(jsonEncoder.encode(particle)))
-	
-	vertices = list(map(jsonDecoder.decode, vertices))
-	
-	return {"particles":jsonEncoder.encode(particles), "vertices":jsonEncoder.encode(vertices)}
\ No newline at end of file
+	Returns:
+	The tracks in the binary format of eventbinary.encode_trajectories, in the same order as the particles
+	returned by get_event for the same cuts, gzip content encoded where the client allows.
+	"""
+	no = request.args.get('no', type=int)
+	filename = request.args.get('filename')
+	if no is None or not filename:
+		abort(404)
+	try:
+		cut = selection.from_args(request.args)
+	except ValueError:
+		abort(400)
+	field = request.args.get("field", app.config["TRAJECTORY_FIELD"], type=float)
+	steps = request.args.get("steps", app.config["TRAJECTORY_STEPS"], type=int)
+	length = app.config["TRAJECTORY_LENGTH"]
+	if not 1 <= steps <= app.config["TRAJECTORY_MAX_STEPS"] or not abs(field) < float("inf"):
+		abort(400)
+	if upload_jobs.active(filename):
+		abort(409)
+	collection = mongo.db[filename]
+	body = eventview.cached_trajectories(collection, no, event_cache, cut, field, steps, length)
+	if body is None and not eventstore.is_uploaded(collection):
+		path = eventview.event_file_path(app.config["EVENT_FILES_DIR"], secure_filename(filename))
+		if path is not None:
+			body = eventview.cached_file_trajectories(path, no, event_cache, cut, field, steps, length)
+	if body is None:
+		abort(404)
+	return binary_response(body, eventbinary.TRAJECTORY_MIMETYPE)
+
+def binary_response(body, mimetype):
+	"""
+	Builds the response for a gzip-compressed binary payload. Binary payloads are cached compressed, so they
+	are sent as they are to any client accepting gzip and decompressed for the others.
+	"""
+	response = app.response_class(mimetype=mimetype)
+	if "gzip" in request.accept_encodings:
+		response.set_data(body)
+		response.headers["Content-Encoding"] = "gzip"
+	else:
+		response.set_data(gzip.decompress(body))
+	response.vary.update(("Accept", "Accept-Encoding"))
+	return response
+
+@app.route('/metrics')
+def get_metrics():
+	"""
+	A view for monitoring the app's performance.
+
+	Returns:
+	A JSON object containing:
+	endpoints -- for each endpoint, a histogram of its request durations in seconds (total), its responses by
+	status code and, for each timed stage of its requests (see timing.stage), a histogram of the stage's
+	duration per request, its number of calls and the totals of its counts.
+	cache -- the payload cache's counters, see PayloadCache.stats.
+	"""
+	return jsonify({"endpoints":metrics.snapshot(), "cache":event_cache.stats()})
@@ -0,0 +1,360 @@
+"""Vectorized kinematic selection over hepmcio events. The particle kinematics of an event are gathered into
+   NumPy arrays once, and cuts are composable predicates evaluated as array expressions that return boolean
+   masks over the event's particles.
+
+   Cuts combine with & (and), | (or) and ~ (not), e.g.
+
+       cut = pt(min=5.0) & abs_eta(max=2.5) & ~status(1)
+       particles = select(evt, cut)
+
+   Every cut carries a hashable key describing it, so cut values can be part of cache keys.
+
+   For very large events a Budget caps the number of tracks kept, ranking the particles passing a cut by pT
+   or energy; the soft particles left out can be summarised per track type by bundles.
+
+   Classes:
+   EventArrays -- NumPy arrays of the particle kinematics of an event.
+   Cut -- a composable predicate over EventArrays.
+   Budget -- a cut keeping the highest ranked particles passing another cut.
+
+   Functions:
+   pt, eta, abs_eta, phi, mass -- range cuts on kinematic quantities.
+   status, pid -- membership cuts on status codes and PDG IDs.
+   budget -- caps the number of particles passing a cut.
+   mask -- evaluates a cut on an event.
+   select -- returns the particles of an event passing a cut.
+   track_types -- classifies particles into the Visualiser's track types.
+   bundles -- sums the particles of each track type, e.g. the soft particles dropped by a Budget.
+   from_args -- builds a cut from query parameters.
+   """
+
+import numpy as np
+
+#Transverse momentum cut for interesting particles.
+PT_CUTOFF = 0.0
+
+#Track types drawn by the Visualiser, indexed by the codes returned by track_types.
+TRACK_TYPES = ("photon", "lepton", "nu", "hadron")
+
+
+class EventArrays(object):
+    """The particle kinematics of an event as NumPy arrays, in the order of evt.particles.values() or of a
+       given subset of the particles. Derived quantities (pt, eta, phi) are computed on first use, as are the
+       splits of track budgets (see Budget), which are then shared by every evaluation on the same arrays.
+
+       Attributes:
+       particles -- the particles, as a list in array order.
+       barcode, pid, status -- integer arrays.
+       px, py, pz, E, mass -- float arrays. Missing masses are NaN.
+    """
+    def __init__(self, evt, particles=None):
+        self.particles = list(evt.particles.values() if particles is None else particles)
+        store = getattr(evt, "store", None)
+        if store is not None:
+            #Columnar events already hold the arrays; take a slice instead of visiting every particle.
+            rows = store.particles[[p._row for p in self.particles]]
+            self.barcode, self.pid, self.status = rows["barcode"], rows["pid"], rows["status"]
+            self.px, self.py, self.pz, self.E = rows["px"], rows["py"], rows["pz"], rows["E"]
+            self.mass = rows["mass"]
+            return
+        n = len(self.particles)
+        self.barcode = np.fromiter((p.barcode for p in self.particles), np.int64, n)
+        self.pid = np.fromiter((p.pid for p in self.particles), np.int64, n)
+        self.status = np.fromiter((p.status if p.status is not None else 0 for p in self.particles), np.int64, n)
+        mom = np.array([p.mom for p in self.particles], dtype=np.float64).reshape(n, 4)
+        self.px, self.py, self.pz, self.E = mom[:, 0], mom[:, 1], mom[:, 2], mom[:, 3]
+        self.mass = np.fromiter((p.mass if p.mass is not None else np.nan for p in self.particles), np.float64, n)
+
+    @property
+    def pt(self):
+        if not hasattr(self, "_pt"):
+            self._pt = np.hypot(self.px, self.py)
+        return self._pt
+
+    @property
+    def eta(self):
+        "Pseudorapidity; particles along the beam axis get +-inf"
+        if not hasattr(self, "_eta"):
+            with np.errstate(divide="ignore", invalid="ignore"):
+                self._eta = np.arcsinh(self.pz / self.pt)
+            self._eta[np.isnan(self._eta)] = 0.0
+        return self._eta
+
+    @property
+    def phi(self):
+        if not hasattr(self, "_phi"):
+            self._phi = np.arctan2(self.py, self.px)
+        return self._phi
+
+
+class Cut(object):
+    """A predicate over the particles of an event, evaluated on EventArrays as a boolean mask.
+
+       Methods:
+       mask -- evaluates the cut.
+    """
+    def __init__(self, fn, key):
+        """Constructor.
+
+           Arguments:
+           fn -- function taking EventArrays and returning a boolean array.
+           key -- hashable description of the cut.
+        """
+        self._fn = fn
+        self.key = key
+
+    def mask(self, arrays):
+        """Evaluates the cut on EventArrays, returning a boolean array.
+        """
+        return self._fn(arrays)
+
+    def __and__(self, other):
+        return Cut(lambda a: self.mask(a) & other.mask(a), ("and", self.key, other.key))
+
+    def __or__(self, other):
+        return Cut(lambda a: self.mask(a) | other.mask(a), ("or", self.key, other.key))
+
+    def __invert__(self):
+        return Cut(lambda a: ~self.mask(a), ("not", self.key))
+
+    def __repr__(self):
+        return "Cut%r" % (self.key,)
+
+
+def _range(name, quantity, min, max):
+    "A cut requiring min < quantity and quantity < max, either bound optional"
+    def fn(arrays):
+        values = quantity(arrays)
+        rtn = np.ones(len(values), dtype=bool)
+        if min is not None:
+            rtn &= values > min
+        if max is not None:
+            rtn &= values < max
+        return rtn
+    return Cut(fn, (name, min, max))
+
+
+def pt(min=None, max=None):
+    """Cut on transverse momentum, min < pT < max.
+    """
+    return _range("pt", lambda a: a.pt, min, max)
+
+def eta(min=None, max=None):
+    """Cut on pseudorapidity, min < eta < max.
+    """
+    return _range("eta", lambda a: a.eta, min, max)
+
+def abs_eta(max=None, min=None):
+    """Cut on absolute pseudorapidity, min < |eta| < max.
+    """
+    return _range("abs_eta", lambda a: np.abs(a.eta), min, max)
+
+def phi(min=None, max=None):
+    """Cut on azimuthal angle, min < phi < max.
+    """
+    return _range("phi", lambda a: a.phi, min, max)
+
+def mass(min=None, max=None):
+    """Cut on generated mass, min < m < max. Particles without a mass fail any bound.
+    """
+    return _range("mass", lambda a: a.mass, min, max)
+
+def status(*codes):
+    """Cut keeping particles whose status code is one of the given codes.
+    """
+    codes = tuple(sorted(set(codes)))
+    return Cut(lambda a: np.isin(a.status, codes), ("status", codes))
+
+def pid(*pids, absolute=True):
+    """Cut keeping particles whose PDG ID is one of the given IDs. By default antiparticles are matched too.
+    """
+    pids = tuple(sorted(set(abs(p) for p in pids) if absolute else set(pids)))
+    return Cut(lambda a: np.isin(np.abs(a.pid) if absolute else a.pid, pids), ("pid", pids, absolute))
+
+
+class Budget(Cut):
+    """A cut keeping at most max_tracks of the particles passing a base cut, those ranked highest by pT or
+       energy. Ties are broken by the order of the particles. The particles passing the base cut but falling
+       outside the budget are the soft ones, which can be summarised by bundles when bundle is set.
+
+       Methods:
+       mask -- evaluates the cut.
+       soft -- returns the particles passing the base cut that are dropped by the budget.
+    """
+    #Quantity each particle is ranked by, by rank name.
+    RANKS = {"pt": lambda a: a.pt, "energy": lambda a: a.E}
+
+    def __init__(self, base, max_tracks, rank="pt", bundle=False):
+        """Constructor. Raises ValueError for a negative budget or an unknown rank.
+
+           Arguments:
+           base -- the Cut picking the candidate particles.
+           max_tracks -- the largest number of particles kept.
+           rank -- "pt" or "energy", the quantity the candidates are ranked by.
+           bundle -- whether the soft particles should be summarised in bundles.
+        """
+        if max_tracks < 0 or rank not in self.RANKS:
+            raise ValueError("Bad track budget %r ranked by %r." % (max_tracks, rank))
+        self.base = base
+        self.max_tracks = max_tracks
+        self.rank = rank
+        self.bundle = bundle
+        Cut.__init__(self, lambda a: self._split(a)[0], ("budget", base.key, max_tracks, rank, bundle))
+
+    def soft(self, arrays):
+        """Returns a boolean array of the particles passing the base cut that fall outside the budget.
+        """
+        return self._split(arrays)[1]
+
+    def _split(self, arrays):
+        "Boolean arrays of the kept and of the soft particles, worked out once per EventArrays and budget"
+        if not hasattr(arrays, "_splits"):
+            arrays._splits = {}
+        split = arrays._splits.get(self.key)
+        if split is None:
+            split = arrays._splits[self.key] = self._compute_split(arrays)
+        return split
+
+    def _compute_split(self, arrays):
+        "Evaluate the base cut and rank its particles, returning read-only kept and soft masks"
+        passed = self.base.mask(arrays)
+        candidates = np.flatnonzero(passed)
+        if len(candidates) <= self.max_tracks:
+            kept, soft = passed, np.zeros(len(passed), dtype=bool)
+        else:
+            quantity = self.RANKS[self.rank](arrays)[candidates]
+            kept = np.zeros(len(passed), dtype=bool)
+            kept[candidates[np.argsort(-quantity, kind="stable")[:self.max_tracks]]] = True
+            soft = passed & ~kept
+        #The masks are shared by every caller of mask and soft on these arrays, so must not be changed in place.
+        kept.flags.writeable = soft.flags.writeable = False
+        return kept, soft
+
+
+def budget(base, max_tracks, rank="pt", bundle=False):
+    """Caps the number of particles passing a cut, see Budget.
+    """
+    return Budget(base, max_tracks, rank, bundle)
+
+
+#The Visualiser's default: non-final-state particles above the pT cut-off.
+DEFAULT_CUT = ~status(1) & pt(min=PT_CUTOFF)
+
+
+def mask(evt, cut, arrays=None):
+    """Evaluates a cut on an event.
+
+       Arguments:
+       evt -- the hepmcio event.
+       cut -- the Cut to evaluate.
+       arrays -- the event's EventArrays, if already built.
+
+       Returns:
+       A boolean array over evt.particles.values().
+    """
+    return cut.mask(arrays if arrays is not None else EventArrays(evt))
+
+
+def select(evt, cut, arrays=None):
+    """Returns the particles of an event passing a cut, in the order of evt.particles.values().
+    """
+    arrays = arrays if arrays is not None else EventArrays(evt)
+    return [arrays.particles[i] for i in np.flatnonzero(cut.mask(arrays))]
+
+
+def track_types(pid):
+    """Classifies particles by PDG ID into the Visualiser's track types, returning an array of indices into
+       TRACK_TYPES: photons, charged leptons, neutrinos, and hadrons for everything else.
+    """
+    pid = np.abs(np.asarray(pid))
+    codes = np.full(len(pid), TRACK_TYPES.index("hadron"), dtype=np.int64)
+    codes[pid == 22] = TRACK_TYPES.index("photon")
+    codes[np.isin(pid, (11, 13, 15))] = TRACK_TYPES.index("lepton")
+    codes[np.isin(pid, (12, 14, 16))] = TRACK_TYPES.index("nu")
+    return codes
+
+
+def bundles(arrays, mask):
+    """Sums the particles selected by a mask per track type, e.g. the soft particles dropped by a Budget.
+
+       Arguments:
+       arrays -- the event's EventArrays.
+       mask -- a boolean array of the particles to bundle.
+
+       Returns:
+       A list with a dict for each track type that has any particles, holding the "type" name, the "count" of
+       particles and their summed "momentum" (px, py, pz, E).
+    """
+    codes = track_types(arrays.pid[mask])
+    mom = np.stack([arrays.px, arrays.py, arrays.pz, arrays.E], axis=1)[mask]
+    counts = np.bincount(codes, minlength=len(TRACK_TYPES))
+    sums = np.zeros((len(TRACK_TYPES), 4))
+    np.add.at(sums, codes, mom)
+    return [{"type":TRACK_TYPES[i], "count":int(counts[i]), "momentum":sums[i].tolist()}
+            for i in range(len(TRACK_TYPES)) if counts[i]]
+
+
+def _floats(value):
+    "Parse an optional float parameter, rejecting nan and infinities, which no particle can be compared with"
+    if value in (None, ""):
+        return None
+    number = float(value)
+    if not np.isfinite(number):
+        raise ValueError("Bad cut value %r." % value)
+    return number
+
+def _ints(value):
+    return [int(x) for x in value.split(",") if x.strip()]
+
+
+def from_args(args):
+    """Builds a cut from query parameters. Unspecified parameters keep the Visualiser's default selection of
+       non-final-state particles with pT above PT_CUTOFF. Raises ValueError for malformed values, including
+       non-finite bounds such as nan or inf.
+
+       Query parameters:
+       pt_min, pt_max -- transverse momentum range.
+       eta_min, eta_max -- pseudorapidity range.
+       abs_eta_max -- maximum absolute pseudorapidity.
+       phi_min, phi_max -- azimuthal angle range.
+       mass_min, mass_max -- generated mass range.
+       status -- comma-separated status codes to keep.
+       not_status -- comma-separated status codes to drop, default 1 (final state) unless status is given.
+       pid -- comma-separated PDG IDs to keep, matching antiparticles too.
+       not_pid -- comma-separated PDG IDs to drop, matching antiparticles too.
+       max_tracks -- keep only this many of the selected particles, see Budget.
+       rank -- "pt" (the default) or "energy", what the particles are ranked by for max_tracks.
+       bundle -- "1" to summarise the particles dropped by max_tracks in per-type bundles.
+
+       Arguments:
+       args -- a mapping of query parameter names to string values, e.g. request.args.
+
+       Returns:
+       The Cut.
+    """
+    parts = []
+    if args.get("status"):
+        parts.append(status(*_ints(args["status"])))
+    not_status = args.get("not_status", "" if args.get("status") else "1")
+    if not_status:
+        parts.append(~status(*_ints(not_status)))
+    pt_min = _floats(args.get("pt_min"))
+    parts.append(pt(min=PT_CUTOFF if pt_min is None else pt_min, max=_floats(args.get("pt_max"))))
+    if args.get("eta_min") or args.get("eta_max"):
+        parts.append(eta(_floats(args.get("eta_min")), _floats(args.get("eta_max"))))
+    if args.get("abs_eta_max"):
+        parts.append(abs_eta(_floats(args["abs_eta_max"])))
+    if args.get("phi_min") or args.get("phi_max"):
+        parts.append(phi(_floats(args.get("phi_min")), _floats(args.get("phi_max"))))
+    if args.get("mass_min") or args.get("mass_max"):
+        parts.append(mass(_floats(args.get("mass_min")), _floats(args.get("mass_max"))))
+    if args.get("pid"):
+        parts.append(pid(*_ints(args["pid"])))
+    if args.get("not_pid"):
+        parts.append(~pid(*_ints(args["not_pid"])))
+    cut = parts[0]
+    for part in parts[1:]:
+        cut = cut & part
+    if args.get("max_tracks"):
+        cut = budget(cut, int(args["max_tracks"]), args.get("rank") or "pt", args.get("bundle") in ("1", "true"))
+    return cut
@@ -0,0 +1,83 @@
+"""Streaming skims of HepMC files. Events are read one at a time, the ones passing a predicate are written
+   straight out with HepMCWriter and the rest are dropped, so a file of any size is skimmed in constant
+   memory. The much smaller output can then be uploaded to the Visualiser.
+
+   Usage: python -m app.skim [--cut QUERY] [--min-count N] [--max-events N] input output
+
+   e.g. python -m app.skim --cut "pt_min=50&pid=6" big.hepmc.gz tops.hepmc.gz
+
+   Functions:
+   has_particles -- builds an event predicate requiring particles that pass a selection cut.
+   skim_file -- writes the events of a file that pass a predicate to a new file.
+   main -- command line entry point.
+   """
+
+import argparse
+import numpy as np
+from urllib.parse import parse_qsl
+from app import hepmcio, selection
+
+
+def has_particles(cut, min_count=1):
+    """Builds an event predicate requiring at least min_count particles that pass a cut.
+
+       Arguments:
+       cut -- the selection.Cut the particles must pass.
+       min_count -- the number of passing particles needed.
+
+       Returns:
+       A function taking an event and returning whether it passes.
+    """
+    return lambda evt: bool(np.count_nonzero(selection.mask(evt, cut)) >= min_count)
+
+
+def skim_file(source, destination, predicate, max_events=None, compresslevel=6):
+    """Writes the events of a HepMC file that pass a predicate to a new file. The input may be compressed
+       (see hepmcio.open_text), and the output is gzip-compressed if its name ends in .gz. Events are read
+       lazily, so predicates looking only at event headers never parse the particles of dropped events.
+
+       Arguments:
+       source -- path of the HepMC file to read.
+       destination -- path of the file to write.
+       predicate -- function taking an event and returning whether to keep it.
+       max_events -- stop once this many events have been written.
+       compresslevel -- the gzip compression level of compressed output.
+
+       Returns:
+       A tuple of the numbers of events read and written.
+    """
+    read = written = 0
+    with hepmcio.open_text(source) as f, hepmcio.HepMCWriter(destination, compresslevel=compresslevel) as writer:
+        for evt in hepmcio.HepMCReader(f, lazy=True):
+            if max_events is not None and written >= max_events:
+                break
+            read += 1
+            if predicate(evt):
+                writer.write_next(evt)
+                written += 1
+    return read, written
+
+
+def main(argv=None):
+    """Command line entry point, see the module usage.
+    """
+    parser = argparse.ArgumentParser(description="Copy the events of a HepMC file that pass a selection to a new file.")
+    parser.add_argument("input", help="HepMC file to read, optionally compressed")
+    parser.add_argument("output", help="HepMC file to write, gzip-compressed if its name ends in .gz")
+    parser.add_argument("--cut", default="", help="selection cut as Visualiser query parameters, e.g. "
+                        "\"pt_min=20&abs_eta_max=2.5\" (see selection.from_args)")
+    parser.add_argument("--min-count", type=int, default=1, help="particles that must pass the cut for an event to be kept")
+    parser.add_argument("--max-events", type=int, default=None, help="stop after writing this many events")
+    parser.add_argument("--compresslevel", type=int, default=6, help="gzip compression level of compressed output")
+    args = parser.parse_args(argv)
+    try:
+        cut = selection.from_args(dict(parse_qsl(args.cut)))
+    except ValueError as e:
+        parser.error("bad --cut: %s" % e)
+    read, written = skim_file(args.input, args.output, has_particles(cut, args.min_count), args.max_events,
+                              args.compresslevel)
+    print("Kept %d of %d events." % (written, read))
+
+
+if __name__ == "__main__":
+    main()
@@ -41,7 +41,23 @@ var no;
 //Whether the event is being visualized in momentum space (=1) or spacetime (=2).
 var viewMode;
 
-var maxno = 8; //placeholder; find way to add max number of events in file
+//The number of events in the file, taken from the file's manifest.
+var maxno;
+//Selection cuts from the page URL (e.g. pt_min, abs_eta_max, pid), sent along with every event request.
+var cuts;
+//Track types, in the order of the type codes of bundles (see selection.TRACK_TYPES).
+var TRACK_TYPES = ["photon", "lepton", "nu", "hadron"];
+//Media type of the packed binary event format requested from get_event (see eventbinary.py).
+var BINARY_MIMETYPE = "application/vnd.hepmc-event";
+//One merged LineSegments per particle type, holding every track of that type in a single BufferGeometry.
+//The buffers are refilled in place when the event or view mode changes.
+var tracks = {};
+//The event being shown, as columns, for looking up the particles picked with the mouse.
+var currentEvent;
+//Media type of the spacetime view's tracks, propagated on the server by get_trajectories (see trajectory.py).
+var TRAJECTORY_MIMETYPE = "application/vnd.hepmc-trajectories";
+//Number of the latest event switch. Responses to the requests of earlier switches arrive too late to be drawn.
+var switchCount = 0;
 
 //Object for registering mouse position on-click.
 var clickInfo = {
@@ -60,24 +76,6 @@ function onMouseClick(event) {
 	clickInfo.x = event.clientX;
 	clickInfo.y = event.clientY;
 };
-//Callback to clear the visualizer when switching events or view modes.
-function clearScene() {
-	removableItems = []
-	scene.children.forEach(function (obj) {
-		if (obj.type === "Line" && obj.material != materials.beam) {
-			removableItems.push(obj);
-		}
-
-
-
-	});
-	while (removableItems.length > 0) {
-		scene.remove(removableItems[0]);
-		removableItems.shift();
-	}
-
-};
-
 //Callback to switch events or view modes on appropriate keyboard presses.
 $('*').off().keydown(function (event) {
 	//This method call stops the events from triggering more than once per click.
@@ -100,33 +98,60 @@ $('*').off().keydown(function (event) {
 		viewMode = 2;
 		switchEvent = true;
 	}
-	//Performs the AJAX call to retrieve appropriate event. On success, clear scene and visualize the new event.
+	//Performs the AJAX calls to retrieve appropriate event, and its tracks in the spacetime view, in the binary
+	//formats. On success, visualize the new event, unless another switch has been made since: the event number
+	//and view mode are those of this switch, and responses to earlier switches are dropped, so the particles
+	//and tracks drawn always belong to the latest event requested.
 	if (switchEvent == true) {
-		$.ajax({
-			type: 'GET',
-			url: 'http://127.0.0.1:5000/visualiser/get_event',
-			data: {
-				"no": no,
-				"filename": file
-			},
-			success: function (data) {
-				clearScene();
-				visualizeParticles(JSON.parse(data.particles), JSON.parse(data.vertices));
+		var switchNo = ++switchCount;
+		var eventNo = no;
+		var mode = viewMode;
+		getBinary("get_event", BINARY_MIMETYPE, eventNo, function (buffer) {
+			if (switchNo !== switchCount) {
+				return;
+			}
+			var event = decodeEvent(buffer);
+			if (mode === 1) {
+				visualizeParticles(event);
+			} else {
+				getBinary("get_trajectories", TRAJECTORY_MIMETYPE, eventNo, function (buffer) {
+					if (switchNo === switchCount) {
+						visualizeParticles(event, decodeTrajectories(buffer));
+					}
+				});
 			}
 		});
 	}
 });
+//Requests an event from one of the Visualiser's binary endpoints, passing the response to onload.
+function getBinary(endpoint, mimetype, eventNo, onload) {
+	var request = new XMLHttpRequest();
+	request.open('GET', 'http://127.0.0.1:5000/visualiser/' + endpoint + '?' + $.param($.extend({}, cuts, {
+		"no": eventNo,
+		"filename": file
+	})));
+	request.responseType = "arraybuffer";
+	request.setRequestHeader("Accept", mimetype);
+	request.onload = function () {
+		if (request.status == 200) {
+			onload(request.response);
+		}
+	};
+	request.send();
+};
 //Register event listeners.
 window.addEventListener('mousemove', onMouseMove, false);
 window.addEventListener('click', onMouseClick, false);
 //Initialize the Python variables processed by the template.
 function initVars(vars) {
-	init(arguments[0], arguments[1], arguments[2]);
+	init(arguments[0], arguments[1], arguments[2], arguments[3], arguments[4], arguments[5]);
 	animate();
 };
 //Set up the scene and load first event.
-function init(particleData, vertexData, filename) {
+function init(particleData, vertexData, filename, eventCount, selectionCuts, bundleData) {
 	no = 1;
+	maxno = eventCount;
+	cuts = selectionCuts || {};
 	file = filename;
 	viewMode = 1;
 	renderer = new THREE.WebGLRenderer();
@@ -161,13 +186,163 @@ function init(particleData, vertexData, filename) {
 	var solenoid = new THREE.Mesh(geometry, materials.detector);
 	solenoid.rotation.x += Math.PI / 2
 	scene.add(solenoid);
-	visualizeParticles(particleData, vertexData);
+	createTracks();
+	visualizeParticles(eventFromDocuments(particleData, vertexData, bundleData || []));
+};
+
+//Creates the merged line objects for each particle type, initially empty.
+function createTracks() {
+	TRACK_TYPES.forEach(function (type) {
+		var track = {
+			geometry: new THREE.BufferGeometry(),
+			//Index into currentEvent of the particle each segment belongs to, or -1 - i for bundle i.
+			particles: new Int32Array(0),
+			//Number of segments in use.
+			count: 0
+		};
+		track.lines = new THREE.LineSegments(track.geometry, materials[type]);
+		track.lines.userData = {pType: type};
+		//The bounding sphere changes with every event, so skip culling rather than recompute it each frame.
+		track.lines.frustumCulled = false;
+		reserveSegments(track, 256);
+		tracks[type] = track;
+		scene.add(track.lines);
+	});
+};
+
+//Makes room for at least n segments in a track's buffers. They are only reallocated when too small, with
+//room to spare, so most event switches reuse them as they are.
+function reserveSegments(track, n) {
+	if (track.particles.length >= n) {
+		return;
+	}
+	var capacity = Math.max(n, 2 * track.particles.length);
+	track.geometry.dispose();
+	track.geometry.addAttribute("position", new THREE.BufferAttribute(new Float32Array(6 * capacity), 3));
+	track.particles = new Int32Array(capacity);
+};
+
+//Appends a polyline of the given number of segments, from points holding x, y, z per point, to a track.
+function addSegments(track, points, segments, particle) {
+	var positions = track.geometry.attributes.position.array;
+	var offset = 6 * track.count;
+	for (var k = 0; k < segments; k++) {
+		positions.set(points.subarray(3 * k, 3 * k + 6), offset + 6 * k);
+		track.particles[track.count + k] = particle;
+	}
+	track.count += segments;
+};
+
+//Unpacks an event in the binary format into typed arrays that are views over the response buffer, so nothing
+//is parsed or copied. Each column has one entry per particle or vertex, or four for momenta and positions.
+function decodeEvent(buffer) {
+	var header = new DataView(buffer, 0, 24);
+	var magic = String.fromCharCode.apply(null, new Uint8Array(buffer, 0, 4));
+	if (magic !== "HEPB" || header.getUint32(4, true) !== 2) {
+		throw new Error("Unsupported event format.");
+	}
+	var n = header.getInt32(12, true);
+	var m = header.getInt32(16, true);
+	var b = header.getInt32(20, true);
+	var offset = 24;
+	function column(Type, length) {
+		var array = new Type(buffer, offset, length);
+		offset += length * 4;
+		return array;
+	}
+	return {
+		no: header.getInt32(8, true),
+		nparticles: n,
+		nvertices: m,
+		momentum: column(Float32Array, 4 * n),
+		pid: column(Int32Array, n),
+		charge: column(Float32Array, n),
+		barcode: column(Int32Array, n),
+		status: column(Int32Array, n),
+		startVertex: column(Int32Array, n),
+		endVertex: column(Int32Array, n),
+		position: column(Float32Array, 4 * m),
+		vertexBarcode: column(Int32Array, m),
+		nbundles: b,
+		bundleType: column(Int32Array, b),
+		bundleCount: column(Int32Array, b),
+		bundleMomentum: column(Float32Array, 4 * b)
+	};
+};
+
+//Unpacks the tracks sent by get_trajectories: the same number of points along each track, x, y, z per point,
+//one track after another, as a view over the response buffer.
+function decodeTrajectories(buffer) {
+	var header = new DataView(buffer, 0, 20);
+	var magic = String.fromCharCode.apply(null, new Uint8Array(buffer, 0, 4));
+	if (magic !== "HEPT" || header.getUint32(4, true) !== 1) {
+		throw new Error("Unsupported trajectory format.");
+	}
+	var n = header.getInt32(12, true);
+	var k = header.getInt32(16, true);
+	return {
+		no: header.getInt32(8, true),
+		ntracks: n,
+		npoints: k,
+		points: new Float32Array(buffer, 20, 3 * n * k)
+	};
+};
+
+//Builds the same columns as decodeEvent from particle and vertex documents and bundles, as passed in by the
+//template.
+function eventFromDocuments(particleData, vertexData, bundleData) {
+	var n = particleData.length;
+	var m = vertexData.length;
+	var b = bundleData.length;
+	var event = {
+		nparticles: n,
+		nvertices: m,
+		momentum: new Float32Array(4 * n),
+		pid: new Int32Array(n),
+		charge: new Float32Array(n),
+		barcode: new Int32Array(n),
+		status: new Int32Array(n),
+		startVertex: new Int32Array(n).fill(-1),
+		endVertex: new Int32Array(n).fill(-1),
+		position: new Float32Array(4 * m),
+		vertexBarcode: new Int32Array(m),
+		nbundles: b,
+		bundleType: new Int32Array(b),
+		bundleCount: new Int32Array(b),
+		bundleMomentum: new Float32Array(4 * b)
+	};
+	for (var k = 0; k < b; k++) {
+		event.bundleType[k] = TRACK_TYPES.indexOf(bundleData[k].type);
+		event.bundleCount[k] = bundleData[k].count;
+		event.bundleMomentum.set(bundleData[k].momentum, 4 * k);
+	}
+	var vertexIndex = new Map();
+	for (var j = 0; j < m; j++) {
+		event.position.set(vertexData[j].position, 4 * j);
+		event.vertexBarcode[j] = vertexData[j].barcode;
+		vertexIndex.set(vertexData[j].barcode, j);
+	}
+	for (var i = 0; i < n; i++) {
+		var particle = particleData[i];
+		event.momentum.set(particle.momentum, 4 * i);
+		event.pid[i] = particle.pid;
+		event.charge[i] = particle.charge;
+		event.barcode[i] = particle.barcode;
+		event.status[i] = particle.status;
+		if (vertexIndex.has(particle.start_vertex)) {
+			event.startVertex[i] = vertexIndex.get(particle.start_vertex);
+		}
+		if (vertexIndex.has(particle.end_vertex)) {
+			event.endVertex[i] = vertexIndex.get(particle.end_vertex);
+		}
+	}
+	return event;
 };
 
 //Helper function to get particle type to select material.
-function getParticleType(particle) {
+function getParticleType(pid) {
 	var particleType;
-	switch (particle["pid"]) {
+	switch (pid) {
 		case 22:
 			particleType = "photon";
 			break;
@@ -193,91 +368,57 @@ function getParticleType(particle) {
 	return particleType;
 };
 
-//Function to visualize particle data.
-function visualizeParticles(particleData, vertexData) {
-	//Momentum view.
+//Function to visualize particle data, held as columns by decodeEvent or eventFromDocuments. Each particle
+//becomes one segment (momentum view) or, in the spacetime view, the polyline of its track as decoded by
+//decodeTrajectories, in the track of its type. Bundles of soft particles are drawn as one segment along their
+//summed momentum in the momentum view only, as they have no trajectory.
+function visualizeParticles(event, trajectories) {
+	currentEvent = event;
+	var segments = viewMode === 1 ? 1 : trajectories.npoints - 1;
+	var types = new Array(event.nparticles);
+	var needed = {};
+	for (var type in tracks) {
+		needed[type] = 0;
+	}
+	for (var i = 0; i < event.nparticles; i++) {
+		types[i] = getParticleType(event.pid[i]);
+		needed[types[i]] += segments;
+	}
 	if (viewMode === 1) {
-		for (var i = 0; i < particleData.length; i++) {
-			//Get momentum and type.
-			var verts = [0, 0, 0, particleData[i].momentum.slice(0, 3)];
-			var type = getParticleType(particleData[i]);
-			//Point line to momentum coordinates.
-			geometry = new THREE.Geometry();
-			geometry.vertices.push(new THREE.Vector3(verts[0], verts[1], verts[2]));
-			geometry.vertices.push(new THREE.Vector3(verts[3][0], verts[3][1], verts[3][2]));
-			var line = new THREE.Line(geometry, materials[type]);
-			//Add data for display on-click.
-			line.userData = {
-				pType: type,
-				pid: particleData[i].pid,
-				momentum: particleData[i].momentum
-			};
-			scene.add(line);
-		};
-	//Soacetime view.
-	} else if (viewMode === 2) {
-		//Timestep.
-		var DT = 5 * 10 ** (-10);
-		//Number of steps.
-		var NSTEP = 16;
-		for (var i = 0; i < particleData.length; i++) {
-			var verts = [];
-			var E = particleData[i].momentum[3];
-			var mass = 0.0;
-			//Get mass if particle is not massles.
-			if (particleData[i].momentum[0] ** 2 + particleData[i].momentum[1] ** 2 + particleData[i].momentum[2] ** 2 < E) {
-				mass = Math.sqrt(E ** 2 - particleData[i].momentum[0] ** 2 - particleData[i].momentum[1] ** 2 - particleData[i].momentum[2] ** 2);
-				};
-				//Find vstart vertex position.
-				var pos3 = vertexData.find(function (vertex) {
-					return vertex.barcode === particleData[i].start_vertex;
-				}).position.slice(0, 3);
-				//Get momentum and charge.
-				var mom3 = particleData[i].momentum.slice(0, 3);
-				var charge = particleData[i].charge;
-				verts.push(pos3);
-				//Model particle movement over time.
-				for (var j = 0; j < NSTEP; j++) {
-
-					var vel3 = mom3.map(mom => mom / E * 3 * 10 ** 8);
-					//Model electric force if particle is charged.
-					if (particleData[i].charge != 0) {
-						pos3 = vel3.map(vel => vel + vel*DT)
-						var force = math.cross(vel3, [0, 0, 4]).map(f => f*particleData[i].charge);
-						mom3 = mom3.map(mom => mom + DT ^ force / 500);
-						verts.push(pos3);
-					//If particle is not charged, just use momentum.
-					} else {
-						pos3 = pos3.map(vel => vel + vel * DT);
-						verts.push(pos3);
-					}
-				};
-				
-				if (verts.length === 2){
-					gemoetry = new THREE.Geometry();
-					verts.forEach(function(vert){
-					geometry.vertices.push(new THREE.Vector3(vert[0], verts[1], verts[2]));
-				});
-				}
-				else {
-					var points = verts.map(vert => new THREE.Vector3(vert[0], vert[1], vert[2]));
-					var curve = new THREE.CatmullRomCurve3(points);
-					geometry = new THREE.BufferGeometry().setFromPoints(curve.getPoints(100));
-				}
-				//Analogous to momentum view.
-				type = getParticleType(particleData[i]);
-				var line = new THREE.Line(geometry, materials[type]);
-				line.userData = {
-					pType: type,
-					pid: particleData[i].pid,
-					momentum: particleData[i].momentum
-				};
-				scene.add(line);
-			};
-
-		};
-
-	};
+		for (var k = 0; k < event.nbundles; k++) {
+			needed[TRACK_TYPES[event.bundleType[k]]] += 1;
+		}
+	}
+	for (var type in tracks) {
+		reserveSegments(tracks[type], needed[type]);
+		tracks[type].count = 0;
+	}
+	var points = new Float32Array(6);
+	for (var i = 0; i < event.nparticles; i++) {
+		//Momentum view: point line from the origin to momentum coordinates.
+		if (viewMode === 1) {
+			points.set(event.momentum.subarray(4 * i, 4 * i + 3), 3);
+			addSegments(tracks[types[i]], points, segments, i);
+		//Spacetime view: the track's points, already computed by the server.
+		} else {
+			var stride = 3 * trajectories.npoints;
+			addSegments(tracks[types[i]], trajectories.points.subarray(stride * i, stride * (i + 1)), segments, i);
+		}
+	}
+	if (viewMode === 1) {
+		for (var k = 0; k < event.nbundles; k++) {
+			points.set(event.bundleMomentum.subarray(4 * k, 4 * k + 3), 3);
+			addSegments(tracks[TRACK_TYPES[event.bundleType[k]]], points, 1, -1 - k);
+		}
+	}
+	for (var type in tracks) {
+		var track = tracks[type];
+		track.geometry.attributes.position.needsUpdate = true;
+		track.geometry.setDrawRange(0, 2 * track.count);
+		//Recomputed from the new positions on the next raycast.
+		track.geometry.boundingSphere = null;
+	}
+};
 
 	//Start render loop.
 	function animate() {
@@ -291,11 +432,22 @@ function visualizeParticles(particleData, vertexData) {
 			//Resets the click check.
 			clickInfo.userHasClicked = false;
 			raycaster.setFromCamera(mouse, camera);
-			//Gets all objects intersecting mouse ray. Displays info for first particle line encountered.
-			var intersects = raycaster.intersectObjects(scene.children);
+			//Gets all tracks intersecting mouse ray. Displays info for the first particle encountered, mapping the
+			//segment hit back to its particle. Segments past the track's count are left over from earlier events.
+			var intersects = raycaster.intersectObjects(Object.values(tracks).map(track => track.lines));
 			for (var i = 0; i < intersects.length; i++) {
-				if (intersects[i].object.type == "Line") {
-					var info = "Type:" + intersects[i].object.userData.pType + "\n" + "ID:" + String(intersects[i].object.userData.pid) + "\n" + "Momentum" + String(intersects[i].object.userData.momentum)
+				var track = tracks[intersects[i].object.userData.pType];
+				var segment = intersects[i].index / 2;
+				if (segment < track.count) {
+					var particle = track.particles[segment];
+					if (particle < 0) {
+						var bundle = -1 - particle;
+						var momentum = Array.from(currentEvent.bundleMomentum.subarray(4 * bundle, 4 * bundle + 4));
+						var info = "Type:" + track.lines.userData.pType + "\n" + "Bundle of " + String(currentEvent.bundleCount[bundle]) + " soft particles" + "\n" + "Momentum" + String(momentum)
+					} else {
+						var momentum = Array.from(currentEvent.momentum.subarray(4 * particle, 4 * particle + 4));
+						var info = "Type:" + track.lines.userData.pType + "\n" + "ID:" + String(currentEvent.pid[particle]) + "\n" + "Momentum" + String(momentum)
+					}
 					$("[id=info]").text(info)
 					break;
 				}
@@ -0,0 +1,317 @@
+"""Lightweight per-request timing of the stages of serving an event. Code on the request path marks its
+   stages with the stage context manager or the timed decorator; while a request is being timed on the
+   current thread, each stage's duration and counts (documents, particles, bytes...) are recorded, and are
+   otherwise ignored at almost no cost, so the same code runs untimed in the prefetch workers, the upload
+   jobs and the benchmarks. A request's stages are sent back in a Server-Timing header and aggregated into
+   the histograms served by the /metrics endpoint.
+
+   Classes:
+   RequestTimings -- the stage durations and counts recorded for one request.
+   Histogram -- cumulative histogram of durations with fixed buckets.
+   Metrics -- thread-safe histograms of request and stage durations per endpoint.
+   SlowRequestProfiler -- profiles requests with cProfile, dumping the profiles of the slow ones.
+
+   Functions:
+   start -- starts timing a request on the current thread.
+   stop -- stops timing the current thread's request, returning its timings.
+   stage -- context manager timing a stage of the current request.
+   timed -- decorator timing every call of a function as a stage of the current request.
+   """
+
+import bisect
+import cProfile
+import functools
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+#Upper bounds in seconds of the histogram buckets, from sub-millisecond cache hits to very large events.
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_local = threading.local()
+
+
+class RequestTimings(object):
+    """The stage durations and counts recorded for one request. A stage entered more than once, e.g. an
+       ancestor walk per selection, is recorded once with its durations and counts summed.
+
+       Methods:
+       add -- records a run of a stage.
+       server_timing -- formats the timings as a Server-Timing header value.
+    """
+    def __init__(self):
+        #Stage name -> [seconds, calls, {count name: total}], in the order the stages were first entered.
+        self.stages = OrderedDict()
+
+    def add(self, name, seconds, counts=None):
+        """Records a run of a stage.
+
+           Arguments:
+           name -- the stage name.
+           seconds -- how long the stage took.
+           counts -- a dict of counts to add to the stage's totals.
+        """
+        entry = self.stages.get(name)
+        if entry is None:
+            entry = self.stages[name] = [0.0, 0, {}]
+        entry[0] += seconds
+        entry[1] += 1
+        for key, value in (counts or {}).items():
+            entry[2][key] = entry[2].get(key, 0) + value
+
+    def server_timing(self, total=None):
+        """Formats the timings as a Server-Timing header value, with durations in milliseconds and each
+           stage's counts in its description, e.g. mongo;dur=12.5;desc="documents=1234".
+
+           Arguments:
+           total -- the duration of the whole request in seconds, added as a "total" metric if given.
+        """
+        metrics = []
+        for name, (seconds, calls, counts) in self.stages.items():
+            metric = "%s;dur=%.3f" % (name, 1000*seconds)
+            if counts:
+                metric += ';desc="%s"' % " ".join("%s=%d" % item for item in counts.items())
+            metrics.append(metric)
+        if total is not None:
+            metrics.append("total;dur=%.3f" % (1000*total))
+        return ", ".join(metrics)
+
+
+class _Stage(object):
+    "Handle given to the body of a stage, for adding counts to it"
+    __slots__ = ("counts",)
+
+    def __init__(self, counts):
+        self.counts = counts
+
+    def count(self, **counts):
+        for key, value in counts.items():
+            self.counts[key] = self.counts.get(key, 0) + value
+
+
+class _NullStage(object):
+    "Handle given to the body of a stage when no request is being timed"
+    __slots__ = ()
+
+    def count(self, **counts):
+        pass
+
+
+_NULL_STAGE = _NullStage()
+
+
+def start():
+    """Starts timing a request on the current thread, replacing any timings left by a request that failed
+       before it could be stopped.
+
+       Returns:
+       The RequestTimings that stages on this thread are recorded into.
+    """
+    _local.timings = RequestTimings()
+    return _local.timings
+
+
+def stop():
+    """Stops timing the current thread's request.
+
+       Returns:
+       Its RequestTimings, or None if no request was being timed.
+    """
+    timings = getattr(_local, "timings", None)
+    _local.timings = None
+    return timings
+
+
+@contextmanager
+def stage(name, **counts):
+    """Context manager timing a stage of the current thread's request. Does nothing if no request is being
+       timed.
+
+       Arguments:
+       name -- the stage name, a Server-Timing metric name such as "mongo" or "decode".
+       counts -- counts to record for the stage; more can be added with the count method of the handle
+       returned, e.g. once the number of documents read is known.
+    """
+    timings = getattr(_local, "timings", None)
+    if timings is None:
+        yield _NULL_STAGE
+        return
+    handle = _Stage(counts)
+    begin = time.perf_counter()
+    try:
+        yield handle
+    finally:
+        timings.add(name, time.perf_counter() - begin, handle.counts)
+
+
+def timed(name):
+    """Decorator timing every call of a function as a stage of the current thread's request, see stage.
+       Calls made while no request is being timed go straight through.
+
+       Arguments:
+       name -- the stage name.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            timings = getattr(_local, "timings", None)
+            if timings is None:
+                return function(*args, **kwargs)
+            begin = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                timings.add(name, time.perf_counter() - begin)
+        return wrapper
+    return decorator
+
+
+class Histogram(object):
+    """Cumulative histogram of durations with fixed bucket bounds, as in the Prometheus exposition format.
+       Not thread-safe by itself; Metrics guards its histograms with a lock.
+
+       Methods:
+       observe -- records a duration.
+       snapshot -- returns the histogram as a dict.
+    """
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0]*(len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        """Records a duration in seconds.
+        """
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def snapshot(self):
+        """Returns a dict with the number of observations, their sum in seconds, the bucket bounds and the
+           cumulative number of observations at or below each bound, with one more for all observations.
+        """
+        cumulative = []
+        total = 0
+        for n in self.counts:
+            total += n
+            cumulative.append(total)
+        return {"count":self.count, "sum":self.sum, "bounds":list(self.buckets), "cumulative":cumulative}
+
+
+class Metrics(object):
+    """Thread-safe aggregate of request timings: per endpoint, a histogram of whole-request durations, the
+       number of responses by status code, and for each stage a histogram of its per-request durations and
+       the totals of its counts.
+
+       Methods:
+       observe -- records a timed request.
+       snapshot -- returns all the histograms and totals as a dict.
+       clear -- drops everything recorded.
+    """
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self._endpoints = OrderedDict()
+        self._lock = threading.Lock()
+
+    def observe(self, endpoint, seconds, timings=None, status=200):
+        """Records a timed request.
+
+           Arguments:
+           endpoint -- the name of the endpoint that served it.
+           seconds -- the duration of the whole request.
+           timings -- its RequestTimings, if its stages were timed.
+           status -- the response status code.
+        """
+        with self._lock:
+            entry = self._endpoints.get(endpoint)
+            if entry is None:
+                entry = self._endpoints[endpoint] = {"total":Histogram(self.buckets), "status":{},
+                                                     "stages":OrderedDict()}
+            entry["total"].observe(seconds)
+            entry["status"][status] = entry["status"].get(status, 0) + 1
+            for name, (stage_seconds, calls, counts) in (timings.stages.items() if timings else ()):
+                stage_entry = entry["stages"].get(name)
+                if stage_entry is None:
+                    stage_entry = entry["stages"][name] = {"seconds":Histogram(self.buckets), "calls":0, "counts":{}}
+                stage_entry["seconds"].observe(stage_seconds)
+                stage_entry["calls"] += calls
+                for key, value in counts.items():
+                    stage_entry["counts"][key] = stage_entry["counts"].get(key, 0) + value
+
+    def snapshot(self):
+        """Returns a dict keyed by endpoint, each with its request duration histogram ("total"), its responses
+           by status code and, for each stage, its duration histogram, number of calls and count totals.
+        """
+        with self._lock:
+            return OrderedDict((endpoint, {
+                "total":entry["total"].snapshot(),
+                "status":{str(code):n for code, n in entry["status"].items()},
+                "stages":OrderedDict((name, {"seconds":s["seconds"].snapshot(), "calls":s["calls"],
+                                             "counts":dict(s["counts"])}) for name, s in entry["stages"].items())})
+                for endpoint, entry in self._endpoints.items())
+
+    def clear(self):
+        """Drops all recorded requests.
+        """
+        with self._lock:
+            self._endpoints.clear()
+
+
+class SlowRequestProfiler(object):
+    """Profiles requests with cProfile and dumps the profiles of those slower than a threshold, for loading
+       with pstats or snakeviz. Profiling slows every request down, so it is only switched on by configuring
+       a directory for the dumps.
+
+       Methods:
+       start -- starts profiling the current thread's request.
+       finish -- stops a profile, dumping it if the request was slow.
+    """
+    def __init__(self, directory, min_seconds=1.0):
+        """Constructor.
+
+           Arguments:
+           directory -- the directory the profiles are written to, created if needed.
+           min_seconds -- requests taking at least this long are dumped.
+        """
+        self.directory = directory
+        self.min_seconds = min_seconds
+        os.makedirs(directory, exist_ok=True)
+
+    def start(self):
+        """Starts profiling the current thread.
+
+           Returns:
+           The cProfile.Profile, or None if another profiler is already active, as on Python versions that
+           allow only one at a time.
+        """
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            return None
+        return profile
+
+    def finish(self, profile, name, seconds):
+        """Stops a profile started by start, dumping it if the request took at least min_seconds.
+
+           Arguments:
+           profile -- the cProfile.Profile returned by start.
+           name -- a name for the request, used in the dump's filename.
+           seconds -- the duration of the request.
+
+           Returns:
+           The path of the dump, or None if the request was not slow enough to keep.
+        """
+        profile.disable()
+        if seconds < self.min_seconds:
+            return None
+        path = os.path.join(self.directory, "%s-%d-%d.prof" % (name, time.time()*1000, threading.get_ident()))
+        profile.dump_stats(path)
+        logger.info("Profile of %s request taking %.3f s written to %s", name, seconds, path)
+        return path
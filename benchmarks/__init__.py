@@ -0,0 +1,3 @@
+"""Performance benchmarks for the Visualiser's hot paths. Run a benchmark as a module from the repository
+   root, e.g. python -m benchmarks.bench_graph
+   """
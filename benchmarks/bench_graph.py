@@ -0,0 +1,61 @@
+"""Micro-benchmark for event graph navigation.
+
+   Builds synthetic binary decay cascades of increasing size and times parent lookups, per-particle ancestor
+   walks and a single batched Event.ancestors walk over every particle in the event. With the adjacency index
+   on Event the time per particle should stay roughly flat as the event grows.
+   """
+
+import time
+from app import hepmcio
+
+
+SIZES = [1000, 2000, 4000, 8000, 16000]
+
+
+def make_cascade_event(nparticles):
+    """Builds an event shaped like a binary decay cascade with displaced vertices.
+
+       Arguments:
+       nparticles -- number of particles in the event.
+
+       Returns:
+       evt -- the synthetic event.
+    """
+    evt = hepmcio.Event()
+    evt.num = 1
+    evt.no = 1
+    nvtx = nparticles // 2 + 1
+    for i in range(1, nvtx + 1):
+        evt.add_vertex(hepmcio.Vertex(pos=[0.1*i, 0.1*i, 0.1*i, 0.0], barcode=-i))
+    for bc in range(1, nparticles + 1):
+        p = hepmcio.Particle(pid=211, mom=[1.0, 1.0, 1.0, 2.0], barcode=bc)
+        #Particle bc comes out of vertex -(bc//2 + 1) and decays at vertex -(bc + 1), like a binary heap.
+        p.nvtx_start = -(bc // 2 + 1) if bc > 1 else -1
+        p.nvtx_end = -(bc + 1) if bc + 1 <= nvtx else 0
+        p.status = 1 if p.nvtx_end == 0 else 2
+        evt.add_particle(p)
+    return evt
+
+
+def time_it(fn):
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+
+def main():
+    print("%8s %16s %16s %16s" % ("N", "parents ns/p", "ancestors ns/p", "batched ns/p"))
+    for n in SIZES:
+        evt = make_cascade_event(n)
+        particles = list(evt.particles.values())
+        t_parents = time_it(lambda: [p.parents() for p in particles])
+        t_ancestors = time_it(lambda: [hepmcio.get_ancestors(p) for p in particles])
+        #A fresh event each time, so the traversal cache does not hide the walk.
+        evt = make_cascade_event(n)
+        particles = list(evt.particles.values())
+        t_batched = time_it(lambda: evt.ancestors(particles, inclusive=True))
+        print("%8d %16.0f %16.0f %16.0f" % (n, 1e9*t_parents/n, 1e9*t_ancestors/n, 1e9*t_batched/n))
+
+
+if __name__ == "__main__":
+    main()
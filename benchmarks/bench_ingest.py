@@ -0,0 +1,67 @@
+"""Benchmark for writing parsed events to MongoDB.
+
+   Compares the old upload path (JSON encode/decode per document, one insert_one plus two insert_many calls
+   per event) with the direct document builder and unordered BulkWriter batches, reporting events/sec.
+   Runs against mongomock by default, or a real mongod given with --uri.
+
+   Usage: python -m benchmarks.bench_ingest [--uri mongodb://localhost:27017/] [--batch-size N] [file]
+   """
+
+import argparse
+import json
+import os
+import time
+from app import hepmcio, hepmcio_json, ingest
+
+
+DEFAULT_FILE = os.path.join(os.path.dirname(__file__), os.pardir, "event_files", "default.hepmc")
+
+
+def get_database(uri):
+    if uri:
+        import pymongo
+        return pymongo.MongoClient(uri)["benchmarkDatabase"]
+    import mongomock
+    return mongomock.MongoClient()["benchmarkDatabase"]
+
+
+def write_legacy(events, collection):
+    "The original upload path, kept here for comparison"
+    hepMCEncoder = hepmcio_json.HepMCJSONEncoder()
+    jsonDecoder = json.JSONDecoder()
+    for event in events:
+        jsonObject = hepMCEncoder.encode(event)
+        collection.insert_one(jsonDecoder.decode(jsonObject.evt))
+        collection.insert_many([jsonDecoder.decode(p) for p in jsonObject.particles])
+        collection.insert_many([jsonDecoder.decode(v) for v in jsonObject.vertices])
+
+
+def write_bulk(events, collection, batch_size):
+    with ingest.BulkWriter(collection, batch_size) as writer:
+        for event in events:
+            writer.add(hepmcio_json.event_documents(event))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("file", nargs="?", default=DEFAULT_FILE)
+    parser.add_argument("--uri", default=None, help="MongoDB URI; uses mongomock if not given")
+    parser.add_argument("--batch-size", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=5, help="number of passes over the file's events")
+    args = parser.parse_args()
+
+    events = hepmcio.HepMCReader.fromfilename(args.file).all_events() * args.repeat
+    db = get_database(args.uri)
+    for name, write in (("legacy", write_legacy),
+                        ("bulk", lambda evts, coll: write_bulk(evts, coll, args.batch_size))):
+        collection = db["bench_" + name]
+        collection.drop()
+        start = time.perf_counter()
+        write(events, collection)
+        elapsed = time.perf_counter() - start
+        print("%-8s %8d events %10.1f events/s" % (name, len(events), len(events)/elapsed))
+        collection.drop()
+
+
+if __name__ == "__main__":
+    main()
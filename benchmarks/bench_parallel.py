@@ -0,0 +1,64 @@
+"""Benchmark for parsing HepMC files in parallel worker processes.
+
+   Builds a large file by repeating the events of a source file, then parses it into documents with
+   hepmcio_parallel.read_events for an increasing number of workers, reporting events/s and the speedup
+   over a single worker.
+
+   Usage: python -m benchmarks.bench_parallel [--copies N] [--workers 1,2,4,8] [file]
+   """
+
+import argparse
+import os
+import tempfile
+import time
+from app import hepmcio_parallel
+
+
+DEFAULT_FILE = os.path.join(os.path.dirname(__file__), os.pardir, "event_files", "default.hepmc")
+
+
+def write_copies(source, f, copies):
+    "Write a HepMC file holding the events of source repeated the given number of times"
+    with open(source, "rb") as s:
+        data = s.read()
+    first = data.index(b"\nE ") + 1
+    last = data.find(b"HepMC::IO_GenEvent-END_EVENT_LISTING")
+    last = len(data) if last < 0 else last
+    f.write(data[:first])
+    for _ in range(copies):
+        f.write(data[first:last])
+    f.write(b"HepMC::IO_GenEvent-END_EVENT_LISTING\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("file", nargs="?", default=DEFAULT_FILE)
+    parser.add_argument("--copies", type=int, default=20, help="number of times the source events are repeated")
+    #The pool is shared and capped at MAX_PROCESSES processes, so more workers than that measure nothing new.
+    parser.add_argument("--workers", default=",".join(str(2**i) for i in range(6)
+                                                      if 2**i <= hepmcio_parallel.MAX_PROCESSES),
+                        help="comma-separated worker counts to time, at most %d" % hepmcio_parallel.MAX_PROCESSES)
+    parser.add_argument("--chunk-bytes", type=int, default=4*1024*1024)
+    args = parser.parse_args()
+    workerCounts = [int(w) for w in args.workers.split(",")]
+    if max(workerCounts) > hepmcio_parallel.MAX_PROCESSES:
+        parser.error("at most %d worker processes are started" % hepmcio_parallel.MAX_PROCESSES)
+
+    with tempfile.NamedTemporaryFile(suffix=".hepmc") as f:
+        write_copies(args.file, f, args.copies)
+        f.flush()
+        size = os.path.getsize(f.name) / 1e6
+        print("%d copies of %s (%.1f MB), %d CPUs" % (args.copies, os.path.basename(args.file), size, os.cpu_count()))
+        baseline = None
+        for workers in workerCounts:
+            start = time.perf_counter()
+            nevents = sum(1 for _ in hepmcio_parallel.read_events(f.name, workers, documents=True,
+                                                                  chunk_bytes=args.chunk_bytes))
+            rate = nevents / (time.perf_counter() - start)
+            baseline = baseline or rate
+            print("%3d workers %8d events %8.1f MB/s %10.1f events/s %6.2fx" % (workers, nevents,
+                  size*rate/nevents, rate, rate/baseline))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+"""Benchmark for parsing HepMC files.
+
+   Compares the default line-by-line HepMCReader with its fast parse mode and with its lazy mode, which only
+   reads event headers, against a raw read of the file, reporting MB/s and events/s for each.
+
+   Usage: python -m benchmarks.bench_parse [--repeat N] [file ...]
+   """
+
+import argparse
+import glob
+import os
+import time
+from app import hepmcio
+
+
+DEFAULT_FILES = sorted(glob.glob(os.path.join(os.path.dirname(__file__), os.pardir, "event_files", "*.hepmc")))
+
+
+def parse(filename, mode):
+    "Parse every event in a file in the given reader mode, returning the number of events"
+    with open(filename, "r") as f:
+        if mode == "raw":
+            return sum(1 for line in f if line.startswith("E "))
+        return sum(1 for _ in hepmcio.HepMCReader(f, fast=mode == "fast", lazy=mode == "lazy"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("files", nargs="*", default=DEFAULT_FILES)
+    parser.add_argument("--repeat", type=int, default=3, help="number of timed passes over each file; the best is reported")
+    args = parser.parse_args()
+
+    for filename in args.files:
+        size = os.path.getsize(filename) / 1e6
+        print("%s (%.1f MB)" % (os.path.basename(filename), size))
+        for name in ("default", "fast", "lazy", "raw"):
+            best = float("inf")
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                nevents = parse(filename, name)
+                best = min(best, time.perf_counter() - start)
+            print("  %-8s %8d events %8.1f MB/s %10.1f events/s" % (name, nevents, size/best, nevents/best))
+
+
+if __name__ == "__main__":
+    main()
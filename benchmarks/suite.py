@@ -0,0 +1,307 @@
+"""Benchmark suite for the Visualiser's hot paths, with results that can be compared across runs.
+
+   Generates a synthetic HepMC file (see benchmarks.synthetic) and times parsing it in each HepMCReader mode,
+   the JSON encoder and decoder, ancestor walks, ingestion into mongomock (or a real mongod given with --uri)
+   and get_event requests through the Flask test client, both uncached and cached, with the file stored one
+   document per particle or in the packed layout. Each benchmark runs --warmup untimed passes, then reports
+   the median of --repeat timed passes, each started after a garbage collection and run with the collector
+   paused, as timeit does.
+
+   The speed of shared and virtual machines drifts by a factor of two from one second to the next, far more
+   than the regressions worth catching, so each timed pass is bracketed by a fixed pure-Python reference
+   workload and the benchmark is also reported relative to it. Results are written as JSON, and compared
+   against a baseline results file when one is given, by their relative times: the run fails if any benchmark
+   is slower than its baseline by more than --tolerance, and by more than --noise-floor seconds, so that the
+   jitter of millisecond benchmarks is not reported either. Comparisons are refused if the baseline was run
+   with another --events, --particles, --depth, --seed, --warmup or --repeat.
+
+   mongomock has no real indexes, so with it the ingest and uncached get_event timings are dominated by its
+   collection scans; use --uri to measure the app's own share against a real mongod.
+
+   Usage: python -m benchmarks.suite [--events N] [--particles N] [--depth N] [--warmup N] [--repeat N]
+                                     [--only NAMES] [--output FILE] [--baseline FILE] [--tolerance F]
+                                     [--noise-floor SECONDS] [--uri URI]
+
+   A baseline for the default configuration is kept in benchmarks/baseline.json. Timings depend on the
+   machine, so regenerate it with --output benchmarks/baseline.json before comparing on a new machine.
+   """
+
+import argparse
+import gc
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import types
+from collections import OrderedDict
+import numpy as np
+from app import app, event_cache, eventstore, hepmcio, hepmcio_json, ingest, routes
+from benchmarks import synthetic
+from benchmarks.bench_ingest import get_database
+
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), "baseline.json")
+
+#Untimed passes before the timed ones, and timed passes whose median is reported.
+WARMUP = 1
+REPEAT = 7
+
+#Iterations of the reference workload, which takes a few tens of milliseconds.
+REFERENCE_LOOPS = 200000
+
+#Slowdowns of at most this many seconds are within the jitter of the shortest benchmarks, so never regressions.
+NOISE_FLOOR = 0.005
+
+
+class Context(object):
+    """The inputs shared by the benchmarks: the synthetic file, its text and the database to ingest into.
+    """
+    def __init__(self, path, uri):
+        self.path = path
+        with open(path) as f:
+            self.text = f.read()
+        self.uri = uri
+
+    def events(self):
+        "Parse the file's events afresh, so no benchmark sees results cached by an earlier one"
+        return hepmcio.HepMCReader(io.StringIO(self.text), fast=True).all_events()
+
+    def database(self):
+        return get_database(self.uri)
+
+
+def parse(mode):
+    "Benchmark reading every event of the file's text in a HepMCReader mode"
+    def run(ctx, _):
+        return sum(1 for _ in hepmcio.HepMCReader(io.StringIO(ctx.text), **mode))
+    return None, run
+
+
+def json_encode():
+    encoder = hepmcio_json.HepMCJSONEncoder()
+    return (lambda ctx: ctx.events()), (lambda ctx, events: len([encoder.encode(evt) for evt in events]))
+
+
+def json_decode():
+    encoder = hepmcio_json.HepMCJSONEncoder()
+    decoder = hepmcio_json.HepMCJSONDecoder()
+    return ((lambda ctx: [encoder.encode(evt) for evt in ctx.events()]),
+            (lambda ctx, objects: len([decoder.decode(obj) for obj in objects])))
+
+
+def ancestors():
+    "Benchmark get_ancestors for every final-state particle, on freshly parsed events each pass"
+    def run(ctx, events):
+        for evt in events:
+            for p in evt.particles.values():
+                if p.status == 1:
+                    hepmcio.get_ancestors(p)
+        return len(events)
+    return (lambda ctx: ctx.events()), run
+
+
+def ingest_file(layout=eventstore.DOCUMENTS):
+    def setup(ctx):
+        collection = ctx.database()["bench_suite_" + layout]
+        collection.drop()
+        return collection
+    def run(ctx, collection):
+        return ingest.ingest_file(ctx.path, collection, workers=1, layout=layout)["events"]
+    return setup, run
+
+
+def get_event(cached, binary=False, layout=eventstore.DOCUMENTS):
+    "Benchmark get_event requests for every event of an uploaded file, with or without the payload cache"
+    state = {"filename":"bench_suite_view_" + layout}
+    def setup(ctx):
+        if "client" not in state:
+            db = ctx.database()
+            db[state["filename"]].drop()
+            state["nevents"] = ingest.ingest_file(ctx.path, db[state["filename"]], workers=1, layout=layout)["events"]
+            state["db"] = db
+            state["client"] = app.test_client()
+        event_cache.invalidate(state["filename"])
+        if cached:
+            _requests(state, binary)
+        return state
+    def run(ctx, state):
+        return _requests(state, binary)
+    return setup, run
+
+
+def _requests(state, binary):
+    "Request every event of the benchmark file, with the app wired to the benchmark database"
+    mongo = routes.mongo
+    #Prefetching would compete with the timed requests, and mongomock is not thread-safe.
+    routes.mongo = types.SimpleNamespace(db=state["db"])
+    routes.prefetcher.prefetch_neighbours = lambda *args, **kwargs: None
+    try:
+        query = "&format=binary" if binary else ""
+        for no in range(1, state["nevents"] + 1):
+            response = state["client"].get("/visualiser/get_event?filename=%s&no=%d%s" % (state["filename"], no, query))
+            if response.status_code != 200:
+                raise RuntimeError("get_event returned %s for event %d" % (response.status, no))
+    finally:
+        routes.mongo = mongo
+        del routes.prefetcher.prefetch_neighbours
+    return state["nevents"]
+
+
+#Benchmark name -> (setup, run). setup(ctx) prepares the input of each pass outside the timing, run(ctx, input)
+#does the timed work and returns the number of events processed.
+BENCHMARKS = OrderedDict([
+    ("parse_default", parse({})),
+    ("parse_fast", parse({"fast": True})),
+    ("parse_lazy", parse({"lazy": True})),
+    ("json_encode", json_encode()),
+    ("json_decode", json_decode()),
+    ("ancestors", ancestors()),
+    ("ingest", ingest_file()),
+    ("ingest_packed", ingest_file(eventstore.PACKED)),
+    ("get_event_uncached", get_event(cached=False)),
+    ("get_event_binary_uncached", get_event(cached=False, binary=True)),
+    ("get_event_packed_uncached", get_event(cached=False, layout=eventstore.PACKED)),
+    ("get_event_packed_binary_uncached", get_event(cached=False, binary=True, layout=eventstore.PACKED)),
+    ("get_event_cached", get_event(cached=True)),
+])
+
+
+def reference():
+    """Times the fixed reference workload, a pure-Python loop of dict stores and string formatting like the
+       parsers' and encoders' own work, returning its duration in seconds.
+    """
+    start = time.perf_counter()
+    table = {}
+    for i in range(REFERENCE_LOOPS):
+        table[i % 1000] = str(i)
+    return time.perf_counter() - start
+
+
+def run_benchmark(ctx, setup, run, repeat, warmup=WARMUP):
+    """Runs a benchmark warmup times untimed, to fill caches and settle the allocator, then repeat times timed.
+       The garbage collector is paused during each timed pass, so that the time of collecting the objects of
+       earlier passes is not charged to whichever pass happens to trigger it. Each timed pass is bracketed by
+       runs of the reference workload, and its time divided by theirs, which cancels out the drift of the
+       machine's speed.
+
+       Returns:
+       The number of events processed, the median and the fastest of the timed passes in seconds, and the
+       median of the passes' times relative to the reference workload.
+    """
+    for _ in range(warmup):
+        run(ctx, setup(ctx) if setup is not None else None)
+    times, relative = [], []
+    for _ in range(repeat):
+        data = setup(ctx) if setup is not None else None
+        gc.collect()
+        gcEnabled = gc.isenabled()
+        gc.disable()
+        try:
+            before = reference()
+            start = time.perf_counter()
+            count = run(ctx, data)
+            seconds = time.perf_counter() - start
+            after = reference()
+        finally:
+            if gcEnabled:
+                gc.enable()
+        times.append(seconds)
+        relative.append(2*seconds/(before + after))
+    return count, float(np.median(times)), min(times), float(np.median(relative))
+
+
+def compare(results, baseline, tolerance, noise_floor=NOISE_FLOOR):
+    """Compares results against baseline results, printing the change of each benchmark.
+
+       Arguments:
+       results, baseline -- results dicts as written by main.
+       tolerance -- the largest slowdown allowed, as a fraction of the baseline time.
+       noise_floor -- slowdowns of at most this many seconds are never regressions, however large a fraction
+       of the baseline time they are.
+
+       Returns:
+       The names of the benchmarks slower than their baseline by more than both the tolerance and the noise floor.
+       The change of each benchmark is that of its time relative to the reference workload.
+
+       Raises:
+       ValueError if the baseline was run with another configuration, as its timings are then not comparable.
+    """
+    if baseline["config"] != results["config"]:
+        raise ValueError("baseline was run with %s, not %s" % (baseline["config"], results["config"]))
+    regressions = []
+    print("%-34s %12s %12s %11s" % ("benchmark", "baseline s", "now s", "rel change"))
+    for name, result in results["benchmarks"].items():
+        base = baseline["benchmarks"].get(name)
+        if base is None:
+            print("%-34s %12s %12.4f" % (name, "-", result["seconds"]))
+            continue
+        change = result["relative"]/base["relative"] - 1
+        flag = ""
+        if change > tolerance and change*base["seconds"] > noise_floor:
+            regressions.append(name)
+            flag = " REGRESSION"
+        print("%-34s %12.4f %12.4f %+10.1f%%%s" % (name, base["seconds"], result["seconds"], 100*change, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--events", type=int, default=10)
+    parser.add_argument("--particles", type=int, default=1000, help="particles per event, besides the beams")
+    parser.add_argument("--depth", type=int, default=3, help="decay generations in each decay tree")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--warmup", type=int, default=WARMUP, help="number of untimed passes before the timed ones")
+    parser.add_argument("--repeat", type=int, default=REPEAT, help="number of timed passes; the median is reported")
+    parser.add_argument("--only", default=None, help="comma-separated benchmark names to run")
+    parser.add_argument("--output", default=None, help="file to write the results to as JSON")
+    parser.add_argument("--baseline", default=None, help="results file to compare against, e.g. %s" % DEFAULT_BASELINE)
+    parser.add_argument("--tolerance", type=float, default=0.25, help="slowdown allowed before a regression is reported")
+    parser.add_argument("--noise-floor", type=float, default=NOISE_FLOOR,
+                        help="slowdown in seconds below which no regression is reported")
+    parser.add_argument("--uri", default=None, help="MongoDB URI; uses mongomock if not given")
+    args = parser.parse_args()
+
+    names = args.only.split(",") if args.only else list(BENCHMARKS)
+    unknown = set(names) - set(BENCHMARKS)
+    if unknown:
+        parser.error("unknown benchmarks: %s" % ", ".join(sorted(unknown)))
+    config = {"events": args.events, "particles": args.particles, "depth": args.depth, "seed": args.seed,
+              "warmup": args.warmup, "repeat": args.repeat}
+    baseline = None
+    if args.baseline:
+        #Checked before running anything, as timings of another configuration cannot be compared.
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline["config"] != config:
+            parser.error("baseline was run with %s, not %s" % (baseline["config"], config))
+    results = {"config": config,
+               "environment": {"python": platform.python_version(), "numpy": np.__version__,
+                               "platform": platform.platform(), "cpus": os.cpu_count()},
+               "benchmarks": OrderedDict()}
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "synthetic.hepmc")
+        synthetic.generate(path, args.events, args.particles, args.depth, args.seed)
+        ctx = Context(path, args.uri)
+        print("%d events of %d particles, depth %d (%.1f MB)" % (args.events, args.particles, args.depth,
+                                                                os.path.getsize(path)/1e6))
+        for name in names:
+            setup, run = BENCHMARKS[name]
+            count, seconds, fastest, relative = run_benchmark(ctx, setup, run, args.repeat, args.warmup)
+            results["benchmarks"][name] = {"seconds": seconds, "min_seconds": fastest, "relative": relative,
+                                           "events": count, "events_per_second": count/seconds}
+            print("  %-34s %10.4f s %10.1f events/s %8.2f x reference" % (name, seconds, count/seconds, relative))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if baseline is not None:
+        regressions = compare(results, baseline, args.tolerance, args.noise_floor)
+        if regressions:
+            print("Slower than baseline by more than %d%%: %s" % (100*args.tolerance, ", ".join(regressions)))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
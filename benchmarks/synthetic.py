@@ -0,0 +1,103 @@
+"""Generator of synthetic HepMC files for benchmarks. Each event holds two beam particles meeting at the
+   origin and a forest of binary decay trees of a given depth coming out of it, with displaced decay
+   vertices so that ancestor walks go all the way up each tree. Files of any size can be made, from a few
+   events to events with tens of thousands of particles, and the same seed always gives the same file.
+
+   Usage: python -m benchmarks.synthetic [--events N] [--particles N] [--depth N] [--seed N] output
+   """
+
+import argparse
+import numpy as np
+from app import hepmcio
+
+
+#PDG IDs given to the generated particles, roughly in the proportions of a hadron collider event.
+PIDS = np.array([211, -211, 211, -211, 111, 22, 22, 321, -321, 2212, -2212, 11, -11, 13, -13, 12])
+
+
+def make_event(num, nparticles, depth, rng):
+    """Builds a synthetic event.
+
+       Arguments:
+       num -- the event's barcode.
+       nparticles -- the number of particles after the two beams.
+       depth -- the number of decay generations in each tree; 0 gives only stable particles.
+       rng -- the numpy RandomState to draw from.
+
+       Returns:
+       The hepmcio Event.
+    """
+    evt = hepmcio.Event()
+    evt.num = num
+    evt.weights = [1.0]
+    evt.units = ["GEV", "MM"]
+    evt.xsec = [1.0e2, 1.0]
+    evt.add_vertex(hepmcio.Vertex([0.0, 0.0, 0.0, 0.0], -1))
+    for bc, pz in ((1, 6500.0), (2, -6500.0)):
+        beam = hepmcio.Particle(2212, [0.0, 0.0, pz, 6500.0], bc)
+        beam.status, beam.mass, beam.nvtx_start, beam.nvtx_end = 4, 0.938, None, -1
+        evt.add_particle(beam)
+    #Momenta drawn isotropically in the transverse plane with an exponential pT spectrum.
+    pt = rng.exponential(5.0, nparticles) + 0.1
+    phi = rng.uniform(-np.pi, np.pi, nparticles)
+    eta = rng.uniform(-4.0, 4.0, nparticles)
+    mom = np.stack([pt*np.cos(phi), pt*np.sin(phi), pt*np.sinh(eta), pt*np.cosh(eta) + 0.14], axis=1).tolist()
+    pids = rng.choice(PIDS, nparticles).tolist()
+    decay = rng.uniform(0.01, 1.0, nparticles).tolist()
+    #Particles are numbered within each tree like a binary heap: node k decays into nodes 2k and 2k+1.
+    tree = 2**(depth + 1) - 1
+    nvertices = 1
+    heap = {}
+    for i in range(nparticles):
+        k = i % tree + 1
+        if k == 1:
+            heap = {}
+            start = -1
+        else:
+            start = heap[k//2]
+        p = hepmcio.Particle(pids[i], mom[i], i + 3)
+        p.mass, p.nvtx_start = 0.14, start
+        if 2*k <= tree and i + 2*k - k < nparticles:
+            #Unstable: decays at a vertex displaced from where it was made, along its momentum.
+            nvertices += 1
+            origin = evt.vertices[start].pos
+            scale = decay[i] / np.sqrt(mom[i][0]**2 + mom[i][1]**2 + mom[i][2]**2)
+            evt.add_vertex(hepmcio.Vertex([origin[j] + scale*mom[i][j] for j in range(3)] + [origin[3] + decay[i]],
+                                          -nvertices))
+            p.status, p.nvtx_end = 2, -nvertices
+            heap[k] = -nvertices
+        else:
+            p.status, p.nvtx_end = 1, 0
+        evt.add_particle(p)
+    return evt
+
+
+def generate(filename, events=100, particles=1000, depth=3, seed=0):
+    """Writes a synthetic HepMC file, gzip-compressed if its name ends in .gz.
+
+       Arguments:
+       filename -- path of the file to write.
+       events -- the number of events.
+       particles -- the number of particles in each event, besides the two beams.
+       depth -- the number of decay generations in each decay tree.
+       seed -- the random seed.
+    """
+    rng = np.random.RandomState(seed)
+    with hepmcio.HepMCWriter(filename) as writer:
+        for num in range(events):
+            writer.write_next(make_event(num, particles, depth, rng))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("output")
+    parser.add_argument("--events", type=int, default=100)
+    parser.add_argument("--particles", type=int, default=1000, help="particles per event, besides the beams")
+    parser.add_argument("--depth", type=int, default=3, help="decay generations in each decay tree")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    generate(args.output, args.events, args.particles, args.depth, args.seed)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,28 @@
 import unittest
+import contextlib
+import io
 import os
+import sys
+import tempfile
+import gzip
+import bz2
+import lzma
 import json
-from app import app, mongo, hepmcio, hepmcio_json
+import math
+import numpy
+import pstats
+import time
+import types
+from app import app, mongo, hepmcio, hepmcio_json, hepmcio_columnar, hepmcio_parallel, ingest, eventview, cache, prefetch, \
+    selection, jobs, eventbinary, trajectory, skim, timing, eventstore, packedstore, routes
+from benchmarks import synthetic, suite
+
+try:
+    import mongomock
+    import mongomock.gridfs
+    mongomock.gridfs.enable_gridfs_integration()
+except ImportError:
+    mongomock = None
 
 __author__ = "Darius Darulis"
 __version__ = "1.0"
@@ -11,6 +32,26 @@ testVertex = None
 testEvent = None
 
 
+class RecordingCollection(object):
+    """
+    Stand-in for a MongoDB collection that records the documents passed to each insert.
+    """
+    def __init__(self):
+        self.batches = []
+
+    def insert_many(self, documents, ordered=True):
+        self.batches.append(list(documents))
+
+    def insert_one(self, document):
+        self.batches.append([document])
+
+    def create_index(self, keys):
+        pass
+
+    @property
+    def documents(self):
+        return [d for batch in self.batches for d in batch]
+
 
 class HepMCTests(unittest.TestCase):
     """
@@ -25,6 +66,33 @@ class HepMCTests(unittest.TestCase):
     testVertexEncoder -- tests encoding vertices into JSON and decoding them back.
     testEventEncoder -- tests encoding events into JSON and decoding them back.
     testHepMCEncodeParticle -- 
+    testGraphNavigation -- tests that the event adjacency index agrees with a scan over all particles.
+    testDecodedGraphNavigation -- tests that decoding an event from JSON rebuilds its adjacency index.
+    testAncestors -- tests the batched ancestor walk on a decay chain deeper than the recursion limit.
+    testParticleTable -- tests charge lookups by PID, including antiparticles and vectorized lookups.
+    testIngestStream -- tests that streaming ingestion inserts every document in bounded batches, then the manifest.
+    testEventDocuments -- tests that the direct document builder matches the JSON encoders.
+    testEventFromDocuments -- tests rebuilding an event graph from its documents and selecting particles on it.
+    testManifest -- tests that manifests are built once for old uploads, and never for files not uploaded.
+    testPayloadCache -- tests LRU eviction, the memory cap, invalidation and the hit/miss counters.
+    testPrefetchNeighbours -- tests that neighbouring events are prefetched into the payload cache.
+    testPackedStorage -- tests that packed events, spilled or not, give the same views as per-particle documents.
+    testReadEvent -- tests random access to events through the byte-offset event index.
+    testFastReader -- tests that the fast parse mode produces the same events as the default mode.
+    testLazyEvents -- tests that lazily read events match eagerly read ones once loaded, and can be unloaded.
+    testHepMCWriter -- tests that written files, plain or gzipped, read back as the events written, and skims.
+    testSyntheticEvents -- tests that generated benchmark files are reproducible, valid and as deep as asked.
+    testBenchmarkCompare -- tests that benchmark regressions are judged relative to the reference workload.
+    testParallelRead -- tests that parsing and ingesting in worker processes matches a single reader.
+    testCompressedInput -- tests reading gzip, bz2 and xz compressed files, detected from their contents, in every reader.
+    testViewThenUpload -- tests that viewing a file from disk leaves it free to be uploaded.
+    testUploadJobs -- tests background upload jobs, their progress reports and the clean-up after a failure.
+    testBinaryPayload -- tests the packed binary event format against the particles and vertices it encodes.
+    testTrackBudget -- tests the top-N track budget, its preserved ancestors and the bundles of soft particles.
+    testTrajectories -- tests helix and straight-line propagation and the encoded, cached tracks of an event.
+    testColumnarEvents -- tests the columnar views against parsed events, after a memory-mapped round trip.
+    testSelection -- tests vectorized cuts and cuts built from query parameters against per-particle loops.
+    testStageTiming -- tests stage timings, their Server-Timing header, the metrics histograms and profile dumps.
     """
 
     def setUp(self):
@@ -37,6 +105,33 @@ class HepMCTests(unittest.TestCase):
     def tearDown(self):
         pass
 
+    def mockDatabase(self):
+        """
+        Points the app at a mongomock database for the rest of the test, and returns the database.
+        """
+        db = mongomock.MongoClient().db
+        mongo = routes.mongo
+        routes.mongo = types.SimpleNamespace(db=db)
+        #mongomock is not thread-safe, so nothing may be prefetched in the background; the calls are only recorded.
+        self.prefetched = []
+        routes.prefetcher.prefetch_neighbours = lambda *args, **kwargs: self.prefetched.append(args[1:3])
+        def restore():
+            routes.mongo = mongo
+            del routes.prefetcher.prefetch_neighbours
+        self.addCleanup(restore)
+        return db
+
+    def upload(self, filename, name, **form):
+        """
+        Uploads a file through the app and waits for its upload job, returning the uploader's response.
+        """
+        with open(filename, "rb") as f:
+            response = self.app.post("/uploader", data=dict(form, file=(f, name)), content_type="multipart/form-data")
+        if response.status_code == 202:
+            while routes.upload_jobs.get(response.get_json()["id"]).state in (jobs.QUEUED, jobs.RUNNING):
+                time.sleep(0.01)
+        return response
+
     def openEvent(self, filename="/event_files/default.hepmc"):
         filename = os.getcwd() + filename
         return hepmcio.HepMCReader.fromfilename(filename).next()
@@ -83,7 +178,598 @@ class HepMCTests(unittest.TestCase):
         jsonified = hepMCEncoder.encode(evt)
         deJsonified = hepMCDecoder.decode(jsonified)
         self.assertEqual(evt, deJsonified)
-        
+
+    def testGraphNavigation(self):
+        evt = self.openEvent()
+        for v in evt.vertices.values():
+            self.assertEqual(v.parents(), [p for p in evt.particles.values() if p.nvtx_end == v.barcode])
+            self.assertEqual(v.children(), [p for p in evt.particles.values() if p.nvtx_start == v.barcode])
+
+    def testDecodedGraphNavigation(self):
+        evt = self.openEvent()
+        hepMCEncoder = hepmcio_json.HepMCJSONEncoder()
+        hepMCDecoder = hepmcio_json.HepMCJSONDecoder()
+        deJsonified = hepMCDecoder.decode(hepMCEncoder.encode(evt))
+        for bc, p in evt.particles.items():
+            decoded = deJsonified.particles[bc]
+            self.assertEqual([q.barcode for q in p.parents() or []], [q.barcode for q in decoded.parents() or []])
+            self.assertEqual([q.barcode for q in p.children() or []], [q.barcode for q in decoded.children() or []])
+
+    def testAncestors(self):
+        #A single chain: particle i is produced at displaced vertex -i and decays at vertex -(i+1).
+        depth = sys.getrecursionlimit() + 100
+        evt = hepmcio.Event()
+        for i in range(1, depth + 2):
+            evt.add_vertex(hepmcio.Vertex(pos=[1.0, 0, 0, 0], barcode=-i))
+        for i in range(1, depth + 1):
+            p = hepmcio.Particle(barcode=i)
+            p.nvtx_start = -i
+            p.nvtx_end = -(i + 1)
+            evt.add_particle(p)
+        last = evt.particles[depth]
+        ancestors = evt.ancestors([last, evt.particles[depth - 1]])
+        self.assertEqual([p.barcode for p in ancestors], list(range(depth - 2, 0, -1)))
+        self.assertEqual(hepmcio.get_ancestors(last)[-1], last)
+        self.assertEqual(len(evt.descendants([evt.particles[1]], inclusive=True)), depth)
+        #Particles from elsewhere are rejected, and the cache of walks stays bounded.
+        with self.assertRaisesRegex(ValueError, "not in this event"):
+            evt.ancestors([hepmcio.Particle(barcode=depth + 1)])
+        for p in list(evt.particles.values())[:hepmcio.TRAVERSAL_CACHE_SIZE + 10]:
+            evt.ancestors([p])
+        self.assertEqual(len(evt._traversals), hepmcio.TRAVERSAL_CACHE_SIZE)
+        self.assertEqual(len(evt.ancestors([last])), depth - 1)
+
+    def testParticleTable(self):
+        table = hepmcio.particle_table()
+        self.assertIs(table, hepmcio.particle_table())
+        self.assertAlmostEqual(table.charge(6), 2/3)
+        self.assertAlmostEqual(table.charge(-6), -2/3)
+        self.assertEqual(table.charge(11), -1.0)
+        self.assertEqual(table.charge(-11), 1.0)
+        self.assertEqual(list(table.charges([11, -11, 22, 0])), [-1.0, 1.0, 0.0, 0.0])
+        evt = self.openEvent()
+        for p in evt.particles.values():
+            self.assertEqual(p.charge, table.charge(p.pid))
+
+    def testIngestStream(self):
+        filename = os.getcwd() + "/event_files/top-reduced.hepmc"
+        events = hepmcio.HepMCReader.fromfilename(filename).all_events()
+        collection = RecordingCollection()
+        with open(filename, "rb") as f:
+            manifest = ingest.ingest_stream(io.TextIOWrapper(f, encoding="utf-8"), collection, batch_size=500)
+        self.assertEqual(manifest, {"type":"manifest", "layout":eventstore.DOCUMENTS, "events":len(events)})
+        self.assertEqual(collection.batches[-1], [manifest])
+        self.assertTrue(all(len(batch) <= 500 for batch in collection.batches))
+        documents = collection.documents[:-1]
+        eventDocuments = [d for d in documents if d["type"] == "event"]
+        self.assertEqual([d["no"] for d in eventDocuments], list(range(1, len(events) + 1)))
+        self.assertEqual([(d["barcode"], d["nparticles"], d["nvertices"]) for d in eventDocuments],
+                         [(e.num, len(e.particles), len(e.vertices)) for e in events])
+        self.assertEqual(len(documents), sum(len(e.particles) + len(e.vertices) + 1 for e in events))
+
+    def testEventDocuments(self):
+        evt = self.openEvent()
+        jsonified = hepmcio_json.HepMCJSONEncoder().encode(evt)
+        jsonDecoder = json.JSONDecoder()
+        expected = [jsonDecoder.decode(jsonified.evt)] + [jsonDecoder.decode(p) for p in jsonified.particles] + \
+            [jsonDecoder.decode(v) for v in jsonified.vertices]
+        self.assertEqual(hepmcio_json.event_documents(evt), expected)
+
+    def testEventFromDocuments(self):
+        evt = self.openEvent()
+        documents = hepmcio_json.event_documents(evt)
+        particles = [d for d in documents if d["type"] == "particle"]
+        vertices = [d for d in documents if d["type"] == "vertex"]
+        rebuilt = hepmcio_json.event_from_documents(documents[0], particles, vertices)
+        self.assertEqual(evt, rebuilt)
+        self.assertEqual(set(evt.particles), set(rebuilt.particles))
+        selected = eventview.select_particles(rebuilt)
+        self.assertEqual(len(selected), len(set(p.barcode for p in selected)))
+        self.assertTrue(all(p.status != 1 for p in selected))
+
+    @unittest.skipIf(mongomock is None, "mongomock not installed")
+    def testManifest(self):
+        db = mongomock.MongoClient().db
+        #Looking up a file that was never uploaded must not create its collection.
+        self.assertIsNone(eventstore.get_manifest(db["missing"]))
+        self.assertNotIn("missing", db.list_collection_names())
+        manifest = ingest.ingest_file(os.getcwd() + "/event_files/top-reduced.hepmc", db["top"], workers=1)
+        #Collections uploaded without a manifest get one built on first access, and only one.
+        db["top"].delete_many({"type":"manifest"})
+        for _ in range(2):
+            self.assertEqual(eventstore.get_manifest(db["top"]), manifest)
+        self.assertEqual(db["top"].count_documents({"type":"manifest"}), 1)
+        #The per-event arrays of manifests written by older uploads are not read back.
+        db["top"].update_one({"type":"manifest"}, {"$set":{"barcodes":[1], "particles":[2], "vertices":[3]}})
+        self.assertEqual(eventstore.get_manifest(db["top"]), manifest)
+
+    def testPayloadCache(self):
+        payloads = cache.PayloadCache(max_entries=2, max_bytes=10)
+        payloads.put(("a", 1), b"1234")
+        payloads.put(("a", 2), b"1234")
+        self.assertEqual(payloads.get(("a", 1)), b"1234")
+        payloads.put(("b", 1), b"1234")
+        self.assertIsNone(payloads.get(("a", 2)))
+        payloads.put(("b", 2), b"123456")
+        self.assertIsNone(payloads.get(("a", 1)))
+        self.assertEqual(payloads.get(("b", 2)), b"123456")
+        payloads.invalidate("b")
+        self.assertIsNone(payloads.get(("b", 2)))
+        self.assertEqual(payloads.stats(), {"hits":2, "misses":3, "evictions":2, "entries":0, "bytes":0})
+
+    @unittest.skipIf(mongomock is None, "mongomock not installed")
+    def testPrefetchNeighbours(self):
+        collection = mongomock.MongoClient().db["top"]
+        with open(os.getcwd() + "/event_files/top-reduced.hepmc", "rb") as f:
+            ingest.ingest_stream(io.TextIOWrapper(f, encoding="utf-8"), collection)
+        payloads = cache.PayloadCache()
+        #mongomock is not thread-safe, so use one worker and let it finish before querying from this thread.
+        prefetcher = prefetch.Prefetcher(payloads, max_workers=1)
+        #Events past either end of the file are not prefetched.
+        prefetcher.prefetch_neighbours(collection, 1, 1)
+        self.assertEqual(prefetcher.submitted, 0)
+        prefetcher.prefetch_neighbours(collection, 2, 3)
+        keys = [eventview.view_key(collection, no) for no in (1, 3)]
+        for key in keys:
+            prefetcher.wait(key)
+        for no, key in zip((1, 3), keys):
+            self.assertEqual(payloads.get(key), eventview.cached_event_view(collection, no, cache.PayloadCache()))
+        prefetcher.shutdown()
+        self.assertFalse(payloads.contains(eventview.view_key(collection, 2)))
+
+    @unittest.skipIf(mongomock is None, "mongomock not installed")
+    def testPackedStorage(self):
+        filename = os.getcwd() + "/event_files/top-reduced.hepmc"
+        db = mongomock.MongoClient().db
+        manifest = ingest.ingest_file(filename, db["documents"], workers=1)
+        packedManifest = ingest.ingest_file(filename, db["packed"], workers=2, layout=eventstore.PACKED)
+        self.assertEqual((manifest["layout"], packedManifest["layout"]), (eventstore.DOCUMENTS, eventstore.PACKED))
+        self.assertEqual(packedManifest["events"], manifest["events"])
+        self.assertEqual([(e["nparticles"], e["nvertices"]) for e in db["packed"].find({"type":"event"}).sort("no")],
+                         [(e["nparticles"], e["nvertices"]) for e in db["documents"].find({"type":"event"}).sort("no")])
+        self.assertEqual(db["packed"].count_documents({}), manifest["events"] + 1)
+        #Converted in place, with the larger events spilled to GridFS.
+        ingest.ingest_file(filename, db["migrated"], workers=1)
+        self.assertEqual(packedstore.migrate(db["migrated"], max_bytes=60000), packedManifest)
+        spilled = ["gridfs" in e for e in db["migrated"].find({"type":"event"})]
+        self.assertTrue(any(spilled) and not all(spilled))
+        self.assertNotIn("migrated" + packedstore.MIGRATION_SUFFIX, db.list_collection_names())
+        cuts = (selection.DEFAULT_CUT, selection.from_args({"pid":"6"}), selection.from_args({"max_tracks":"5", "bundle":"1"}))
+        for no in range(1, manifest["events"] + 1):
+            for cut in cuts:
+                view = eventview.event_view(db["documents"], no, cut)
+                binary = eventview.encoded_event_view(db["documents"], no, cut, binary=True)
+                for name in ("packed", "migrated"):
+                    self.assertEqual(eventview.event_view(db[name], no, cut), view)
+                    self.assertEqual(eventview.encoded_event_view(db[name], no, cut, binary=True), binary)
+        evt = eventview.load_event(db["packed"], 2)[0]
+        self.assertFalse(evt.store.particles.flags.writeable)
+        packedstore.drop(db["migrated"])
+        self.assertNotIn("migrated", db.list_collection_names())
+        self.assertEqual(db[packedstore.GRIDFS_BUCKET + ".files"].count_documents({}), 0)
+        #A file with a gap in its event numbers is refused before anything is written.
+        ingest.ingest_file(filename, db["gap"], workers=1)
+        db["gap"].delete_one({"type":"event", "no":2})
+        count = db["gap"].count_documents({})
+        with self.assertRaisesRegex(ValueError, r"missing events \[2\]"):
+            packedstore.migrate(db["gap"], max_bytes=60000)
+        self.assertEqual(db["gap"].count_documents({}), count)
+        self.assertNotIn("gap" + packedstore.MIGRATION_SUFFIX, db.list_collection_names())
+        self.assertEqual(db[packedstore.GRIDFS_BUCKET + ".files"].count_documents({}), 0)
+
+    def testReadEvent(self):
+        filename = os.getcwd() + "/event_files/top-reduced.hepmc"
+        events = hepmcio.HepMCReader.fromfilename(filename).all_events()
+        with open(filename, "rb") as f:
+            index = hepmcio.index_events(f)
+        self.assertEqual(len(index), len(events))
+        reader = hepmcio.HepMCReader.fromfilename(filename, index=index)
+        for no in reversed(range(1, len(events) + 1)):
+            evt = reader.read_event(no)
+            self.assertEqual(evt, events[no - 1])
+            self.assertEqual(evt.no, no)
+            self.assertEqual(set(evt.particles), set(events[no - 1].particles))
+        self.assertIsNone(reader.read_event(len(events) + 1))
+        #Without an index the reader builds one on first use.
+        self.assertEqual(hepmcio.HepMCReader.fromfilename(filename).read_event(2), events[1])
+        #In-memory text is indexed by character, other text-only streams cannot seek.
+        with open(filename) as f:
+            text = f.read()
+        self.assertEqual(hepmcio.HepMCReader(io.StringIO(text)).read_event(3), events[2])
+        self.assertEqual(hepmcio.HepMCReader(io.StringIO(text), fast=True).read_event(2), events[1])
+        class TextOnly(io.TextIOBase):
+            def __init__(self, text):
+                self._lines = iter(text.splitlines(True))
+            def readline(self, size=-1):
+                return next(self._lines, "")
+        with self.assertRaisesRegex(ValueError, "binary-backed"):
+            hepmcio.HepMCReader(TextOnly(text)).read_event(2)
+        #A damaged sidecar index is rebuilt, and replaced whole.
+        with tempfile.TemporaryDirectory() as tmp:
+            copy = tmp + "/top.hepmc"
+            with open(filename, "rb") as source, open(copy, "wb") as f:
+                f.write(source.read())
+            with open(copy + ".idx.npy", "wb") as f:
+                f.write(b"\x93NUMPY truncated")
+            self.assertTrue((hepmcio.load_event_index(copy) == index).all())
+            self.assertTrue((numpy.load(copy + ".idx.npy") == index).all())
+            self.assertEqual(sorted(os.listdir(tmp)), ["top.hepmc", "top.hepmc.idx.npy"])
+
+    def testFastReader(self):
+        filename = os.getcwd() + "/event_files/top-reduced.hepmc"
+        events = hepmcio.HepMCReader.fromfilename(filename).all_events()
+        reader = hepmcio.HepMCReader.fromfilename(filename, fast=True)
+        #Small blocks so that event boundaries fall across reads.
+        reader.BLOCK_SIZE = 97
+        fastEvents = reader.all_events()
+        self.assertEqual(fastEvents, events)
+        for evt, fastEvt in zip(events, fastEvents):
+            self.assertEqual(fastEvt.no, evt.no)
+            self.assertEqual(hepmcio_json.event_documents(fastEvt), hepmcio_json.event_documents(evt))
+        reader = hepmcio.HepMCReader.fromfilename(filename, fast=True)
+        self.assertEqual(reader.read_event(3), events[2])
+        self.assertEqual(reader.next(), events[3])
+
+    def testLazyEvents(self):
+        filename = os.getcwd() + "/event_files/top-reduced.hepmc"
+        events = hepmcio.HepMCReader.fromfilename(filename).all_events()
+        reader = hepmcio.HepMCReader.fromfilename(filename, lazy=True)
+        reader.BLOCK_SIZE = 97
+        lazyEvents = reader.all_events()
+        #Headers are read straight away, the particles and vertices only when first used.
+        self.assertEqual(lazyEvents, events)
+        self.assertEqual([(e.no, e.units, e.xsec) for e in lazyEvents], [(e.no, e.units, e.xsec) for e in events])
+        self.assertFalse(any(e._loaded for e in lazyEvents))
+        for evt, lazyEvt in zip(events, lazyEvents):
+            self.assertEqual(hepmcio_json.event_documents(lazyEvt), hepmcio_json.event_documents(evt))
+        lazyEvt = lazyEvents[1]
+        ancestors = [p.barcode for p in lazyEvt.ancestors(lazyEvt.particles.values())]
+        lazyEvt.unload()
+        self.assertFalse(lazyEvt._loaded)
+        self.assertEqual([p.barcode for p in lazyEvt.ancestors(lazyEvt.particles.values())], ancestors)
+        self.assertRaises(ValueError, events[0].unload)
+        #An event whose body cannot be parsed raises each time it is used, and is never left partly loaded.
+        with open(filename) as f:
+            text = f.read()
+        start = text.index("\nP ", text.index("\nV ")) + 1
+        with tempfile.TemporaryDirectory() as tmp:
+            with open(tmp + "/bad.hepmc", "w") as f:
+                f.write(text[:start] + "P 1 2 x" + text[text.index("\n", start):])
+            badEvt = hepmcio.HepMCReader.fromfilename(tmp + "/bad.hepmc", lazy=True).next()
+        for attempt in range(2):
+            self.assertRaises(ValueError, badEvt.load)
+            self.assertFalse(badEvt._loaded)
+            self.assertEqual((badEvt._particles, badEvt._vertices), ({}, {}))
+
+    def testHepMCWriter(self):
+        filename = os.getcwd() + "/event_files/top-reduced.hepmc"
+        events = hepmcio.HepMCReader.fromfilename(filename).all_events()
+        with tempfile.TemporaryDirectory() as tmp:
+            for out in (tmp + "/out.hepmc", tmp + "/out.hepmc.gz"):
+                with hepmcio.HepMCWriter(out) as writer:
+                    self.assertEqual(writer.write_events(events), len(events))
+                written = hepmcio.HepMCReader.fromfilename(out).all_events()
+                self.assertEqual(written, events)
+                for evt, writtenEvt in zip(events, written):
+                    self.assertEqual(hepmcio_json.event_documents(writtenEvt), hepmcio_json.event_documents(evt))
+            self.assertEqual(hepmcio.compression(tmp + "/out.hepmc.gz"), "gzip")
+            #Skims keep the events with enough particles passing the cut, in order.
+            cut = selection.from_args({"pt_min":"100", "pid":"6"})
+            keep = skim.has_particles(cut, 2)
+            self.assertEqual(skim.skim_file(filename, tmp + "/skim.hepmc.gz", keep), (len(events), 2))
+            self.assertEqual(hepmcio.HepMCReader.fromfilename(tmp + "/skim.hepmc.gz").all_events(),
+                             [evt for evt in events if keep(evt)])
+
+    def testSyntheticEvents(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            synthetic.generate(tmp + "/a.hepmc", events=3, particles=100, depth=2, seed=1)
+            synthetic.generate(tmp + "/b.hepmc", events=3, particles=100, depth=2, seed=1)
+            with open(tmp + "/a.hepmc") as a, open(tmp + "/b.hepmc") as b:
+                self.assertEqual(a.read(), b.read())
+            events = hepmcio.HepMCReader.fromfilename(tmp + "/a.hepmc").all_events()
+        self.assertEqual(len(events), 3)
+        for evt in events:
+            self.assertEqual(len(evt.particles), 102)
+            #The deepest leaves walk back through every decay generation of their tree to the root.
+            leaf = max(len(hepmcio.get_ancestors(p)) for p in evt.particles.values() if p.status == 1)
+            self.assertEqual(leaf, 2 + 1)
+
+    def testBenchmarkCompare(self):
+        config = {"events":10, "repeat":7}
+        baseline = {"config":config, "benchmarks":{"slow":{"seconds":1.0, "relative":10.0},
+                                                   "short":{"seconds":0.001, "relative":0.01}}}
+        #A machine running at half speed slows the reference workload as much as the benchmarks.
+        halfSpeed = {"config":config, "benchmarks":{"slow":{"seconds":2.0, "relative":10.0},
+                                                    "short":{"seconds":0.002, "relative":0.01}}}
+        slower = {"config":config, "benchmarks":{"slow":{"seconds":1.5, "relative":15.0},
+                                                 "short":{"seconds":0.0015, "relative":0.015}}}
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertEqual(suite.compare(halfSpeed, baseline, 0.25), [])
+            #The short benchmark slowed down by as much, but by less than the noise floor.
+            self.assertEqual(suite.compare(slower, baseline, 0.25), ["slow"])
+            self.assertRaises(ValueError, suite.compare, dict(slower, config={"events":20, "repeat":7}), baseline, 0.25)
+
+    def testParallelRead(self):
+        filename = os.getcwd() + "/event_files/top-reduced.hepmc"
+        events = hepmcio.HepMCReader.fromfilename(filename).all_events()
+        ranges = hepmcio_parallel.event_ranges(filename, 3)
+        self.assertEqual(ranges[0][0], 0)
+        self.assertEqual(ranges[-1][1], os.path.getsize(filename))
+        #Small files are parsed in-process, without starting the worker processes.
+        pool, hepmcio_parallel._pool = hepmcio_parallel._pool, None
+        try:
+            self.assertEqual(list(hepmcio_parallel.read_events(filename, workers=2, chunk_bytes=50000)), events)
+            self.assertIsNone(hepmcio_parallel._pool)
+        finally:
+            hepmcio_parallel._pool = hepmcio_parallel._pool or pool
+        #Small chunks so that the file is split across several worker tasks.
+        parallelEvents = list(hepmcio_parallel.read_events(filename, workers=2, chunk_bytes=50000, min_bytes=0))
+        self.assertEqual(parallelEvents, events)
+        self.assertEqual([e.no for e in parallelEvents], [e.no for e in events])
+        #Every read shares one pool of worker processes.
+        pool = hepmcio_parallel._pool
+        self.assertEqual(len(list(hepmcio_parallel.read_events(filename, workers=2, chunk_bytes=50000,
+                                                               min_bytes=0))), len(events))
+        self.assertIs(hepmcio_parallel._pool, pool)
+        streamed = RecordingCollection()
+        with open(filename, "rb") as f:
+            manifest = ingest.ingest_stream(io.TextIOWrapper(f, encoding="utf-8"), streamed)
+        collection = RecordingCollection()
+        self.assertEqual(ingest.ingest_file(filename, collection, workers=2), manifest)
+        self.assertEqual(collection.documents, streamed.documents)
+
+    def testCompressedInput(self):
+        filename = os.getcwd() + "/event_files/top-reduced.hepmc"
+        events = hepmcio.HepMCReader.fromfilename(filename).all_events()
+        self.assertIsNone(hepmcio.compression(filename))
+        with open(filename, "rb") as f:
+            data = f.read()
+        with tempfile.TemporaryDirectory() as directory:
+            for fmt, module in (("gzip", gzip), ("bz2", bz2), ("xz", lzma)):
+                #The name is misleading on purpose, as the format is detected from the contents.
+                path = os.path.join(directory, fmt + ".hepmc")
+                with open(path, "wb") as f:
+                    f.write(module.compress(data))
+                self.assertEqual(hepmcio.compression(path), fmt)
+                self.assertEqual(hepmcio.HepMCReader.fromfilename(path, fast=True).all_events(), events)
+                self.assertEqual(hepmcio.HepMCReader.fromfilename(path).read_event(3), events[2])
+                self.assertEqual([view.to_event() for view in hepmcio_columnar.ColumnarEvents.from_file(path)], events)
+                documents = list(hepmcio_parallel.read_events(path, workers=2, documents=True, chunk_bytes=50000,
+                                                              min_bytes=0))
+                self.assertEqual(documents, [hepmcio_json.event_documents(e) for e in events])
+
+    @unittest.skipIf(mongomock is None, "mongomock not installed")
+    def testViewThenUpload(self):
+        db = self.mockDatabase()
+        #Files in the event files directory can be viewed before being uploaded, without reserving their name.
+        self.assertEqual(self.app.get("/visualiser/default/").status_code, 200)
+        self.assertEqual(self.app.get("/visualiser/get_event?no=2&filename=default").status_code, 200)
+        self.assertEqual(self.app.get("/visualiser/get_event?no=2&filename=nothing").status_code, 404)
+        self.assertEqual(self.app.get("/visualiser/get_trajectories?no=2&filename=default").status_code, 200)
+        self.assertEqual(self.app.get("/visualiser/get_trajectories?no=2&filename=nothing").status_code, 404)
+        self.assertEqual(db.list_collection_names(), [])
+        #Events read from disk have nothing in the database to prefetch.
+        self.assertEqual(self.prefetched, [])
+        self.assertEqual(self.upload(os.getcwd() + "/event_files/default.hepmc", "default.hepmc").status_code, 202)
+        maxno = eventstore.get_manifest(db["default"])["events"]
+        self.assertEqual(maxno, eventview.file_event_count(os.getcwd() + "/event_files/default.hepmc"))
+        self.assertEqual(self.app.get("/visualiser/default/").status_code, 200)
+        self.assertEqual(self.app.get("/visualiser/get_event?no=2&filename=default").status_code, 200)
+        self.assertEqual(self.prefetched, [(1, maxno), (2, maxno)])
+
+    def testUploadJobs(self):
+        filename = os.getcwd() + "/event_files/top-reduced.hepmc"
+        events = hepmcio.HepMCReader.fromfilename(filename).all_events()
+        payloads = cache.PayloadCache()
+        payloads.put(("top", 1, "default"), b"stale")
+        uploads = jobs.UploadJobs(payloads, max_workers=1, batch_size=500, ingest_workers=1)
+        collection = RecordingCollection()
+        fd, path = tempfile.mkstemp()
+        with os.fdopen(fd, "wb") as f, open(filename, "rb") as source:
+            f.write(source.read())
+        job = uploads.submit("top", path, collection)
+        #A second, unreadable upload queued behind the first.
+        fd, badPath = tempfile.mkstemp()
+        with os.fdopen(fd, "w") as f:
+            f.write("not a HepMC file\n")
+        badCollection = RecordingCollection()
+        badCollection.drop = lambda: badCollection.batches.clear()
+        badJob = uploads.submit("bad", badPath, badCollection)
+        self.assertTrue(uploads.active("bad"))
+        #A file with an upload queued or running cannot be registered again until that job is done or cancelled.
+        self.assertIsNone(uploads.submit("bad", badPath, RecordingCollection()))
+        self.assertIsNone(uploads.reserve("bad"))
+        reserved = uploads.reserve("other")
+        self.assertIsNone(uploads.reserve("other"))
+        uploads.cancel(reserved)
+        self.assertFalse(uploads.active("other"))
+        uploads.shutdown()
+        status = job.status()
+        self.assertEqual(status["state"], jobs.DONE)
+        self.assertEqual(status["events"], len(events))
+        self.assertEqual(status["bytes_read"], os.path.getsize(filename))
+        self.assertEqual(collection.batches[-1][0]["events"], len(events))
+        self.assertIsNone(payloads.get(("top", 1, "default")))
+        self.assertEqual(badJob.status()["state"], jobs.FAILED)
+        self.assertIsNotNone(badJob.status()["error"])
+        self.assertEqual(badCollection.documents, [])
+        self.assertFalse(uploads.active("bad"))
+        self.assertIs(uploads.get(job.id), job)
+        self.assertFalse(os.path.exists(path) or os.path.exists(badPath))
+
+    def testBinaryPayload(self):
+        evt = self.openEvent()
+        particles = eventview.select_particles(evt)
+        vertices = list(evt.vertices.values())
+        decoded = eventbinary.decode_event(eventbinary.encode_event(7, evt, particles))
+        self.assertEqual(decoded["no"], 7)
+        columns = decoded["particles"]
+        self.assertEqual(columns["barcode"].tolist(), [p.barcode for p in particles])
+        self.assertEqual(columns["pid"].tolist(), [p.pid for p in particles])
+        self.assertEqual(columns["status"].tolist(), [p.status for p in particles])
+        #Momenta and charges are stored as float32.
+        close = lambda xs, ys: all(math.isclose(x, y, rel_tol=1e-6, abs_tol=1e-30) for x, y in zip(xs, ys))
+        self.assertTrue(close(columns["momentum"].ravel().tolist(), [x for p in particles for x in p.mom]))
+        self.assertTrue(close(columns["charge"].tolist(), [hepmcio.particle_table().charge(p.pid) for p in particles]))
+        self.assertEqual([vertices[i].barcode for i in columns["start_vertex"]], [p.nvtx_start for p in particles])
+        self.assertEqual(decoded["vertices"]["barcode"].tolist(), [v.barcode for v in vertices])
+        #Binary payloads are cached gzip-compressed, separately from the JSON ones.
+        payloads = cache.PayloadCache()
+        path = os.getcwd() + "/event_files/default.hepmc"
+        body = eventview.cached_file_event_view(path, 1, payloads, binary=True)
+        self.assertEqual(eventbinary.decode_event(gzip.decompress(body))["particles"]["barcode"].tolist(),
+                         [p.barcode for p in particles])
+        self.assertEqual(json.loads(eventview.cached_file_event_view(path, 1, payloads))["no"], 1)
+        self.assertEqual(payloads.stats()["entries"], 2)
+
+    def testTrackBudget(self):
+        evt = self.openEvent()
+        arrays = selection.EventArrays(evt)
+        candidates = selection.select(evt, selection.DEFAULT_CUT, arrays)
+        cut = selection.from_args({"max_tracks":"5", "rank":"energy", "bundle":"1"})
+        self.assertEqual(cut.key, selection.budget(selection.DEFAULT_CUT, 5, "energy", True).key)
+        kept = selection.select(evt, cut, arrays)
+        #The base cut is evaluated and ranked once per arrays, however often the budget is used on them.
+        calls = []
+        base = selection.Cut(lambda a: calls.append(a) or selection.DEFAULT_CUT.mask(a), "counted")
+        counted = selection.budget(base, 5)
+        for evaluate in (counted.mask, counted.soft, counted.mask):
+            evaluate(arrays)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sorted(p.barcode for p in kept),
+                         sorted(p.barcode for p in sorted(candidates, key=lambda p: -p.mom[3])[:5]))
+        #The ancestors of the kept particles are always included.
+        particles = eventview.select_particles(evt, cut)
+        self.assertEqual(particles, evt.ancestors(kept, inclusive=True))
+        #Everything else passing the base cut is summed per type.
+        bundles = eventview.soft_bundles(evt, cut)
+        self.assertEqual(sum(b["count"] for b in bundles), len(candidates) - 5)
+        soft = [p for p in candidates if p not in kept]
+        self.assertTrue(numpy.allclose(numpy.sum([b["momentum"] for b in bundles], axis=0),
+                                       numpy.sum([p.mom for p in soft], axis=0)))
+        self.assertEqual(eventview.soft_bundles(evt, selection.budget(selection.DEFAULT_CUT, 5)), [])
+        #A budget larger than the candidates keeps them all.
+        self.assertEqual(selection.select(evt, selection.budget(selection.DEFAULT_CUT, 10**6), arrays), candidates)
+        self.assertRaises(ValueError, selection.from_args, {"max_tracks":"5", "rank":"mass"})
+        #Bundles travel in both payload formats.
+        path = os.getcwd() + "/event_files/default.hepmc"
+        view = eventview.file_event_view(path, 1, cut)
+        self.assertEqual(view["bundles"], bundles)
+        #Only the vertices of the chosen particles are sent under a budget.
+        self.assertEqual({v["barcode"] for v in view["vertices"]},
+                         ({p.nvtx_start for p in particles} | {p.nvtx_end for p in particles}) - {0})
+        decoded = eventbinary.decode_event(gzip.decompress(eventview.encoded_file_event_view(path, 1, cut, True)))
+        self.assertEqual(decoded["bundles"]["count"].tolist(), [b["count"] for b in bundles])
+        self.assertEqual([selection.TRACK_TYPES[t] for t in decoded["bundles"]["type"]], [b["type"] for b in bundles])
+
+    def testTrajectories(self):
+        #A positive track along x in a 4 T field, a neutral one and one along the beam axis.
+        momentum = [[2.0, 0.0, 1.0], [1.0, 1.0, 0.0], [0.0, 0.0, 5.0]]
+        points = trajectory.propagate(momentum, [1, 0, -1], [[0, 0, 0], [1, 2, 3], [0, 0, 0]], 4.0, 50, 800.0)
+        self.assertEqual(points.shape, (3, 51, 3))
+        #The charged track stays on a circle of radius pT/(0.3 q B) around its centre, turning clockwise.
+        radius = 2.0/(trajectory.CURVATURE*4.0)
+        distances = numpy.hypot(points[0, :, 0], points[0, :, 1] + radius)
+        self.assertTrue(numpy.allclose(distances, radius))
+        self.assertLess(points[0, 1, 1], 0)
+        self.assertTrue(numpy.allclose(points[0, :, 2], numpy.linspace(0, 800/math.sqrt(5), 51)))
+        self.assertTrue(numpy.allclose(points[1, -1], [1 + 800/math.sqrt(2), 2 + 800/math.sqrt(2), 3]))
+        self.assertTrue(numpy.allclose(points[2, -1], [0, 0, 800]))
+        #Without a field every track is straight.
+        straight = trajectory.propagate(momentum, [1, 0, -1], numpy.zeros((3, 3)), 0.0, 4, 800.0)
+        self.assertTrue(numpy.allclose(straight[0, -1], [1600/math.sqrt(5), 0, 800/math.sqrt(5)]))
+        #An event's tracks start at the production vertices of its interesting particles.
+        evt = self.openEvent()
+        particles = eventview.select_particles(evt)
+        points = trajectory.event_trajectories(evt, particles, steps=8)
+        self.assertEqual(points.shape, (len(particles), 9, 3))
+        for p, track in zip(particles, points):
+            self.assertTrue(numpy.allclose(track[0], evt.vertices[p.nvtx_start].pos[:3]))
+        no, decoded = eventbinary.decode_trajectories(eventbinary.encode_trajectories(3, points))
+        self.assertEqual(no, 3)
+        self.assertTrue(numpy.allclose(decoded, points, rtol=1e-6))
+        #Tracks are cached per event, cut and propagation parameters.
+        payloads = cache.PayloadCache()
+        path = os.getcwd() + "/event_files/default.hepmc"
+        body = eventview.cached_file_trajectories(path, 1, payloads, steps=8)
+        self.assertTrue(numpy.allclose(eventbinary.decode_trajectories(gzip.decompress(body))[1], points, rtol=1e-6))
+        self.assertIs(eventview.cached_file_trajectories(path, 1, payloads, steps=8), body)
+        eventview.cached_file_trajectories(path, 1, payloads, field=2.0, steps=8)
+        self.assertEqual(payloads.stats()["entries"], 2)
+
+    def testSelection(self):
+        evt = self.openEvent()
+        particles = list(evt.particles.values())
+        default = [p for p in particles if p.status != 1 and p.mom[0]**2 + p.mom[1]**2 > selection.PT_CUTOFF**2]
+        self.assertEqual(selection.select(evt, selection.DEFAULT_CUT), default)
+        self.assertEqual(selection.from_args({}).key, selection.DEFAULT_CUT.key)
+        cut = selection.from_args({"pt_min":"10", "abs_eta_max":"2.5", "pid":"211,-11"})
+        expected = [p for p in particles if p.status != 1 and math.hypot(p.mom[0], p.mom[1]) > 10 and \
+            abs(math.asinh(p.mom[2]/math.hypot(p.mom[0], p.mom[1]))) < 2.5 and abs(p.pid) in (211, 11)]
+        self.assertEqual(selection.select(evt, cut), expected)
+        finalPhotons = selection.status(1) & selection.pid(22, absolute=False)
+        self.assertEqual(selection.select(evt, finalPhotons), [p for p in particles if p.status == 1 and p.pid == 22])
+        self.assertRaises(ValueError, selection.from_args, {"pt_min":"abc"})
+        for value in ("nan", "inf", "-Infinity"):
+            self.assertRaises(ValueError, selection.from_args, {"eta_max":value})
+        self.assertEqual(self.app.get("/visualiser/get_event?no=1&filename=default&pt_min=nan").status_code, 400)
+
+    def testColumnarEvents(self):
+        filename = os.getcwd() + "/event_files/top-reduced.hepmc"
+        events = hepmcio.HepMCReader.fromfilename(filename).all_events()
+        with tempfile.TemporaryDirectory() as tmp:
+            hepmcio_columnar.ColumnarEvents.from_file(filename).save(tmp + "/top")
+            store = hepmcio_columnar.ColumnarEvents.load(tmp + "/top", mmap_mode="r")
+            self.assertEqual(len(store), len(events))
+            for evt, view in zip(events, store):
+                self.assertEqual(evt, view)
+                self.assertEqual(evt, view.to_event())
+                for bc, p in evt.particles.items():
+                    self.assertEqual(p, view.particles[bc])
+                    self.assertEqual(hepmcio_json.particle_document(p), hepmcio_json.particle_document(view.particles[bc]))
+                    self.assertEqual([q.barcode for q in p.parents() or []], [q.barcode for q in view.particles[bc].parents() or []])
+                    self.assertEqual([q.barcode for q in p.children() or []], [q.barcode for q in view.particles[bc].children() or []])
+
+    def testStageTiming(self):
+        filename = os.getcwd() + "/event_files/default.hepmc"
+        #Nothing is recorded unless a request is being timed on this thread.
+        self.assertIsNone(timing.stop())
+        with timing.stage("parse") as stage:
+            stage.count(particles=1)
+        timings = timing.start()
+        with open(filename) as f:
+            evt = hepmcio.HepMCReader(f, index=hepmcio.load_event_index(filename)).read_event(2)
+        for _ in range(2):
+            with timing.stage("select", particles=3) as stage:
+                stage.count(particles=2, vertices=1)
+        self.assertIs(timing.stop(), timings)
+        self.assertEqual(list(timings.stages), ["parse", "select"])
+        self.assertEqual(timings.stages["select"][1:], [2, {"particles":10, "vertices":2}])
+        header = timings.server_timing(1.5)
+        self.assertRegex(header, r'^parse;dur=[0-9.]+, select;dur=[0-9.]+;desc="particles=10 vertices=2", total;dur=1500.000$')
+        histogram = timing.Histogram((0.1, 1.0))
+        for seconds in (0.05, 0.1, 0.5, 2.0):
+            histogram.observe(seconds)
+        self.assertEqual(histogram.snapshot(), {"count":4, "sum":2.65, "bounds":[0.1, 1.0], "cumulative":[2, 3, 4]})
+        metrics = timing.Metrics()
+        metrics.observe("get_event", 0.2, timings)
+        metrics.observe("get_event", 0.3, None, 404)
+        snapshot = metrics.snapshot()["get_event"]
+        self.assertEqual((snapshot["total"]["count"], snapshot["status"]), (2, {"200":1, "404":1}))
+        self.assertEqual(snapshot["stages"]["select"]["counts"], {"particles":10, "vertices":2})
+        #Responses carry their timings, which are added to the app's metrics.
+        response = self.app.get("/metrics")
+        self.assertIn("total;dur=", response.headers["Server-Timing"])
+        self.assertIn("get_metrics", self.app.get("/metrics").get_json()["endpoints"])
+        with tempfile.TemporaryDirectory() as tmp:
+            profiler = timing.SlowRequestProfiler(tmp, min_seconds=1.0)
+            self.assertIsNone(profiler.finish(profiler.start(), "fast", 0.5))
+            profile = profiler.start()
+            evt.ancestors(evt.particles.values())
+            path = profiler.finish(profile, "slow", 2.0)
+            self.assertEqual(os.listdir(tmp), [os.path.basename(path)])
+            self.assertGreater(pstats.Stats(path).total_calls, 0)
+
 
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file